@@ -23,23 +23,27 @@ async function deleteOldLogs() {
         await client.connect();
         connected = true;
 
-        // 削除対象のレコード数を先に取得
-        const countQuery = `
-            SELECT COUNT(*) 
-            FROM logs 
-            WHERE created_at < NOW() - INTERVAL '7 days'
-        `;
-        const countResult = await client.query(countQuery);
-        const deletedCount = parseInt(countResult.rows[0].count);
+        // logsがパーティション化されていれば、保持期間を過ぎた日のパーティションを丸ごと削除する
+        let droppedPartitions = 0;
+        const partitionedResult = await client.query(
+            `SELECT to_regprocedure('public.logs_drop_partitions(interval)') IS NOT NULL AS partitioned`
+        );
+        if (partitionedResult.rows[0].partitioned) {
+            const dropResult = await client.query(
+                `SELECT public.logs_drop_partitions(INTERVAL '7 days') AS dropped`
+            );
+            droppedPartitions = dropResult.rows[0].dropped;
+        }
 
-        // 古いログを削除
+        // 残りの古いログ（パーティション化前のテーブルやデフォルトパーティションの行）を削除
         const deleteQuery = `
             DELETE FROM logs 
             WHERE created_at < NOW() - INTERVAL '7 days'
         `;
-        await client.query(deleteQuery);
+        const deleteResult = await client.query(deleteQuery);
+        const deletedCount = deleteResult.rowCount;
         
-        await writeLog('info', 'deleteOldLogs', `${deletedCount}件の古いログを削除しました`, null, null);
+        await writeLog('info', 'deleteOldLogs', `${droppedPartitions}個のパーティションと${deletedCount}件の古いログを削除しました`, null, null);
         return true;
 
     } catch (error) {
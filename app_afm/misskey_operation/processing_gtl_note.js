@@ -1,10 +1,18 @@
 import { config } from 'dotenv';
+import axios from 'axios';
 import pkg from 'pg';
 import { writeLog } from '../db_operation/create_logs.js';
 const { Client } = pkg;
 
 config();
 
+// python-afmの取り込みAPIへまとめて送るためのバッファ
+const INGEST_URL = 'http://python-afm:3000/ingest/notes';
+const INGEST_BATCH_SIZE = 100;
+const INGEST_FLUSH_INTERVAL = 2000;
+let pendingNotes = [];
+let flushTimer = null;
+
 const createDBClient = () => {
     return new Client({
         user: process.env.POSTGRES_USER,
@@ -15,7 +23,7 @@ const createDBClient = () => {
     });
 };
 
-async function processGtlNote(note) {
+async function insertGtlNote(note) {
     let client = createDBClient();
     let connected = false;
     
@@ -23,16 +31,20 @@ async function processGtlNote(note) {
         await client.connect();
         connected = true;
 
+        // 取り込みAPIが保存した後に失敗を返した場合もあるため、保存済みのノートは飛ばす
         const query = `
-            INSERT INTO glt_observation (user_name, instance_name, post_text)
-            VALUES ($1, $2, $3)
+            INSERT INTO glt_observation (note_id, user_name, instance_name, post_text)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (note_id) DO NOTHING
             RETURNING gtl_id
         `;
         
         const values = [
+            note.id,
             note.user.name,
-            note.user.instance.name,
-            note.text
+            // ローカルユーザーのノートにはinstanceがない
+            note.user.instance?.name ?? null,
+            note.text ?? null
         ];
 
         const result = await client.query(query, values);
@@ -57,4 +69,54 @@ async function processGtlNote(note) {
     }
 }
 
+async function flushGtlNotes() {
+    if (flushTimer) {
+        clearTimeout(flushTimer);
+        flushTimer = null;
+    }
+    const notes = pendingNotes;
+    pendingNotes = [];
+    if (notes.length === 0) {
+        return true;
+    }
+
+    try {
+        // python-afm側で形態素解析した結果と一緒に保存する
+        const response = await axios.post(INGEST_URL, {
+            notes: notes.map(note => ({
+                note_id: note.id,
+                user_name: note.user.name,
+                // ローカルユーザーのノートにはinstanceがなく、リノートはtextがnull
+                instance_name: note.user.instance?.name ?? null,
+                text: note.text ?? null
+            }))
+        });
+        const rejected = response.data?.rejected ?? [];
+        if (rejected.length) {
+            const warning_message = `取り込みAPIで保存されなかったノートがあります: ${JSON.stringify(rejected)}`;
+            await writeLog('warning', 'processGtlNote', warning_message, null, null);
+        }
+        return true;
+    } catch (error) {
+        const error_message = `GTL観測データの取り込みAPIでエラーが発生したため直接保存します: ${error.message}`;
+        await writeLog('error', 'processGtlNote', error_message, null, null);
+        // 取り込みAPIが使えない場合は従来どおり1件ずつ保存する（note_idで重複を防ぐため、タイムアウト後も安全）
+        for (const note of notes) {
+            await insertGtlNote(note);
+        }
+        return false;
+    }
+}
+
+async function processGtlNote(note) {
+    pendingNotes.push(note);
+    if (pendingNotes.length >= INGEST_BATCH_SIZE) {
+        return flushGtlNotes();
+    }
+    if (!flushTimer) {
+        flushTimer = setTimeout(flushGtlNotes, INGEST_FLUSH_INTERVAL);
+    }
+    return true;
+}
+
 export { processGtlNote };
\ No newline at end of file
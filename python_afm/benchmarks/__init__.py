@@ -0,0 +1,10 @@
+"""テキスト生成・ワードクラウドの処理速度を再現可能な条件で計測するベンチマーク
+
+合成したノートをメモリ上のDB（fakedb.FakeDatabase）に入れ、実際のPostgreSQLなしで計測する。
+python_afmディレクトリで実行する:
+
+    python -m benchmarks --save-baseline baseline.json
+    python -m benchmarks --baseline baseline.json --output result.json
+
+ベースラインより中央値が --threshold の割合を超えて遅いシナリオがあれば終了コード1で終わる。
+"""
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import statistics
+from datetime import datetime
+
+# 計測対象のモジュールを読み込む前に、結果がぶれにくい設定にしておく（環境変数で上書きできる）
+# ワーカープロセスを使わず、ログのサンプリング・レート制限もしない
+os.environ.setdefault('WORKER_POOL_SIZE', '0')
+os.environ.setdefault('LOG_RATE_LIMIT', '0')
+
+from benchmarks.corpus import NOISE_KINDS, generate_notes
+from benchmarks.fakedb import FakeDatabase
+from benchmarks.scenarios import SCENARIOS, BenchmarkContext
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(runs, wall_seconds):
+    """実行ごと（エンドポイントはリクエストごと）の所要時間を集計する"""
+    samples = []
+    processed = errors = 0
+    for run in runs:
+        samples.extend(run.latencies if run.latencies is not None else [run.seconds])
+        processed += run.processed
+        errors += run.errors
+    return {
+        'samples': len(samples),
+        'median': statistics.median(samples),
+        'p95': percentile(samples, 0.95),
+        'min': min(samples),
+        'mean': statistics.fmean(samples),
+        'items_per_second': processed / wall_seconds if wall_seconds else None,
+        'errors': errors
+    }
+
+
+def run_scenario(name, ctx, repeat, warmup):
+    run = SCENARIOS[name](ctx)
+    for _ in range(warmup):
+        run()
+    runs = []
+    wall_seconds = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        result.seconds = time.perf_counter() - started
+        wall_seconds += result.seconds
+        runs.append(result)
+    return summarize(runs, wall_seconds)
+
+
+def compare(results, baseline, threshold):
+    """中央値がベースラインより threshold の割合を超えて遅くなったシナリオを回帰とする"""
+    comparison = {}
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or 'median' not in previous:
+            comparison[name] = {'status': 'new'}
+            continue
+        ratio = current['median'] / previous['median'] if previous['median'] else float('inf')
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        comparison[name] = {'status': status, 'ratio': round(ratio, 4),
+                            'baseline_median': previous['median'], 'median': current['median']}
+    return comparison
+
+
+def print_report(results, comparison):
+    print(f"{'scenario':<22}{'median(ms)':>12}{'p95(ms)':>12}{'items/s':>12}{'errors':>8}  vs baseline")
+    for name, result in results.items():
+        line = (f"{name:<22}{result['median'] * 1000:>12.2f}{result['p95'] * 1000:>12.2f}"
+                f"{result['items_per_second'] or 0:>12.1f}{result['errors']:>8}")
+        if comparison:
+            entry = comparison[name]
+            line += f"  {entry['status']}" + (f" (x{entry['ratio']:.3f})" if 'ratio' in entry else '')
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='テキスト生成・ワードクラウドの処理速度を計測する')
+    parser.add_argument('--size', type=int, default=2000, help='合成するノートの件数')
+    parser.add_argument('--noise', type=float, default=0.1, help='ノイズを混ぜるノートの割合')
+    parser.add_argument('--noise-kinds', default=','.join(NOISE_KINDS), help='混ぜるノイズ（カンマ区切り）')
+    parser.add_argument('--span-hours', type=float, default=24, help='ノートの投稿時刻を分布させる期間')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='実行するシナリオ（カンマ区切り）')
+    parser.add_argument('--repeat', type=int, default=5, help='シナリオごとの計測回数')
+    parser.add_argument('--warmup', type=int, default=1, help='計測前に捨てる実行回数')
+    parser.add_argument('--concurrency', type=int, default=8, help='エンドポイントへの同時リクエスト数')
+    parser.add_argument('--requests', type=int, default=50, help='エンドポイントの1回の計測で送るリクエスト数')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='クエリごとに加える待ち時間（ミリ秒）')
+    parser.add_argument('--output', help='結果のJSONを書き出すパス')
+    parser.add_argument('--baseline', help='比較するベースラインのJSON')
+    parser.add_argument('--save-baseline', help='今回の結果をベースラインとして保存するパス')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='中央値がベースラインよりこの割合を超えて遅ければ回帰として終了コード1を返す')
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    args.noise_kinds = [kind.strip() for kind in args.noise_kinds.split(',') if kind.strip()]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    db = FakeDatabase(latency=args.db_latency / 1000).install()
+    notes = generate_notes(args.size, args.noise, args.noise_kinds, args.seed, args.span_hours)
+    db.load_notes(notes)
+    ctx = BenchmarkContext(db, [note['text'] for note in notes], args.seed, args.concurrency, args.requests)
+    # モデルのスナップショットは実行ごとの作業ディレクトリに置き、前回の結果を読み込まないようにする
+    os.environ.setdefault('MARKOV_MODEL_PATH', os.path.join(ctx.workdir, 'markov_model.bin'))
+
+    results = {}
+    try:
+        # 実行順はSCENARIOSの定義順に揃える
+        for name in [name for name in SCENARIOS if name in args.scenarios]:
+            print(f"running {name}...", file=sys.stderr)
+            results[name] = run_scenario(name, ctx, args.repeat, args.warmup)
+    finally:
+        ctx.close()
+        shutil.rmtree(ctx.workdir, ignore_errors=True)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            comparison = compare(results, json.load(f)['scenarios'], args.threshold)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'params': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline', 'save_baseline')},
+            'fake_db': db.stats()
+        },
+        'scenarios': results
+    }
+    if comparison is not None:
+        report['comparison'] = comparison
+
+    print_report(results, comparison)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    regressions = [name for name, entry in (comparison or {}).items() if entry['status'] == 'regression']
+    if regressions:
+        print(f"regressions beyond {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
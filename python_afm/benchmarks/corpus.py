@@ -0,0 +1,97 @@
+import random
+from text_filter import CHINESE_CHARS
+
+# 文章の組み立てに使う語彙（名詞が偏りすぎないよう、ワードクラウドに出る語を多めに入れておく）
+SUBJECTS = ['今日', '昨日', '明日', '週末', '朝', '夜', '猫', '犬', '友達', '先輩', '後輩', '家族', '上司',
+            'タイムライン', 'サーバー', 'インスタンス', '新作', 'アニメ', 'ゲーム', '電車', '会社', '学校']
+OBJECTS = ['ラーメン', 'カレー', 'コーヒー', '紅茶', 'ケーキ', '写真', '動画', '漫画', '小説', '音楽',
+           'ライブ', '映画', '絵', 'プログラム', 'ブラウザ', 'データベース', '散歩', '掃除', '洗濯', '料理']
+ADJECTIVES = ['とても', 'すごく', 'ちょっと', 'かなり', 'やっぱり', 'なんとなく', '久しぶりに', 'ついに']
+PREDICATES = ['美味しかった', '楽しかった', '眠い', '忙しい', '面白い', 'かわいい', '疲れた', '最高だった',
+              '見に行った', '作ってみた', '買ってしまった', '始めました', '終わらない', 'したい']
+ENDINGS = ['', '。', '！', '…', 'ね', 'よ', 'な', 'かも', 'わ', 'ですね', 'でした']
+CONNECTORS = ['けど', 'ので', 'から', 'し', 'て']
+
+EMOJI = ['😂', '🥺', '✨', '🍜', '☕', '🎉', '😴', '🐈', ':blobcat:', ':igyo:', ':role_white:']
+DOMAINS = ['misskey.io', 'example.com', 'mstdn.jp', 'fedibird.com']
+
+# ノイズの種類（フィルタで除外・検証される対象）
+NOISE_KINDS = ('url', 'mention', 'chinese', 'emoji')
+
+# 実際のタイムラインのように出現頻度の低い語が多数ある状態を作るため、カタカナの造語を混ぜる
+# （ワードクラウドは描画した語を除外ワードに加えるため、語彙が少ないとすぐに描画できる語がなくなる）
+KATAKANA = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン'
+TAIL_VOCABULARY_SIZE = 3000
+
+
+def _tail_vocabulary(size, seed=0x61666d):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(KATAKANA) for _ in range(rng.randint(3, 6))))
+    words = sorted(words)
+    # 順位に反比例する出現頻度（Zipf分布）
+    weights = [1 / rank for rank in range(1, size + 1)]
+    return words, weights
+
+
+_TAIL_WORDS, _TAIL_WEIGHTS = _tail_vocabulary(TAIL_VOCABULARY_SIZE)
+
+
+def _sentence(rng):
+    obj = rng.choices(_TAIL_WORDS, _TAIL_WEIGHTS)[0] if rng.random() < 0.5 else rng.choice(OBJECTS)
+    parts = [rng.choice(SUBJECTS), 'は', rng.choice(ADJECTIVES), obj]
+    parts.append(rng.choice(['が', 'を', 'で', 'も']))
+    parts.append(rng.choice(PREDICATES))
+    return ''.join(parts)
+
+
+def _add_noise(rng, text, kind):
+    if kind == 'url':
+        return f"{text} https://{rng.choice(DOMAINS)}/notes/{rng.getrandbits(40):x}"
+    if kind == 'mention':
+        return f"@user{rng.randrange(1000)}@{rng.choice(DOMAINS)} {text}"
+    if kind == 'chinese':
+        position = rng.randrange(len(text) + 1)
+        chars = ''.join(rng.choice(CHINESE_CHARS) for _ in range(rng.randint(1, 3)))
+        return text[:position] + chars + text[position:]
+    if kind == 'emoji':
+        return text + ''.join(rng.choice(EMOJI) for _ in range(rng.randint(1, 3)))
+    raise ValueError(f"Unknown noise kind: {kind}")
+
+
+def generate_texts(size, noise=0.1, noise_kinds=NOISE_KINDS, seed=0):
+    """合成した日本語のノートをsize件生成する
+
+    noiseの割合のノートに、noise_kindsから選んだURL・メンション・中国語の文字・絵文字を混ぜる。
+    同じseedなら同じ内容になる。
+    """
+    rng = random.Random(seed)
+    noise_kinds = list(noise_kinds)
+    texts = []
+    for _ in range(size):
+        text = _sentence(rng)
+        for _ in range(rng.choice([0, 0, 1, 1, 2])):
+            text += rng.choice(CONNECTORS) + _sentence(rng)
+        text += rng.choice(ENDINGS)
+        if noise_kinds and rng.random() < noise:
+            text = _add_noise(rng, text, rng.choice(noise_kinds))
+        texts.append(text)
+    return texts
+
+
+def generate_notes(size, noise=0.1, noise_kinds=NOISE_KINDS, seed=0, span_hours=24):
+    """glt_observationに入れるノート（本文・投稿者・投稿時刻）を投稿時刻の古い順に生成する"""
+    rng = random.Random(seed + 1)
+    texts = generate_texts(size, noise, noise_kinds, seed)
+    offsets = sorted((rng.uniform(0, span_hours * 3600) for _ in range(size)), reverse=True)
+    return [
+        {
+            'user_name': f"user{rng.randrange(500)}",
+            'instance_name': rng.choice(DOMAINS),
+            'text': text,
+            # 投稿からの経過秒（FakeDatabaseが投稿時刻に変換する）
+            'age_seconds': offset
+        }
+        for text, offset in zip(texts, offsets)
+    ]
@@ -0,0 +1,313 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from datetime import datetime
+import psycopg2
+import psycopg2.extensions
+import db_pool
+
+# execute_valuesがmogrifyで組み立てた各行を、実行時に元の値へ戻すための目印
+_ROW_MARKER = re.compile(r'\x00(\d+)\x00')
+
+
+class FakeDatabase:
+    """ベンチマーク用に、このパッケージが発行するクエリだけに応答するメモリ上のDB
+
+    glt_observation・note_text・memorandum・logsを保持する。
+    install()するとdb_poolの接続の作成がこのDBへの接続に置き換わる。
+    """
+
+    def __init__(self, latency=0.0, forbidden_words=(), stop_words=(), wordcloud_forbidden=''):
+        # 1クエリごとに加える待ち時間（秒）。DBとの往復を模擬する
+        self.latency = latency
+        self._lock = threading.Lock()
+        # (gtl_id, post_text, 投稿時刻のepoch秒, tokens, pos, user_name, instance_name)
+        self.observations = []
+        self._eligible_ids = []
+        self._eligible = []
+        self._note_ids = set()
+        self.note_text = {'forbidden': list(forbidden_words), 'stop_words': list(stop_words)}
+        self.memorandum = {'wordcloud_forbidden': wordcloud_forbidden}
+        self.logs = []
+        # job_id -> generation_jobsの行（列の順はJobStore.loadのSELECTと同じ）
+        self.jobs = {}
+        self.queries = 0
+        # 対応していないクエリ（空の結果を返したもの）
+        self.unknown_queries = []
+
+    # --- データの投入・確認 ---
+
+    @staticmethod
+    def is_eligible(text):
+        """003_corpus_indexes.sqlのeligible列と同じ条件"""
+        return text is not None and len(text) >= 10 and 'http' not in text and '@' not in text
+
+    def add_observation(self, text, posted_at=None, tokens=None, pos=None, user_name=None, instance_name=None):
+        with self._lock:
+            gtl_id = len(self.observations) + 1
+            row = (gtl_id, text, time.time() if posted_at is None else posted_at, tokens, pos,
+                   user_name, instance_name)
+            self.observations.append(row)
+            if self.is_eligible(text):
+                self._eligible_ids.append(gtl_id)
+                self._eligible.append(row)
+            return gtl_id
+
+    def load_notes(self, notes):
+        """corpus.generate_notes()の結果を投稿時刻付きで入れる"""
+        now = time.time()
+        for note in notes:
+            self.add_observation(note['text'], now - note['age_seconds'],
+                                 user_name=note.get('user_name'), instance_name=note.get('instance_name'))
+
+    def reset_memorandum(self, wordcloud_forbidden=''):
+        with self._lock:
+            self.memorandum['wordcloud_forbidden'] = wordcloud_forbidden
+
+    def install(self):
+        db_pool.set_connection_factory(self.connect)
+        return self
+
+    def uninstall(self):
+        db_pool.set_connection_factory(None)
+
+    def connect(self, **db_params):
+        return FakeConnection(self)
+
+    # --- クエリの実行 ---
+
+    def execute(self, query, params, rows=None):
+        """クエリを実行して結果の行のリストを返す（rowsはexecute_valuesで渡された各行）"""
+        if self.latency:
+            time.sleep(self.latency)
+        sql = ' '.join(query.split())
+        with self._lock:
+            self.queries += 1
+            return self._dispatch(sql, params, rows)
+
+    def _eligible_after(self, last_id):
+        return bisect.bisect_right(self._eligible_ids, last_id)
+
+    def _dispatch(self, sql, params, rows):
+        if sql == 'SELECT 1' or sql.startswith('SELECT 1 FROM public.schema_migrations'):
+            # マイグレーションは適用済みとして扱う
+            return [(1,)]
+        if 'pg_advisory_xact_lock' in sql or 'pg_try_advisory_xact_lock' in sql:
+            return [(True,)]
+        if sql.startswith(('CREATE ', 'LISTEN ', 'SET ', 'INSERT INTO public.schema_migrations')):
+            return []
+        if 'to_regprocedure' in sql:
+            # logsはパーティション化していない扱いにする
+            return [(False,)]
+        if sql.startswith('EXPLAIN'):
+            return [([{'Plan': {'Node Type': 'Index Scan', 'Relation Name': 'glt_observation',
+                                'Index Name': 'glt_observation_eligible_gtl_id_idx'}}],)]
+        if sql.startswith('SELECT EXTRACT(EPOCH FROM LOCALTIMESTAMP)'):
+            return [(time.time(),)]
+
+        if 'FROM public.glt_observation' in sql:
+            return self._select_observations(sql, params)
+        if 'INSERT INTO public.glt_observation' in sql:
+            return self._insert_observations(rows)
+
+        if 'FROM public.note_text' in sql:
+            key = re.search(r"key = '(\w+)'", sql).group(1)
+            value = self.note_text.get(key)
+            return [(list(value),)] if value is not None else []
+        if 'FROM public.memorandum' in sql:
+            key = re.search(r"key = '(\w+)'", sql).group(1)
+            return [(self.memorandum[key],)] if key in self.memorandum else []
+        if sql.startswith('INSERT INTO public.memorandum'):
+            self.memorandum['wordcloud_forbidden'] = params[0]
+            return []
+        if sql.startswith('INSERT INTO logs'):
+            self.logs.extend(rows or [])
+            return []
+        if 'public.generation_jobs' in sql:
+            return self._generation_jobs(sql, params)
+
+        self.unknown_queries.append(sql)
+        return []
+
+    def _generation_jobs(self, sql, params):
+        if sql.startswith('INSERT'):
+            (job_id, kind, job_params, status, result, data, error, error_status, joined,
+             created_at, finished_at) = params
+            # psycopg2.Binaryは元のバイト列をadaptedに持つ
+            data = getattr(data, 'adapted', data)
+            self.jobs[job_id] = (job_id, kind, json.loads(job_params), status,
+                                 json.loads(result) if result is not None else None,
+                                 bytes(data) if data is not None else None,
+                                 error, error_status, joined, created_at, finished_at)
+            return []
+        if sql.startswith('SELECT'):
+            row = self.jobs.get(params[0])
+            if row is None:
+                return []
+            if 'SELECT job_id, kind, params, status, result, result_data' not in sql and row[5] is not None:
+                row = row[:5] + (b'',) + row[6:]
+            return [row]
+        if sql.startswith('DELETE'):
+            cutoff = params[0]
+            expired = [job_id for job_id, row in self.jobs.items() if (row[10] or row[9]) < cutoff]
+            for job_id in expired:
+                del self.jobs[job_id]
+            return []
+        self.unknown_queries.append(sql)
+        return []
+
+    def _select_observations(self, sql, params):
+        eligible = self._eligible
+        if 'unnest' in sql:
+            # PIVOT_SAMPLE_SQL: 各起点からrun_length件
+            pivots, run_length = params
+            result = []
+            for pivot in pivots:
+                start = bisect.bisect_left(self._eligible_ids, pivot)
+                result.extend((row[0], row[1], row[3], row[4]) for row in eligible[start:start + run_length])
+            return result
+        if 'min(gtl_id)' in sql:
+            # CORPUS_BOUNDS_SQL
+            if not eligible:
+                return [(None, None, None)]
+            since = time.time() - params[0] * 3600
+            recent = next((row[0] for row in eligible if row[2] >= since), None)
+            return [(eligible[0][0], eligible[-1][0], recent)]
+        if 'EXTRACT(EPOCH' in sql:
+            # OBSERVATIONS_AFTER_SQL
+            last_id, since_seconds, limit = params
+            since = time.time() - since_seconds
+            matched = (row for row in eligible[self._eligible_after(last_id):] if row[2] >= since)
+            return [(row[0], row[1], row[2], row[3], row[4]) for _, row in zip(range(limit), matched)]
+        if 'gtl_id >' in sql:
+            # TEXTS_AFTER_SQL（limitがNoneなら全件）
+            last_id, limit = params
+            start = self._eligible_after(last_id)
+            end = None if limit is None else start + limit
+            return [(row[0], row[1], datetime.fromtimestamp(row[2]), row[3], row[4]) for row in eligible[start:end]]
+        self.unknown_queries.append(sql)
+        return []
+
+    def _insert_observations(self, rows):
+        now = time.time()
+        result = []
+        for note_id, user_name, instance_name, text, tokens, pos in rows:
+            # ON CONFLICT (note_id) DO NOTHING
+            if note_id is not None:
+                if note_id in self._note_ids:
+                    continue
+                self._note_ids.add(note_id)
+            gtl_id = len(self.observations) + 1
+            row = (gtl_id, text, now, tokens, pos, user_name, instance_name)
+            self.observations.append(row)
+            if self.is_eligible(text):
+                self._eligible_ids.append(gtl_id)
+                self._eligible.append(row)
+            result.append((gtl_id,))
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'observations': len(self.observations),
+                'eligible': len(self._eligible),
+                'logs': len(self.logs),
+                'queries': self.queries,
+                'unknown_queries': len(self.unknown_queries)
+            }
+
+
+class FakeConnection:
+    """psycopg2の接続のうち、このパッケージが使う部分だけを持つ"""
+
+    encoding = 'UTF8'
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.notifies = []
+        # LISTEN中のselect()に渡すため、書き込まれることのないパイプを持っておく
+        self._read_fd, self._write_fd = os.pipe()
+
+    def cursor(self, name=None):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        return FakeCursor(self)
+
+    def fileno(self):
+        return self._read_fd
+
+    def poll(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def set_isolation_level(self, level):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        if not self.closed:
+            self.closed = 1
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.itersize = 2000
+        self._rows = []
+        self._position = 0
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._rows = []
+
+    def mogrify(self, template, args):
+        # execute_valuesの各行は値のまま保持し、目印だけをクエリに埋め込む
+        self._pending.append(tuple(args))
+        return f'\x00{len(self._pending) - 1}\x00'.encode('utf-8')
+
+    def execute(self, query, params=None):
+        rows = None
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+            indexes = [int(i) for i in _ROW_MARKER.findall(query)]
+            if indexes:
+                rows = [self._pending[i] for i in indexes]
+                query = _ROW_MARKER.sub('', query)
+            self._pending = []
+        self._rows = self.connection.db.execute(query, params, rows)
+        self._position = 0
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        while self._position < len(self._rows):
+            yield self.fetchone()
@@ -0,0 +1,161 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BenchmarkContext:
+    """各シナリオで共有するDB・コーパス・計測対象のオブジェクト（必要になったときに作る）"""
+
+    def __init__(self, db, texts, seed=0, concurrency=8, requests=50):
+        self.db = db
+        self.texts = texts
+        self.seed = seed
+        self.concurrency = concurrency
+        self.requests = requests
+        self.db_params = {'dbname': 'benchmark'}
+        self.workdir = tempfile.mkdtemp(prefix='afm-bench-')
+        self._processor = None
+        self._log_manager = None
+        self._main = None
+
+    @property
+    def log_manager(self):
+        if self._log_manager is None:
+            from create_logs import LogManager
+            self._log_manager = LogManager(self.db_params)
+        return self._log_manager
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            from text_processor import TextProcessor
+            self._processor = TextProcessor(self.db_params, log_manager=self.log_manager)
+            self._processor.warm_up()
+        return self._processor
+
+    @property
+    def main(self):
+        """main.pyのモジュール。読み込み時にinit_app()でモデルの学習と定期更新の開始まで行われる"""
+        if self._main is None:
+            import main
+            self._main = main
+        return self._main
+
+    def close(self):
+        if self._log_manager is not None:
+            self._log_manager.close()
+
+
+class Run:
+    """1回の実行結果（processed件を処理。エンドポイントはリクエストごとの所要時間も持つ）"""
+
+    def __init__(self, processed, latencies=None, errors=0):
+        self.processed = processed
+        self.latencies = latencies
+        self.errors = errors
+        self.seconds = None
+
+
+def tokenize(ctx):
+    """形態素解析のキャッシュを空にしてから全テキストをtokenize()する"""
+    processor = ctx.processor
+
+    def run():
+        processor.token_cache.clear()
+        for text in ctx.texts:
+            processor.tokenize(text)
+        return Run(len(ctx.texts))
+    return run
+
+
+def generate_markov_text(ctx):
+    """コーパスの前処理・モデルの構築・文の生成までを通して行う"""
+    processor = ctx.processor
+
+    def run():
+        processor.token_cache.clear()
+        random.seed(ctx.seed)
+        processor.generate_markov_text(ctx.texts)
+        return Run(len(ctx.texts))
+    return run
+
+
+def generate_wordcloud(ctx):
+    """名詞の集計からPNGの書き出しまで（描画結果のキャッシュと除外ワードは毎回元に戻す）"""
+    processor = ctx.processor
+    output_path = os.path.join(ctx.workdir, 'wordcloud.png')
+
+    def run():
+        processor.token_cache.clear()
+        processor.renderer.clear()
+        ctx.db.reset_memorandum()
+        processor.word_lists.invalidate('wordcloud_forbidden')
+        if not processor.generate_wordcloud(ctx.texts, output_path):
+            raise RuntimeError('generate_wordcloud failed')
+        return Run(len(ctx.texts))
+    return run
+
+
+def write_log(ctx):
+    """テキストの件数分のログを書き込み、キューが空になるまでを計測する"""
+    log_manager = ctx.log_manager
+
+    def run():
+        for i, text in enumerate(ctx.texts):
+            log_manager.write_log('INFO', 'benchmark', f'Processed note {i}',
+                                  metadata={'length': len(text), 'sample': text[:20]})
+        log_manager.flush()
+        return Run(len(ctx.texts))
+    return run
+
+
+def _endpoint(ctx, path, params_list, before_run=None):
+    app = ctx.main.app
+    local = threading.local()
+
+    def request(i):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        response = client.get(path, query_string=params_list[i % len(params_list)])
+        response.get_data()
+        return time.perf_counter() - started, response.status_code
+
+    def run():
+        if before_run is not None:
+            before_run()
+        with ThreadPoolExecutor(max_workers=ctx.concurrency) as executor:
+            results = list(executor.map(request, range(ctx.requests)))
+        errors = sum(1 for _, status in results if status >= 400)
+        return Run(len(results), [seconds for seconds, _ in results], errors)
+    return run
+
+
+def endpoint_text(ctx):
+    """/generate/textへ同時にconcurrency件ずつリクエストする"""
+    return _endpoint(ctx, '/generate/text', [{}])
+
+
+def endpoint_wordcloud(ctx):
+    """/generate/wordcloudへ同時にリクエストする（集計期間を変えて描画のキャッシュに当たらない依頼も混ぜる）"""
+    def reset():
+        # 前の計測で描画した語が除外ワードに溜まったままにならないよう、毎回元に戻す
+        ctx.db.reset_memorandum()
+        ctx.main.processor.word_lists.invalidate('wordcloud_forbidden')
+        ctx.main.processor.renderer.clear()
+    return _endpoint(ctx, '/generate/wordcloud', [{'hours': hours} for hours in (1, 2, 4, 8, 12, 24)], reset)
+
+
+# 実行順（エンドポイントはmain.pyを読み込み定期更新のスレッドが動き出すため最後にする）
+SCENARIOS = {
+    'tokenize': tokenize,
+    'generate_markov_text': generate_markov_text,
+    'generate_wordcloud': generate_wordcloud,
+    'write_log': write_log,
+    'endpoint_text': endpoint_text,
+    'endpoint_wordcloud': endpoint_wordcloud
+}
@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import mmap
+import time
+import random
+import struct
+from array import array
+from bisect import bisect_right
+
+# 特殊トークンのID
+BEGIN_ID = 0
+END_ID = 1
+
+# 保存形式：マジック・形式バージョン・状態数・メタ情報の長さ
+MAGIC = b'AFMC'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sHHI')
+# 語彙のバイト数・状態数・遷移数
+_COUNTS = struct.Struct('<QQQ')
+# 配列の型（状態のトークン列・遷移の開始位置・遷移先トークン・累積重み・遷移先の状態）
+_ARRAY_TYPECODES = ('I', 'I', 'I', 'Q', 'i')
+
+SUPPORTED_STATE_SIZES = (2, 3, 4)
+
+
+def _pad(length, alignment=8):
+    return -length % alignment
+
+
+class _ChainBuilder:
+    """トークン列や遷移回数を受け取り、CompactChainを組み立てる"""
+
+    def __init__(self, state_size):
+        if state_size not in SUPPORTED_STATE_SIZES:
+            raise ValueError(f"Unsupported state size: {state_size}")
+        self.state_size = state_size
+        self.vocab = ['', '']
+        self.token_ids = {}
+        # (状態のトークンID..., 次のトークンID) -> 出現回数
+        self.counts = {}
+
+    def intern(self, token):
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = len(self.vocab)
+            self.token_ids[token] = token_id
+            self.vocab.append(token)
+        return token_id
+
+    def add_run(self, tokens):
+        """1文分のトークン列を学習"""
+        intern = self.intern
+        counts = self.counts
+        items = [BEGIN_ID] * self.state_size + [intern(token) for token in tokens] + [END_ID]
+        # (状態 + 次のトークン)の組を1つのタプルとして数える
+        for key in zip(*(items[i:] for i in range(self.state_size + 1))):
+            counts[key] = counts.get(key, 0) + 1
+
+    def add_count(self, state_tokens, follow_token, count):
+        """文字列の状態と遷移先を回数付きで追加（モデルの結合・変換用）"""
+        key = tuple(BEGIN_ID if token is None else self.intern(token) for token in state_tokens)
+        key += (END_ID if follow_token is None else self.intern(follow_token),)
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def build(self):
+        if not self.counts:
+            return None
+        keys = sorted(self.counts)
+        # 並べ替えた組は状態ごとにまとまっている。開始状態（BEGINのみ）はIDが最小なので必ず先頭に来る
+        state_ids = {}
+        for key in keys:
+            state = key[:-1]
+            if state not in state_ids:
+                state_ids[state] = len(state_ids)
+
+        state_tokens = array('I')
+        offsets = array('I', [0])
+        next_tokens = array('I')
+        cum_weights = array('Q')
+        next_states = array('i')
+        previous_state = None
+        total = 0
+        for key in keys:
+            state = key[:-1]
+            follow = key[-1]
+            if state != previous_state:
+                if previous_state is not None:
+                    offsets.append(len(next_tokens))
+                state_tokens.extend(state)
+                previous_state = state
+                total = 0
+            total += self.counts[key]
+            next_tokens.append(follow)
+            cum_weights.append(total)
+            next_states.append(-1 if follow == END_ID else state_ids[key[1:]])
+        offsets.append(len(next_tokens))
+        self.counts = {}
+        return CompactChain(self.state_size, self.vocab, state_tokens, offsets, next_tokens, cum_weights, next_states)
+
+
+class CompactChain:
+    """トークンを整数IDに置き換え、遷移をCSR形式の配列に詰めたマルコフ連鎖"""
+
+    def __init__(self, state_size, vocab, state_tokens, offsets, next_tokens, cum_weights, next_states):
+        self.state_size = state_size
+        # ID -> トークン（0と1はBEGIN/END）
+        self.vocab = vocab
+        self.state_tokens = state_tokens
+        # 状態iの遷移は offsets[i]:offsets[i + 1] の範囲
+        self.offsets = offsets
+        self.next_tokens = next_tokens
+        # 状態ごとに0から積み上げた重み（二分探索で遷移を選ぶ）
+        self.cum_weights = cum_weights
+        # 遷移した後の状態のID（ENDへの遷移は-1）
+        self.next_states = next_states
+        self._token_ids = None
+        # 配列がファイルのmmapを直接参照しているか（同じファイルを開いたプロセス間でページを共有する）
+        self.mapped = False
+
+    @classmethod
+    def build(cls, runs, state_size=2):
+        """トークン列のイテレータから構築（空ならNone）"""
+        builder = _ChainBuilder(state_size)
+        for run in runs:
+            builder.add_run(run)
+        return builder.build()
+
+    @classmethod
+    def from_markovify(cls, model):
+        """markovifyのTextまたはChainから変換"""
+        from markovify.chain import BEGIN, END
+        chain = getattr(model, 'chain', model)
+        builder = _ChainBuilder(chain.state_size)
+        for state, followers in chain.model.items():
+            state_tokens = [None if token == BEGIN else token for token in state]
+            if isinstance(followers, list):
+                # compile()済みのモデルは(候補, 累積重み)の組で持っている
+                choices, cumdist = followers
+                previous = 0
+                items = []
+                for choice, cumulative in zip(choices, cumdist):
+                    items.append((choice, cumulative - previous))
+                    previous = cumulative
+            else:
+                items = followers.items()
+            for follow, count in items:
+                builder.add_count(state_tokens, None if follow == END else follow, count)
+        return builder.build()
+
+    @classmethod
+    def combine(cls, chains):
+        """複数の連鎖の遷移回数を合算した新しい連鎖を返す"""
+        chains = [chain for chain in chains if chain is not None]
+        if not chains:
+            return None
+        state_size = chains[0].state_size
+        if any(chain.state_size != state_size for chain in chains):
+            raise ValueError("All chains must have the same state size")
+        builder = _ChainBuilder(state_size)
+        for chain in chains:
+            for state_tokens, follow, count in chain.iter_counts():
+                builder.add_count(state_tokens, follow, count)
+        return builder.build()
+
+    @property
+    def state_count(self):
+        return len(self.offsets) - 1
+
+    @property
+    def transition_count(self):
+        return len(self.next_tokens)
+
+    @property
+    def token_ids(self):
+        """トークン -> ID（初回のみ作成）"""
+        if self._token_ids is None:
+            self._token_ids = {token: i for i, token in enumerate(self.vocab) if i > END_ID}
+        return self._token_ids
+
+    def iter_counts(self):
+        """(状態のトークン列, 遷移先, 回数)を順に返す（BEGIN/ENDはNone）"""
+        vocab = self.vocab
+        size = self.state_size
+
+        def decode(token_id):
+            return None if token_id <= END_ID else vocab[token_id]
+
+        for state in range(self.state_count):
+            state_tokens = [decode(t) for t in self.state_tokens[state * size:(state + 1) * size]]
+            previous = 0
+            for i in range(self.offsets[state], self.offsets[state + 1]):
+                yield state_tokens, decode(self.next_tokens[i]), self.cum_weights[i] - previous
+                previous = self.cum_weights[i]
+
+    def choose(self, state, rng=random):
+        """状態から遷移を1つ選び、その遷移の位置を返す"""
+        start = self.offsets[state]
+        end = self.offsets[state + 1]
+        r = int(rng.random() * self.cum_weights[end - 1])
+        return bisect_right(self.cum_weights, r, start, end)
+
+    def walk(self, rng=random):
+        """開始状態からENDまで遷移し、トークンのリストを返す"""
+        vocab = self.vocab
+        next_tokens = self.next_tokens
+        next_states = self.next_states
+        choose = self.choose
+        words = []
+        state = 0
+        while True:
+            i = choose(state, rng)
+            token = next_tokens[i]
+            if token == END_ID:
+                return words
+            words.append(vocab[token])
+            state = next_states[i]
+
+    def make_sentence(self, tries=10, max_words=None, min_words=None, **kwargs):
+        """markovify.Text.make_sentenceと同じ条件で文を生成（空白区切り、失敗時はNone）"""
+        for _ in range(tries):
+            words = self.walk()
+            if (max_words is not None and len(words) > max_words) or (
+                    min_words is not None and len(words) < min_words):
+                continue
+            return ' '.join(words)
+        return None
+
+    def token_mask(self, predicate):
+        """predicateが真になるトークンを1としたマスク（BEGIN/ENDは常に0）"""
+        mask = bytearray(len(self.vocab))
+        for token_id in range(END_ID + 1, len(self.vocab)):
+            if predicate(self.vocab[token_id]):
+                mask[token_id] = 1
+        return mask
+
+    def constrained_walk(self, banned=None, automaton=None, min_words=0, max_words=None, min_chars=0,
+                         max_steps=1000, rng=random):
+        """禁止トークンと禁止語を避けながら遷移し、条件を満たすトークンのリストを返す
+
+        banned: token_maskで作ったマスク（1のトークンには遷移しない）
+        automaton: 連結した文字列に現れてはいけない語のAhoCorasick（文字ごとに状態を進める）
+        ENDへの遷移はmin_words語・min_chars文字に達するまで選ばない。行き止まりでは1つ前に戻って別の
+        遷移を選び、max_steps回の選択で見つからなければNoneを返す
+        """
+        vocab = self.vocab
+        offsets = self.offsets
+        next_tokens = self.next_tokens
+        next_states = self.next_states
+        cum_weights = self.cum_weights
+
+        words = []
+        # 各位置の[連鎖の状態, オートマトンの状態, 文字数, 除外した遷移, 選んだ遷移]
+        stack = [[0, 0, 0, set(), None]]
+        steps = 0
+        while stack and steps < max_steps:
+            steps += 1
+            frame = stack[-1]
+            state, ac_state, chars, excluded, _ = frame
+            can_end = len(words) >= min_words and chars >= min_chars
+            can_continue = max_words is None or len(words) < max_words
+
+            def check(i):
+                """遷移iが使えるなら遷移後のオートマトンの状態を返す（使えなければNone）"""
+                token = next_tokens[i]
+                if token == END_ID:
+                    return ac_state if can_end else None
+                if not can_continue or (banned is not None and banned[token]):
+                    return None
+                if automaton is None:
+                    return ac_state
+                next_ac = ac_state
+                for char in vocab[token]:
+                    next_ac = automaton.step(next_ac, char)
+                    if automaton.match_at(next_ac) is not None:
+                        return None
+                return next_ac
+
+            start = offsets[state]
+            end = offsets[state + 1]
+            chosen = None
+            # まずは通常どおり重みで選び、使えない遷移だった場合だけ候補を絞り込む
+            for _ in range(3):
+                i = bisect_right(cum_weights, int(rng.random() * cum_weights[end - 1]), start, end)
+                if i in excluded:
+                    continue
+                next_ac = check(i)
+                if next_ac is None:
+                    excluded.add(i)
+                    continue
+                chosen = i
+                break
+            if chosen is None:
+                candidates = []
+                weights = []
+                for i in range(start, end):
+                    if i in excluded:
+                        continue
+                    next_ac = check(i)
+                    if next_ac is None:
+                        excluded.add(i)
+                        continue
+                    candidates.append((i, next_ac))
+                    weights.append(cum_weights[i] - (cum_weights[i - 1] if i > start else 0))
+                if candidates:
+                    chosen, next_ac = rng.choices(candidates, weights)[0]
+
+            if chosen is None:
+                # 行き止まり：この位置を捨て、1つ前の位置で選んだ遷移を除外して選び直す
+                stack.pop()
+                if stack:
+                    words.pop()
+                    parent = stack[-1]
+                    parent[3].add(parent[4])
+                continue
+
+            token = next_tokens[chosen]
+            if token == END_ID:
+                return words
+            frame[4] = chosen
+            words.append(vocab[token])
+            stack.append([next_states[chosen], next_ac, chars + len(vocab[token]), set(), None])
+        return None
+
+    def _arrays(self):
+        return (self.state_tokens, self.offsets, self.next_tokens, self.cum_weights, self.next_states)
+
+    @property
+    def nbytes(self):
+        """配列と語彙が占めるおおよそのバイト数"""
+        return (sum(a.itemsize * len(a) for a in self._arrays()) +
+                sys.getsizeof(self.vocab) + sum(sys.getsizeof(token) for token in self.vocab))
+
+    def to_bytes(self, meta=None):
+        """ヘッダ・語彙・各配列を連結した1つのバイト列に変換（リトルエンディアン）"""
+        meta_bytes = json.dumps(meta or {}, ensure_ascii=False).encode('utf-8')
+        vocab_bytes = '\0'.join(self.vocab).encode('utf-8')
+        parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, self.state_size, len(meta_bytes)), meta_bytes]
+        parts.append(_COUNTS.pack(len(vocab_bytes), self.state_count, self.transition_count))
+        parts.append(vocab_bytes)
+        length = sum(len(part) for part in parts)
+        for values in self._arrays():
+            # 配列は8バイト境界から始める
+            parts.append(b'\0' * _pad(length))
+            length += _pad(length)
+            if sys.byteorder != 'little':
+                values = array(values.typecode, values)
+                values.byteswap()
+            data = values.tobytes()
+            parts.append(data)
+            length += len(data)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data, copy=True):
+        """to_bytesで作ったバイト列から復元し、(連鎖, メタ情報)を返す
+
+        copy=Falseの場合、dataはmemoryviewで渡し、配列はコピーせずにその範囲を参照する
+        """
+        magic, version, state_size, meta_length = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Unsupported compact chain format")
+        offset = _HEADER.size
+        meta = json.loads(bytes(data[offset:offset + meta_length]).decode('utf-8'))
+        offset += meta_length
+        vocab_length, state_count, transition_count = _COUNTS.unpack_from(data, offset)
+        offset += _COUNTS.size
+        vocab = bytes(data[offset:offset + vocab_length]).decode('utf-8').split('\0')
+        offset += vocab_length
+
+        lengths = (state_count * state_size, state_count + 1, transition_count, transition_count, transition_count)
+        arrays = []
+        for typecode, length in zip(_ARRAY_TYPECODES, lengths):
+            offset += _pad(offset)
+            values = array(typecode)
+            size = values.itemsize * length
+            if offset + size > len(data):
+                raise ValueError("Truncated compact chain data")
+            if copy:
+                values.frombytes(data[offset:offset + size])
+                if sys.byteorder != 'little':
+                    values.byteswap()
+            else:
+                values = data[offset:offset + size].cast(typecode)
+            arrays.append(values)
+            offset += size
+        return cls(state_size, vocab, *arrays), meta
+
+    def save(self, path, meta=None):
+        """一時ファイルに書き出してから置き換える
+
+        読み込み中のプロセスは置き換え前のファイルをmmapしたまま使い続けられるよう、既存のファイルは書き換えない
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self.to_bytes(meta))
+                f.flush()
+                # 他のコンテナから読まれる前に内容をディスクに書き出す
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def open(cls, path):
+        """ファイルを読み取り専用でmmapし、配列をコピーせずに参照する
+
+        同じファイルを開いたワーカー・コンテナは物理メモリ上の1つのコピーを共有する。
+        語彙の文字列だけは各プロセスで復元する
+        """
+        if sys.byteorder != 'little':
+            return cls.load(path)
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        chain, meta = cls.from_bytes(memoryview(mapped), copy=False)
+        chain.mapped = True
+        return chain, meta
+
+    def stats(self):
+        return {
+            'state_size': self.state_size,
+            'vocab': len(self.vocab) - 2,
+            'states': self.state_count,
+            'transitions': self.transition_count,
+            'bytes': self.nbytes,
+            'mapped': self.mapped
+        }
+
+
+def _benchmark(lines=20000, vocab_size=5000, state_size=2, samples=2000):
+    """同じコーパスでmarkovifyとCompactChainの構築時間・メモリ・生成速度を比較する"""
+    import tracemalloc
+    import markovify
+    from markov_model import iter_runs
+
+    rng = random.Random(42)
+    kana = [chr(c) for c in range(0x3042, 0x3094)]
+    vocab = [''.join(rng.choice(kana) for _ in range(rng.randint(1, 4))) for _ in range(vocab_size)]
+    # 出現頻度に偏りのある単語で文を作る
+    weights = [1 / (rank + 1) for rank in range(vocab_size)]
+    corpus = [' '.join(rng.choices(vocab, weights, k=rng.randint(5, 30))) + ' 。' for _ in range(lines)]
+
+    def measure(build):
+        # 構築時間はトレースの影響を受けないよう、メモリ計測とは別に測る
+        start = time.perf_counter()
+        build()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        model = build()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for _ in range(samples):
+            model.make_sentence(tries=100, max_words=50, min_words=5)
+        rate = samples / (time.perf_counter() - start)
+        return elapsed, current, peak, rate
+
+    results = {
+        'markovify': measure(lambda: markovify.NewlineText('\n'.join(corpus), state_size=state_size,
+                                                           retain_original=False)),
+        'compact': measure(lambda: CompactChain.build(iter_runs(corpus), state_size))
+    }
+    print(f"lines={lines} vocab={vocab_size} state_size={state_size}")
+    for name, (elapsed, current, peak, rate) in results.items():
+        print(f"{name:10s} build={elapsed * 1000:8.1f}ms model={current / 1024 / 1024:7.1f}MB "
+              f"peak={peak / 1024 / 1024:7.1f}MB sentences/s={rate:9.1f}")
+
+
+if __name__ == '__main__':
+    for size in SUPPORTED_STATE_SIZES:
+        _benchmark(state_size=size)
@@ -0,0 +1,261 @@
+import os
+import sys
+import math
+import time
+import random
+import threading
+
+# 学習・集計用のノートの読み出し（eligibleは003_corpus_indexes.sqlで追加した生成列）
+TEXTS_AFTER_SQL = """
+    SELECT gtl_id, post_text, timestamp, tokens, pos
+    FROM public.glt_observation
+    WHERE eligible
+    AND gtl_id > %s
+    ORDER BY gtl_id
+    LIMIT %s
+"""
+
+OBSERVATIONS_AFTER_SQL = """
+    SELECT gtl_id, post_text, EXTRACT(EPOCH FROM CAST(timestamp AS timestamp)), tokens, pos
+    FROM public.glt_observation
+    WHERE eligible
+    AND gtl_id > %s
+    AND timestamp >= NOW() - %s * INTERVAL '1 second'
+    ORDER BY gtl_id
+    LIMIT %s
+"""
+
+CORPUS_BOUNDS_SQL = """
+    SELECT
+        (SELECT min(gtl_id) FROM public.glt_observation WHERE eligible),
+        (SELECT max(gtl_id) FROM public.glt_observation WHERE eligible),
+        (SELECT min(gtl_id) FROM public.glt_observation
+         WHERE eligible AND timestamp >= NOW() - %s * INTERVAL '1 hour')
+"""
+
+# 起点ごとにインデックスをgtl_id順にrun_length件だけ読む
+PIVOT_SAMPLE_SQL = """
+    SELECT o.gtl_id, o.post_text, o.tokens, o.pos
+    FROM unnest(%s::bigint[]) AS p(pivot)
+    CROSS JOIN LATERAL (
+        SELECT gtl_id, post_text, tokens, pos
+        FROM public.glt_observation
+        WHERE eligible
+        AND gtl_id >= p.pivot
+        ORDER BY gtl_id
+        LIMIT %s
+    ) o
+"""
+
+
+# 実行計画の確認に使うクエリと代表的なパラメータ
+PLAN_CHECKS = {
+    'texts_after': (TEXTS_AFTER_SQL, (0, 1000)),
+    'observations_after': (OBSERVATIONS_AFTER_SQL, (0, 4 * 3600, 1000)),
+    'corpus_bounds': (CORPUS_BOUNDS_SQL, (24,)),
+    'pivot_sample': (PIVOT_SAMPLE_SQL, ([1, 1000, 100000], 20))
+}
+
+
+# 003_corpus_indexes.sqlで作成した、eligibleな行だけを含む部分インデックス
+ELIGIBLE_INDEXES = ('glt_observation_eligible_gtl_id_idx', 'glt_observation_eligible_timestamp_idx')
+
+
+def _scan_indexes(plan, relation='glt_observation'):
+    """EXPLAIN (FORMAT JSON)の実行計画から、指定したテーブルを読むノードごとに使うインデックス名を返す（全件走査はNone）"""
+    found = []
+    node_type = plan.get('Node Type')
+    if plan.get('Relation Name') == relation:
+        if node_type == 'Seq Scan':
+            found.append(None)
+        elif node_type in ('Index Scan', 'Index Only Scan'):
+            found.append(plan.get('Index Name'))
+        elif node_type == 'Bitmap Heap Scan':
+            # ビットマップ走査ではインデックス名は子のBitmap Index Scanにある
+            return found + _bitmap_indexes(plan)
+    for child in plan.get('Plans', []):
+        found.extend(_scan_indexes(child, relation))
+    return found
+
+
+def _bitmap_indexes(plan):
+    found = []
+    for child in plan.get('Plans', []):
+        if child.get('Node Type') == 'Bitmap Index Scan':
+            found.append(child.get('Index Name'))
+        else:
+            found.extend(_bitmap_indexes(child))
+    return found
+
+
+def query_plan_indexes(conn):
+    """PLAN_CHECKSの各クエリについて、glt_observationを読むときに使うインデックス名のリストを返す
+    （実行計画を取得できなかったクエリは例外のメッセージを返す）"""
+    indexes = {}
+    for name, (sql, params) in PLAN_CHECKS.items():
+        try:
+            with conn.cursor() as cur:
+                # 小さなテーブルでは全件走査の方が安く見積もられるため、インデックスで実行できるかを確認する
+                cur.execute("SET LOCAL enable_seqscan = off")
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                indexes[name] = _scan_indexes(cur.fetchone()[0][0]['Plan'])
+        except Exception as e:
+            indexes[name] = str(e)
+        finally:
+            # SET LOCALを元に戻し、失敗したクエリのトランザクションも終わらせる
+            conn.rollback()
+    return indexes
+
+
+def check_query_plans(conn):
+    """コーパス用のクエリがeligibleの部分インデックスでglt_observationを読むか実行計画で確認し、問題のあるクエリ名を返す
+    （enable_seqscan=offでは主キーのインデックスでも実行できてしまうため、インデックス名まで確かめる）"""
+    problems = {}
+    for name, indexes in query_plan_indexes(conn).items():
+        if isinstance(indexes, str):
+            problems[name] = indexes
+        elif None in indexes:
+            problems[name] = 'Seq Scan on glt_observation'
+        elif not indexes or any(index not in ELIGIBLE_INDEXES for index in indexes):
+            problems[name] = f'glt_observation is not read through the eligible indexes: {indexes}'
+    return problems
+
+
+class CorpusSampler:
+    """学習用テキストを全期間からインデックス経由でランダムに抽出する"""
+
+    # 投稿ペース（gtl_idの増え方）を推定する時間窓
+    RATE_WINDOW_HOURS = 24
+
+    def __init__(self, processor, sample_size=None, half_life_hours=None, run_length=None):
+        self.processor = processor
+        self.sample_size = int(sample_size or os.getenv('CORPUS_SAMPLE_SIZE', '1000'))
+        # 選ばれやすさが半分になるまでの時間（0で全期間から一様に抽出）
+        if half_life_hours is None:
+            half_life_hours = os.getenv('CORPUS_SAMPLE_HALF_LIFE_HOURS', '168')
+        self.half_life_hours = float(half_life_hours)
+        # 1つの起点からgtl_id順に続けて読む件数
+        self.run_length = int(run_length or os.getenv('CORPUS_SAMPLE_RUN_LENGTH', '10'))
+        # gtl_idの範囲を取得し直す間隔（秒）
+        self.bounds_ttl = float(os.getenv('CORPUS_SAMPLE_BOUNDS_TTL', '300'))
+
+        self._bounds = None
+        self._bounds_loaded_at = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'samples': 0,
+            'rows': 0,
+            'duplicates': 0
+        }
+        self.last_duration = None
+
+    def bounds(self):
+        """学習対象のgtl_idの(最小, 最大, 直近RATE_WINDOW_HOURS時間の最初)を返す（bounds_ttl秒キャッシュ）"""
+        with self._lock:
+            if self._bounds is None or time.monotonic() - self._bounds_loaded_at > self.bounds_ttl:
+                bounds = self.processor.get_corpus_bounds(self.RATE_WINDOW_HOURS)
+                if bounds is not None:
+                    self._bounds = bounds
+                    self._bounds_loaded_at = time.monotonic()
+            return self._bounds
+
+    def _half_life_ids(self, max_id, recent_min_id):
+        """半減期（時間）を直近の投稿ペースからgtl_idの幅に換算"""
+        if self.half_life_hours <= 0 or recent_min_id is None:
+            return None
+        ids_per_hour = (max_id - recent_min_id + 1) / self.RATE_WINDOW_HOURS
+        return max(ids_per_hour * self.half_life_hours, 1.0)
+
+    @staticmethod
+    def draw_pivot(min_id, max_id, half_life=None, rng=random):
+        """起点のgtl_idを1つ選ぶ（half_lifeを指定すると新しいほど選ばれやすい）"""
+        span = max_id - min_id + 1
+        u = rng.random()
+        if half_life is None:
+            offset = u * span
+        else:
+            # 最新からの距離を[0, span)に切り詰めた指数分布から引く
+            offset = -half_life * math.log2(1 - u * (1 - 2 ** (-span / half_life)))
+        return max(max_id - int(offset), min_id)
+
+    def sample(self, size=None):
+        """学習対象のノートを最大size件ランダムに取得し、(gtl_id, テキスト, 保存済みの解析結果)を返す"""
+        size = size or self.sample_size
+        started = time.perf_counter()
+        bounds = self.bounds()
+        if bounds is None:
+            return []
+        min_id, max_id, recent_min_id = bounds
+        half_life = self._half_life_ids(max_id, recent_min_id)
+
+        # 起点の近くで読みが重なる分を見込んで多めに起点を選ぶ
+        runs = math.ceil(size / self.run_length * 1.5)
+        pivots = sorted({self.draw_pivot(min_id, max_id, half_life) for _ in range(runs)})
+        rows = self.processor.get_texts_from_pivots(pivots, self.run_length)
+        if not rows:
+            return []
+
+        unique = {}
+        for row in rows:
+            unique.setdefault(row[0], row)
+        sampled = list(unique.values())
+        random.shuffle(sampled)
+        sampled = sampled[:size]
+
+        self._stats['samples'] += 1
+        self._stats['rows'] += len(sampled)
+        self._stats['duplicates'] += len(rows) - len(unique)
+        self.last_duration = time.perf_counter() - started
+        return sampled
+
+    def sample_texts(self, size=None):
+        return [row[1] for row in self.sample(size)]
+
+    def check_query_plans(self):
+        """check_query_plans()をプールの接続で実行し、問題があればWARNINGを記録する"""
+        log_manager = self.processor.log_manager
+        try:
+            with self.processor.pool.connection() as conn:
+                problems = check_query_plans(conn)
+        except Exception as e:
+            log_manager.write_log("ERROR", "CorpusSampler", f"Error checking query plans: {str(e)}")
+            return {'connection': str(e)}
+
+        if problems:
+            log_manager.write_log("WARNING", "CorpusSampler", "Corpus queries fall back to sequential scans",
+                                  metadata={'queries': problems})
+        return problems
+
+    def stats(self):
+        bounds = self._bounds
+        return {
+            'sample_size': self.sample_size,
+            'half_life_hours': self.half_life_hours,
+            'run_length': self.run_length,
+            'min_id': bounds[0] if bounds else None,
+            'max_id': bounds[1] if bounds else None,
+            'last_duration': self.last_duration,
+            **self._stats
+        }
+
+
+if __name__ == '__main__':
+    # マイグレーション後のDBでコーパス用クエリの実行計画を確認する（全件走査があれば終了コード1）
+    # アプリケーションは起動せず、環境変数の接続先に直接つなぐ
+    from dotenv import load_dotenv
+    from db_pool import connect
+    load_dotenv()
+    conn = connect({
+        'dbname': os.getenv('POSTGRES_DB'),
+        'user': os.getenv('POSTGRES_USER'),
+        'password': os.getenv('POSTGRES_PASSWORD'),
+        'host': os.getenv('POSTGRES_HOST'),
+        'port': os.getenv('POSTGRES_PORT')
+    })
+    try:
+        problems = check_query_plans(conn)
+    finally:
+        conn.close()
+    for name, problem in problems.items():
+        print(f"{name}: {problem}")
+    sys.exit(1 if problems else 0)
@@ -1,32 +1,372 @@
 import os
+import re
+import sys
 import json
-import psycopg2
+import time
+import random
+import atexit
+import threading
+from collections import deque
+from psycopg2.extras import execute_values
+from db_pool import get_pool
+from metrics import LOG_WRITE_SECONDS, LOG_SUPPRESSED
 from dotenv import load_dotenv
 from datetime import datetime
 
+# キューが溢れたときに捨てる順番（ERROR以上は捨てない）
+DROPPABLE_LEVELS = ['DEBUG', 'INFO', 'WARNING']
+# ソースごとのサンプリングと、既定のレート制限の対象になるレベル
+SAMPLED_LEVELS = ['DEBUG', 'INFO']
+# 日ごとのパーティションを作成するロックキー（migrations.MIGRATION_LOCK_KEYと重ならない値）
+PARTITION_LOCK_KEY = 0x61666d02
+# 件数や経過時間だけが違うメッセージを同じものとしてまとめるため、数字を置き換える
+_DIGITS = re.compile(r'\d+')
+
+
+def _parse_source_rates(value):
+    """'TextProcessor:0.1,RollingNounIndex:0.5' の形式の設定をdictにする"""
+    rates = {}
+    for item in (value or '').split(','):
+        source, sep, rate = item.strip().rpartition(':')
+        if not sep or not source:
+            continue
+        try:
+            rates[source] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+class TokenBucket:
+    """1秒あたりrate件、最大burst件まで通すトークンバケット"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
 class LogManager:
-    def __init__(self, db_params):
+    def __init__(self, db_params, async_mode=None):
         self.db_params = db_params
+        self.pool = get_pool(db_params)
+
+        # 非同期モード：キューに積んでバックグラウンドでまとめて書き込む
+        if async_mode is None:
+            async_mode = os.getenv('LOG_ASYNC', '1') == '1'
+        self.async_mode = async_mode
+        self.queue_size = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+        self.batch_size = int(os.getenv('LOG_BATCH_SIZE', '200'))
+        self.flush_interval = float(os.getenv('LOG_FLUSH_INTERVAL', '2'))
+        # drop_oldest: キュー内の古い低優先度ログを捨てる / drop_newest: 新しく来た低優先度ログを捨てる
+        self.overflow_policy = os.getenv('LOG_OVERFLOW_POLICY', 'drop_oldest')
+
+        # DEBUG/INFOをソースごとに指定した割合だけ残す（1.0ならすべて残す）
+        self.sample_rates = _parse_source_rates(os.getenv('LOG_SAMPLE_RATES', ''))
+        # (ソース, レベル)ごとのレート制限。0以下なら無効
+        self.rate_limit = float(os.getenv('LOG_RATE_LIMIT', '5'))
+        # レート制限するレベル（既定ではWARNINGは制限しない。ERRORは指定しても制限しない）
+        self.rate_limit_levels = [
+            level.strip() for level in os.getenv('LOG_RATE_LIMIT_LEVELS', ','.join(SAMPLED_LEVELS)).split(',')
+            if level.strip() in DROPPABLE_LEVELS
+        ]
+        self.rate_burst = float(os.getenv('LOG_RATE_BURST', '50'))
+        self.rate_limits = _parse_source_rates(os.getenv('LOG_RATE_LIMITS', ''))
+        # レート制限で抑えたログは同じメッセージごとに件数をまとめ、この間隔で1行ずつ書き込む
+        self.aggregate_interval = float(os.getenv('LOG_AGGREGATE_INTERVAL', '60'))
+        self.aggregate_max_keys = int(os.getenv('LOG_AGGREGATE_MAX_KEYS', '1000'))
+        # logsが日ごとのパーティションに分かれている場合に、何日先まで作成しておくか
+        self.partition_days_ahead = int(os.getenv('LOG_PARTITION_DAYS_AHEAD', '3'))
+        self.partition_check_interval = float(os.getenv('LOG_PARTITION_CHECK_INTERVAL', '3600'))
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._limit_lock = threading.Lock()
+        self._buckets = {}
+        # (レベル, ソース, 数字を除いたメッセージ) -> [件数, 最初の時刻, 最後の時刻, 最初のメッセージ, 最初のmetadata]
+        self._suppressed = {}
+        self._next_aggregate = time.monotonic() + self.aggregate_interval
+        # 起動直後に一度パーティションを確認する
+        self._next_partition_check = 0.0
+        self._stats = {
+            'written': 0,
+            'batches': 0,
+            'failures': 0,
+            'dropped': {level: 0 for level in DROPPABLE_LEVELS},
+            'spilled': 0,
+            'sampled_out': 0,
+            'rate_limited': 0,
+            'aggregated_rows': 0,
+            'partitions_created': 0
+        }
+
+        if self.async_mode:
+            self.start()
+            atexit.register(self.close)
 
     def write_log(self, level, source, message, metadata=None):
+        if level in SAMPLED_LEVELS:
+            rate = self.sample_rates.get(source, 1.0)
+            if rate < 1.0:
+                if random.random() >= rate:
+                    with self._limit_lock:
+                        self._stats['sampled_out'] += 1
+                    LOG_SUPPRESSED.inc(source=source, reason='sampled')
+                    return True
+                # 残した行から元の件数を推定できるように割合を記録しておく
+                metadata = dict(metadata or {}, sample_rate=rate)
+
+        if level in self.rate_limit_levels and not self._allow(level, source, message, metadata):
+            return True
+
+        record = (
+            level,
+            source,
+            message,
+            json.dumps(metadata) if metadata else None,
+            datetime.now()
+        )
+        if self.async_mode and not self._closed:
+            return self._enqueue(record)
+        records = self._due_aggregates() + [record]
+        self._maintain_partitions()
+        return self._write_records(records)
+
+    def _allow(self, level, source, message, metadata):
+        """レート制限内ならTrue。超えた分は数字以外が同じメッセージごとに件数をまとめておく"""
+        rate = self.rate_limits.get(source, self.rate_limit)
+        if rate <= 0:
+            return True
+        with self._limit_lock:
+            bucket = self._buckets.get((source, level))
+            if bucket is None:
+                bucket = TokenBucket(rate, max(self.rate_burst, 1))
+                self._buckets[(source, level)] = bucket
+            if bucket.take():
+                return True
+            self._stats['rate_limited'] += 1
+            key = (level, source, _DIGITS.sub('#', message))
+            entry = self._suppressed.get(key)
+            now = datetime.now()
+            if entry is not None:
+                entry[0] += 1
+                entry[2] = now
+            elif len(self._suppressed) < self.aggregate_max_keys:
+                self._suppressed[key] = [1, now, now, message, metadata]
+            else:
+                # まとめる種類が多すぎる場合は件数だけ数えて捨てる
+                self._stats['dropped'][level] += 1
+        LOG_SUPPRESSED.inc(source=source, reason='rate_limited')
+        return False
+
+    def _due_aggregates(self, force=False):
+        """まとめる間隔が経過していれば、抑えたログを1メッセージ1行にして返す"""
+        if not force and time.monotonic() < self._next_aggregate:
+            return []
+        with self._limit_lock:
+            self._next_aggregate = time.monotonic() + self.aggregate_interval
+            suppressed, self._suppressed = self._suppressed, {}
+            self._stats['aggregated_rows'] += len(suppressed)
+        records = []
+        for (level, source, _), (count, first_at, last_at, message, metadata) in suppressed.items():
+            metadata = dict(metadata or {}, suppressed=count,
+                            first_at=first_at.isoformat(), last_at=last_at.isoformat())
+            records.append((level, source, message, json.dumps(metadata), last_at))
+        return records
+
+    def _maintain_partitions(self):
+        """logsがパーティション化されていれば、今日から数日先までのパーティションを作成しておく"""
+        if time.monotonic() < self._next_partition_check:
+            return
+        self._next_partition_check = time.monotonic() + self.partition_check_interval
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
+                    cur.execute("SELECT to_regprocedure('public.logs_create_partition(date)') IS NOT NULL")
+                    if not cur.fetchone()[0]:
+                        return
+                    # 複数のワーカーが同時に作成しようとしないよう、取れなかった場合は他に任せる
+                    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+                    if not cur.fetchone()[0]:
+                        return
                     cur.execute(
+                        "SELECT public.logs_create_partition(CURRENT_DATE + day) FROM generate_series(0, %s) AS day",
+                        (self.partition_days_ahead,)
+                    )
+                    created = sum(1 for (was_created,) in cur.fetchall() if was_created)
+                    conn.commit()
+            self._stats['partitions_created'] += created
+        except Exception as e:
+            print(f"Error creating log partitions: {str(e)}")
+
+    def _write_records(self, records):
+        start = time.perf_counter()
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    execute_values(
+                        cur,
                         """
                         INSERT INTO logs (level, source, message, metadata, created_at)
-                        VALUES (%s, %s, %s, %s, %s)
+                        VALUES %s
                         """,
-                        (
-                            level,
-                            source,
-                            message,
-                            json.dumps(metadata) if metadata else None,
-                            datetime.now()
-                        )
+                        records,
+                        page_size=max(len(records), 1)
                     )
                     conn.commit()
             return True
         except Exception as e:
             print(f"Error writing to log: {str(e)}")
             return False
+        finally:
+            LOG_WRITE_SECONDS.observe(time.perf_counter() - start)
+
+    def _enqueue(self, record):
+        with self._cond:
+            if len(self._queue) >= self.queue_size and not self._make_room(record[0]):
+                return False
+            self._queue.append(record)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def _make_room(self, level):
+        """溢れたときに捨てるログを選ぶ。新しいログを受け入れられる場合はTrue"""
+        if self.overflow_policy == 'drop_newest' and level in DROPPABLE_LEVELS:
+            self._stats['dropped'][level] += 1
+            return False
+        if self._drop_one(level):
+            return True
+        if level in DROPPABLE_LEVELS:
+            self._stats['dropped'][level] += 1
+            return False
+        # キューがERRORで埋まっている場合も上限は超えず、最も古いものを標準エラー出力に退避する
+        self._spill(self._queue.popleft())
+        return True
+
+    def _drop_one(self, level=None):
+        """levelと同じか低い優先度のログをoverflow_policyに従って1件捨てる。捨てられればTrue"""
+        newest = self.overflow_policy == 'drop_newest'
+        for drop_level in DROPPABLE_LEVELS:
+            if level in DROPPABLE_LEVELS and DROPPABLE_LEVELS.index(drop_level) > DROPPABLE_LEVELS.index(level):
+                break
+            queued_levels = [queued[0] for queued in self._queue]
+            indexes = range(len(queued_levels) - 1, -1, -1) if newest else range(len(queued_levels))
+            for i in indexes:
+                if queued_levels[i] == drop_level:
+                    del self._queue[i]
+                    self._stats['dropped'][drop_level] += 1
+                    return True
+        return False
+
+    def _trim(self):
+        """書き込みに失敗して戻したログでqueue_sizeを超えた分を、溢れたときと同じ順番で減らす"""
+        while len(self._queue) > self.queue_size:
+            if not self._drop_one():
+                self._spill(self._queue.popleft())
+
+    def _spill(self, record):
+        """DBに書き込めないまま捨てるERRORを標準エラー出力に残す"""
+        level, source, message, metadata, created_at = record
+        print(f"[{created_at.isoformat()}] {level} {source}: {message} {metadata or ''}", file=sys.stderr)
+        self._stats['spilled'] += 1
+
+    def start(self):
+        """バックグラウンドの書き込みスレッドを開始"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='log-flusher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size and not self._closed:
+                    self._cond.wait(self.flush_interval)
+                if self._closed and not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+            self._maintain_partitions()
+            batch.extend(self._due_aggregates())
+            if batch and not self._flush_batch(batch):
+                with self._cond:
+                    # 書き込みに失敗した分はキューの先頭に戻し、次の周期で再試行する
+                    self._queue.extendleft(reversed(batch))
+                    self._trim()
+                    if self._closed:
+                        return
+                    self._cond.wait(self.flush_interval)
+
+    def _flush_batch(self, batch):
+        if self._write_records(batch):
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+            return True
+        self._stats['failures'] += 1
+        return False
+
+    def flush(self):
+        """キューに残っているログとまとめ途中のログを同期的に書き込む"""
+        aggregated = self._due_aggregates(force=True)
+        if aggregated and not self._flush_batch(aggregated):
+            return False
+        while True:
+            with self._cond:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            if not batch:
+                return True
+            if not self._flush_batch(batch):
+                return False
+
+    def close(self):
+        """書き込みスレッドを止め、残りのログを書き込んでから終了する"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval + 10)
+        self.flush()
+
+    def after_fork(self):
+        """fork後の子プロセスで呼び、書き込みスレッドを起動し直す（親のキューは親が書き込む）"""
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._limit_lock = threading.Lock()
+        self._buckets = {}
+        self._suppressed = {}
+        self._thread = None
+        self._closed = False
+        if self.async_mode:
+            self.start()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'async': self.async_mode,
+                'queued': len(self._queue),
+                'queue_size': self.queue_size,
+                'written': self._stats['written'],
+                'batches': self._stats['batches'],
+                'failures': self._stats['failures'],
+                'dropped': dict(self._stats['dropped']),
+                'spilled': self._stats['spilled'],
+                'sampled_out': self._stats['sampled_out'],
+                'rate_limited': self._stats['rate_limited'],
+                'aggregating': len(self._suppressed),
+                'aggregated_rows': self._stats['aggregated_rows'],
+                'partitions_created': self._stats['partitions_created']
+            }
@@ -0,0 +1,235 @@
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    """プールが枯渇し、タイムアウトまでに接続を取得できなかった"""
+
+
+class ConnectionPool:
+    """プロセス全体で共有するPostgreSQL接続プール"""
+
+    def __init__(self, db_params, min_size=None, max_size=None, timeout=None, healthcheck_after=None):
+        self.db_params = db_params
+        self.min_size = min_size if min_size is not None else int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+        self.max_size = max_size if max_size is not None else int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+        # 接続取得の待ち時間の上限（秒）
+        self.timeout = timeout if timeout is not None else float(os.getenv('DB_POOL_TIMEOUT', '10'))
+        # この秒数以上使われていない接続は貸し出し前に疎通確認する
+        self.healthcheck_after = healthcheck_after if healthcheck_after is not None else float(os.getenv('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        # fork前の親プロセスから引き継いだ接続（閉じると親の接続が切れるため保持するだけ）
+        self._inherited = []
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'stale': 0,
+            'waits': 0,
+            'timeouts': 0
+        }
+
+        try:
+            self._fill_min()
+        except Exception as e:
+            print(f"Error initializing connection pool: {str(e)}")
+
+    def _fill_min(self):
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _connect(self):
+        conn = connect(self.db_params)
+        self._stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """接続を取得する。枯渇時はtimeout秒まで返却を待つ"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError(f"Timed out waiting for a database connection ({timeout}s)")
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn = None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn, time.monotonic() - last_used):
+                self._stats['reused'] += 1
+                return conn
+
+            # 切断されていた接続は破棄して取り直す
+            self._stats['stale'] += 1
+            self._discard(conn)
+
+    def _discard(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def putconn(self, conn, discard=False):
+        """接続をプールに返却する"""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """正常終了時はcommit、それ以外（例外・途中終了）はrollbackしてから接続を返却する"""
+        conn = self.getconn(timeout)
+        committed = False
+        try:
+            yield conn
+            conn.commit()
+            committed = True
+        finally:
+            # 例外だけでなく、接続を使っているジェネレータが途中で閉じられた場合（GeneratorExit）も必ず返却する
+            if not committed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            self.putconn(conn, discard=conn.closed != 0)
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def after_fork(self):
+        """fork後の子プロセスで呼び、親の接続を使わずに新しく接続し直すようにする"""
+        self._inherited.extend(conn for conn, _ in self._idle)
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                **self._stats
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+# 接続を作成する関数（ベンチマークなどで実際のDBの代わりを使う場合に差し替える）
+_connection_factory = psycopg2.connect
+
+
+def set_connection_factory(factory):
+    """以後の接続の作成に使う関数を差し替え、作成済みのプールを破棄する（Noneで元に戻す）"""
+    global _connection_factory
+    _connection_factory = factory or psycopg2.connect
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
+
+
+def connect(db_params):
+    """プールを経由しない接続を作成する（LISTEN用など）"""
+    return _connection_factory(**db_params)
+
+
+def close_all_pools():
+    """fork前に親プロセスの空き接続を閉じ、子プロセスと接続を共有しないようにする"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.closeall()
+
+
+def reset_pools_after_fork():
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        pool.after_fork()
+
+
+def get_pool(db_params):
+    """接続先ごとにプロセスで1つのプールを返す"""
+    key = tuple(sorted((k, str(v)) for k, v in db_params.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_params)
+            _pools[key] = pool
+        return pool
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import threading
+
+# MinHashの置換に使う乗数・加数の乱数シード
+_SEED = 0x61666d
+# シングルを区切る文字（トークンには含まれない制御文字）
+_SHINGLE_SEPARATOR = '\x1f'
+
+
+def _stable_hash(shingle):
+    """シングルの64bitハッシュ（組み込みのhash()と違いPYTHONHASHSEEDに左右されず、プロセス間で同じ値になる）"""
+    digest = hashlib.blake2b(_SHINGLE_SEPARATOR.join(shingle).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class NearDuplicateIndex:
+    """トークンのシングルのMinHashとLSHで、既に見たノートとほぼ同じノートを検出する"""
+
+    def __init__(self, num_perm=None, bands=None, threshold=None, max_entries=None, shingle_size=None):
+        self.num_perm = int(num_perm or os.getenv('DEDUP_NUM_PERM', '64'))
+        self.bands = int(bands or os.getenv('DEDUP_BANDS', '8'))
+        if self.num_perm % self.bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.rows = self.num_perm // self.bands
+        # 推定Jaccard係数がこの値以上なら重複とみなす
+        self.threshold = float(threshold or os.getenv('DEDUP_THRESHOLD', '0.8'))
+        # 保持する署名の数（超えたら古いものから上書きする）
+        self.max_entries = int(max_entries or os.getenv('DEDUP_MAX_ENTRIES', '20000'))
+        self.shingle_size = int(shingle_size or os.getenv('DEDUP_SHINGLE_SIZE', '3'))
+
+        # numpyの読み込みは重いため（text_processorを読み込むだけで約0.1秒）、索引を作るときに読み込む
+        import numpy as np
+        rng = np.random.default_rng(_SEED)
+        # 奇数の乗数による multiply-shift ハッシュを置換の代わりに使う
+        self._a = rng.integers(1, 2 ** 63, size=(self.num_perm, 1), dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=(self.num_perm, 1), dtype=np.uint64)
+
+        # 署名のリングバッファと、バンドごとのバケット（バンドのハッシュ -> スロット）
+        self._signatures = np.zeros((self.max_entries, self.num_perm), dtype=np.uint32)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._next_slot = 0
+        self._filled = 0
+        self._lock = threading.Lock()
+        self.seen = 0
+        self.duplicates = 0
+
+    def _shingles(self, tokens):
+        size = self.shingle_size
+        if len(tokens) <= size:
+            return [tuple(tokens)]
+        return [tuple(tokens[i:i + size]) for i in range(len(tokens) - size + 1)]
+
+    def signature(self, tokens):
+        """トークン列のMinHash署名"""
+        import numpy as np
+        hashes = np.fromiter((_stable_hash(shingle) for shingle in self._shingles(tokens)), dtype=np.uint64)
+        return ((self._a * hashes + self._b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        # バンドの署名のバイト列をそのままバケットのキーにする
+        rows = self.rows
+        return [signature[i * rows:(i + 1) * rows].tobytes() for i in range(self.bands)]
+
+    def check_and_add(self, tokens):
+        """既に見たノートとほぼ同じならTrue。そうでなければ索引に追加してFalse"""
+        if not tokens:
+            return False
+        signature = self.signature(tokens)
+        keys = self._band_keys(signature)
+        with self._lock:
+            self.seen += 1
+            for band, key in enumerate(keys):
+                slot = self._buckets[band].get(key)
+                if slot is not None and (self._signatures[slot] == signature).mean() >= self.threshold:
+                    self.duplicates += 1
+                    return True
+            self._insert(signature, keys)
+            return False
+
+    def _insert(self, signature, keys):
+        slot = self._next_slot
+        if self._filled == self.max_entries:
+            # 上書きするスロットを指しているバケットを取り除く
+            for band, key in enumerate(self._band_keys(self._signatures[slot])):
+                if self._buckets[band].get(key) == slot:
+                    del self._buckets[band][key]
+        else:
+            self._filled += 1
+        self._signatures[slot] = signature
+        for band, key in enumerate(keys):
+            self._buckets[band][key] = slot
+        self._next_slot = (slot + 1) % self.max_entries
+
+    def stats(self):
+        return {
+            'seen': self.seen,
+            'duplicates': self.duplicates,
+            # 重複除去でコーパスが縮んだ割合
+            'shrink_ratio': self.duplicates / self.seen if self.seen else 0.0,
+            'entries': self._filled,
+            'max_entries': self.max_entries,
+            'threshold': self.threshold
+        }
@@ -0,0 +1,43 @@
+import os
+
+# 本番用の設定: gunicorn -c gunicorn.conf.py main:app
+
+bind = '0.0.0.0:3000'
+# ジョブの状態と結果はDB（generation_jobs）に、/metricsの値はMETRICS_MULTIPROC_DIRに各ワーカーが書き出して共有する
+# （/debug/profileのプロファイラは、開始の依頼を受けたワーカーのリクエストだけを計測する）
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# ジョブの完了待ちや/metricsの取得を並行して受け付けるため、ワーカーごとにスレッドを持たせる
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+
+# MeCabの辞書・フォント・マルコフ連鎖モデルをマスターで読み込んでからforkし、ワーカー間で共有する
+preload_app = True
+# スレッド・DB接続・ワーカープロセスはforkを越えて引き継げないため、fork後に各ワーカーで開始させる
+os.environ['PRELOAD_APP'] = '1'
+# 各ワーカーのプロセスプール（worker_pool.py）をCPU数÷ワーカー数に抑えるため、ワーカー数を渡す
+os.environ['GUNICORN_WORKERS'] = str(workers)
+# 各ワーカーのメトリクスを書き出し、/metricsで合算するディレクトリ（main.pyを読み込む前に設定する）
+os.environ.setdefault('METRICS_MULTIPROC_DIR', '/tmp/afm_metrics')
+
+accesslog = '-'
+errorlog = '-'
+
+
+def when_ready(server):
+    # preloadの後、最初のワーカーをforkする前に1回だけ呼ばれる
+    # （pre_forkはmax_requestsによる再起動を含め、ワーカーをforkするたびに呼ばれる）
+    import main
+    main.before_fork()
+
+
+def post_fork(server, worker):
+    import main
+    main.after_fork()
+
+
+def worker_exit(server, worker):
+    # 終了するワーカーのメトリクスを最後に書き出し、合算から漏れないようにする
+    import main
+    main.metrics_writer.stop()
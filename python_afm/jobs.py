@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+
+
+class JobError(Exception):
+    """ジョブの失敗をHTTPステータス付きで表す"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Job:
+    def __init__(self, kind, params, key, prepared=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.key = key
+        # 呼び出し元で準備済みのデータ（ワードクラウドの頻度表など）。実行後は手放す
+        self.prepared = prepared
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.created_at = time.time()
+        self.finished_at = None
+        # 同じ内容の依頼がこのジョブにまとめられた回数
+        self.joined = 0
+        self.done = threading.Event()
+
+    @classmethod
+    def from_row(cls, row):
+        """JobStoreから読み込んだ行で、別のワーカーが実行したジョブを表す"""
+        job_id, kind, params, status, result, data, error, error_status, joined, created_at, finished_at = row
+        job = cls(kind, params, None)
+        job.id = job_id
+        job.status = status
+        if result is not None and data is not None:
+            # 画像を読み込まなかった場合も空のバイト列を入れ、画像があることはdataキーで分かるようにする
+            result = {**result, 'data': bytes(data)}
+        job.result = result
+        job.error = error
+        job.error_status = error_status
+        job.joined = joined
+        job.created_at = created_at
+        job.finished_at = finished_at
+        if job.finished:
+            job.done.set()
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'joined': self.joined,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+        if self.status == 'succeeded':
+            # バイナリは/jobs/<id>/resultから取得する
+            data['result'] = {k: v for k, v in self.result.items() if k != 'data'}
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+class JobStore:
+    """ジョブの状態と結果をDBに保存し、どのgunicornワーカーに届いた問い合わせにも答えられるようにする"""
+
+    def __init__(self, pool, log_manager):
+        self.pool = pool
+        self.log_manager = log_manager
+
+    def save(self, job):
+        """ジョブの現在の状態を保存する（失敗してもジョブ自体は続ける）"""
+        result, data = None, None
+        if job.result is not None:
+            result = json.dumps({k: v for k, v in job.result.items() if k != 'data'}, ensure_ascii=False)
+            data = job.result.get('data')
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO public.generation_jobs
+                            (job_id, kind, params, status, result, result_data, error, error_status, joined,
+                             created_at, finished_at)
+                        VALUES (%s, %s, %s::jsonb, %s, %s::jsonb, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (job_id) DO UPDATE SET
+                            status = EXCLUDED.status,
+                            result = EXCLUDED.result,
+                            result_data = EXCLUDED.result_data,
+                            error = EXCLUDED.error,
+                            error_status = EXCLUDED.error_status,
+                            joined = EXCLUDED.joined,
+                            finished_at = EXCLUDED.finished_at
+                    """, (job.id, job.kind, json.dumps(job.params, ensure_ascii=False), job.status, result,
+                          psycopg2.Binary(data) if data is not None else None, job.error, job.error_status,
+                          job.joined, job.created_at, job.finished_at))
+            return True
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "JobStore", f"Error saving job: {str(e)}",
+                                       metadata={'job_id': job.id, 'status': job.status})
+            return False
+
+    def load(self, job_id, with_data=False):
+        """保存済みのジョブを返す（なければNone）。with_data=Falseでは画像のバイト列を読まない"""
+        data_column = 'result_data' if with_data else "CASE WHEN result_data IS NULL THEN NULL ELSE ''::bytea END"
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"""
+                        SELECT job_id, kind, params, status, result, {data_column}, error, error_status, joined,
+                               created_at, finished_at
+                        FROM public.generation_jobs
+                        WHERE job_id = %s
+                    """, (job_id,))
+                    row = cur.fetchone()
+            return Job.from_row(row) if row else None
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "JobStore", f"Error loading job: {str(e)}",
+                                       metadata={'job_id': job_id})
+            return None
+
+    def delete_expired(self, cutoff):
+        """cutoff（epoch秒）より前に完了したジョブと、それより前に作られたまま終わらなかったジョブを削除する"""
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        DELETE FROM public.generation_jobs
+                        WHERE COALESCE(finished_at, created_at) < %s
+                    """, (cutoff,))
+            return True
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "JobStore", f"Error deleting expired jobs: {str(e)}")
+            return False
+
+
+class JobManager:
+    """重い生成処理をジョブとして非同期に実行し、実行中の同一依頼を1つの処理にまとめる
+    （まとめるのは同じワーカーに届いた依頼。状態と結果はstoreに保存し、どのワーカーからも参照できる）"""
+
+    def __init__(self, runners, log_manager, max_workers=None, result_ttl=None, normalizers=None, store=None):
+        # runners: ジョブの種類 -> パラメータを受け取り結果のdictを返す関数
+        self.runners = runners
+        # normalizers: ジョブの種類 -> パラメータを検証・型変換する関数（同じ依頼が同じキーになるように）
+        self.normalizers = normalizers or {}
+        self.log_manager = log_manager
+        self.max_workers = int(max_workers or os.getenv('JOB_WORKERS', '2'))
+        # 完了したジョブの結果を保持する秒数
+        self.result_ttl = float(result_ttl or os.getenv('JOB_RESULT_TTL', '600'))
+        # 他のワーカーから状態と結果を参照できるようにする保存先（Noneならこのプロセスだけで持つ）
+        self.store = store
+        self._store_expired_at = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'deduplicated': 0,
+            'succeeded': 0,
+            'failed': 0
+        }
+
+    @staticmethod
+    def make_key(kind, params):
+        return f"{kind}:{json.dumps(params, sort_keys=True, ensure_ascii=False)}"
+
+    def normalize(self, kind, params):
+        """パラメータを正規化する（不正な値はJobErrorを送出）"""
+        normalizer = self.normalizers.get(kind)
+        return normalizer(params) if normalizer else params
+
+    def submit(self, kind, params, prepared=None):
+        """ジョブを登録する。同じ内容のジョブが実行中ならそれを返す"""
+        if kind not in self.runners:
+            raise KeyError(kind)
+        params = self.normalize(kind, params)
+        key = self.make_key(kind, params)
+        with self._lock:
+            self._expire()
+            job = self._inflight.get(key)
+            if job is not None:
+                job.joined += 1
+                self._stats['deduplicated'] += 1
+                return job, False
+            job = Job(kind, params, key, prepared)
+            self._jobs[job.id] = job
+            self._inflight[key] = job
+            self._stats['submitted'] += 1
+        if self.store is not None:
+            # 登録直後から別のワーカーでも/jobs/<id>で見つかるよう、実行前に保存する
+            self.store.save(job)
+            self._expire_store()
+        self._executor.submit(self._run, job)
+        return job, True
+
+    def run(self, kind, params, timeout=None, prepared=None):
+        """ジョブを登録して完了まで待つ（同期エンドポイントからの利用向け）"""
+        job, _ = self.submit(kind, params, prepared)
+        if not job.done.wait(timeout):
+            raise JobError("ジョブの完了待ちがタイムアウトしました", 503)
+        return job
+
+    def get(self, job_id, with_data=False):
+        """ジョブを返す。このプロセスになければ保存先から読み込む（with_data=Trueなら画像も読む）"""
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id, with_data)
+        return job
+
+    def _run(self, job):
+        job.status = 'running'
+        if self.store is not None:
+            self.store.save(job)
+        try:
+            runner = self.runners[job.kind]
+            job.result = runner(job.params) if job.prepared is None else runner(job.params, job.prepared)
+            job.status = 'succeeded'
+        except JobError as je:
+            job.error = je.message
+            job.error_status = je.status
+            job.status = 'failed'
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "JobManager", f"Job {job.kind} failed: {str(e)}",
+                                       metadata={'job_id': job.id, 'error_type': type(e).__name__})
+            job.error = 'サーバーエラーが発生しました'
+            job.error_status = 500
+            job.status = 'failed'
+        finally:
+            job.prepared = None
+            job.finished_at = time.time()
+            if self.store is not None:
+                self.store.save(job)
+            with self._lock:
+                if self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+                self._stats[job.status] += 1
+            job.done.set()
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _expire_store(self):
+        # 保存先の古いジョブの削除は1分に1回まで
+        now = time.time()
+        if now - self._store_expired_at < 60:
+            return
+        self._store_expired_at = now
+        self.store.delete_expired(now - self.result_ttl)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'jobs': len(self._jobs),
+                'inflight': len(self._inflight),
+                'result_ttl': self.result_ttl,
+                **self._stats
+            }
@@ -2,16 +2,46 @@ import os
 from dotenv import load_dotenv
 from text_processor import TextProcessor
 from create_logs import LogManager
+from markov_model import MarkovModelStore
+from sentence_pool import SentencePool
+from noun_index import RollingNounIndex
+from wordcloud_render import IMAGE_FORMATS
+from worker_pool import WorkerPool, WorkerTimeoutError
+from jobs import JobManager, JobStore, JobError
+from db_pool import get_pool, close_all_pools, reset_pools_after_fork
+from migrations import apply_migrations
+import gc
+import threading
+import metrics
+from profiling import Profiler
+import time
 from datetime import datetime
 import json
-from flask import Flask, jsonify, send_file, current_app
-import tempfile
+from flask import Flask, jsonify, send_file, current_app, request
+import io
 
 app = Flask(__name__)
 
 # グローバル変数の定義
 processor = None
 log_manager = None
+markov_store = None
+sentence_pool = None
+noun_index = None
+worker_pool = None
+job_manager = None
+profiler = None
+metrics_writer = metrics.SnapshotWriter()
+
+# gunicornのpreload_appで読み込まれる場合は1（スレッド・DB接続・ワーカープロセスはfork後に開始する）
+PRELOAD_APP = os.getenv('PRELOAD_APP', '0') == '1'
+# /readyで返す、定期更新のスレッドとワーカープロセスの準備状況
+readiness = {'background': False, 'workers': False}
+
+# ワードクラウドの集計期間（時間）の既定値
+DEFAULT_WORDCLOUD_HOURS = 4
+# 取り込みAPIが1回で受け付けるノート数の上限
+INGEST_MAX_BATCH = int(os.getenv('INGEST_MAX_BATCH', '1000'))
 
 def get_db_params():
     load_dotenv()
@@ -25,68 +55,273 @@ def get_db_params():
         'port': os.getenv('POSTGRES_PORT')
     }
 
-# アプリケーション初期化時に実行される関数
+# アプリケーション初期化時に実行される関数（プロセスごとに1回だけ呼ぶ）
 def init_app():
     with app.app_context():
+        started = time.perf_counter()
         db_params = get_db_params()
-        global processor, log_manager
-        processor = TextProcessor(db_params)
+        global processor, log_manager, markov_store, sentence_pool, noun_index, worker_pool, job_manager, profiler
         log_manager = LogManager(db_params)
-        
+        apply_migrations(get_pool(db_params), log_manager)
+        worker_pool = WorkerPool()
+        if PRELOAD_APP:
+            # マスターで起動したプロセスプールはfork先のワーカーで使えないため、初期化中はこのプロセスで処理する
+            worker_pool.suspend()
+        processor = TextProcessor(db_params, log_manager=log_manager, worker_pool=worker_pool)
+        # コーパス用のクエリがインデックスを使えるか確認（問題があればWARNINGを記録）
+        processor.corpus_sampler.check_query_plans()
+
+        # マルコフ連鎖モデルを読み込み（なければ構築）
+        markov_store = MarkovModelStore(processor, log_manager)
+        markov_store.get_model()
+
+        # 検証済みの文章をあらかじめ生成しておき、リクエスト時は取り出すだけにする
+        sentence_pool = SentencePool(markov_store, processor, log_manager)
+
+        # ワードクラウド用の名詞頻度インデックスを構築
+        noun_index = RollingNounIndex(processor, log_manager)
+        noun_index.refresh()
+
+        # 管理者用のプロファイラ（PROFILE_ADMIN_TOKENが未設定なら/debug/profileは無効）
+        profiler = Profiler()
+
+        # 生成処理を非同期に実行し、同じ内容の依頼をまとめるジョブ管理
+        # ジョブは別スレッドで動くため、プロファイル中はジョブの実行も計測する
+        # 状態と結果はDBに保存し、別のワーカーに届いた/jobs/<id>にも答えられるようにする
+        job_manager = JobManager({kind: profiler.wrap(runner) for kind, runner in JOB_RUNNERS.items()}, log_manager,
+                                 normalizers=JOB_NORMALIZERS, store=JobStore(processor.pool, log_manager))
+
+        register_gauges()
+
+        # MeCabの辞書・単語リスト・フォントを読み込んでおく（preload時はfork前に読み込み、ワーカー間で共有する）
+        warmed = processor.warm_up()
+
+        if not PRELOAD_APP:
+            start_background()
+
         log_manager.write_log(
             'INFO',
             'system',
             'Application initialized',
-            metadata={'host': '0.0.0.0', 'port': 3000}
+            metadata={'host': '0.0.0.0', 'port': 3000, 'preload': PRELOAD_APP,
+                      'seconds': round(time.perf_counter() - started, 3), **warmed}
         )
 
-# アプリケーション起動前に初期化を実行
-init_app()
+def start_background():
+    """定期更新のスレッドとワーカープロセスを開始する（preload時はfork後の各ワーカーで呼ぶ）"""
+    processor.word_lists.start_listener()
+    markov_store.start()
+    sentence_pool.start()
+    noun_index.start()
+    # 複数のワーカーの/metricsを合算するため、このプロセスの値を定期的に書き出す
+    metrics_writer.start()
+    readiness['background'] = True
+    # ワーカープロセスの起動と辞書の読み込みはリクエストの受け付けと並行して行う
+    threading.Thread(target=warm_up_workers, name='worker-warm-up', daemon=True).start()
 
-@app.route('/generate/text', methods=['GET'])
-def generate_text():
+def warm_up_workers():
     try:
-        texts = processor.get_texts_from_db()
-        texts_wordcloud = processor.get_texts_from_db_wordcloud()
-        if not texts:
-            log_manager.write_log(
-                'WARNING',
-                'text_generator',
-                'No texts found in database'
-            )
-            return jsonify({'error': 'データベースにテキストが見つかりませんでした'}), 404
+        started = time.perf_counter()
+        workers = worker_pool.warm_up()
+        readiness['workers'] = True
+        log_manager.write_log('INFO', 'system', 'Worker processes warmed up',
+                              metadata={'workers': workers, 'seconds': round(time.perf_counter() - started, 3)})
+    except Exception as e:
+        log_manager.write_log('ERROR', 'system', f'Failed to warm up worker processes: {str(e)}',
+                              metadata={'error_type': type(e).__name__})
 
-        try:
-            generated_text = processor.generate_markov_text(texts)
-            
-            log_manager.write_log(
-                'INFO',
-                'text_generator',
-                'テキストの生成に成功しました',
-                metadata={'text_length': len(generated_text)}
-            )
+def before_fork():
+    """preload時にgunicornのマスターで最初のワーカーをforkする前に1回だけ呼ぶ"""
+    # 書き込みスレッドを止めて残りのログを書き込む（以後マスターのログは同期的に書き込む）
+    log_manager.close()
+    # 子プロセスと同じ接続を共有しないよう、マスターの接続を閉じておく
+    close_all_pools()
+    # 前回の起動で書き出されたメトリクスを消し、マスターで記録した値（初期化の所要時間など）を書き出しておく
+    metrics.REGISTRY.clear_snapshots()
+    metrics.REGISTRY.write_snapshot(include_gauges=False)
+    # 読み込み済みのオブジェクトをGCの対象から外し、参照カウント以外でページがコピーされないようにする
+    gc.freeze()
 
-            return jsonify({'text': generated_text})
+def after_fork():
+    """preload時にgunicornのワーカーでfork直後に呼ぶ"""
+    reset_pools_after_fork()
+    # マスターから引き継いだメトリクスの値はマスターの書き出したファイルで数えるため、二重に数えないよう捨てる
+    metrics.REGISTRY.reset()
+    log_manager.after_fork()
+    worker_pool.resume()
+    start_background()
 
-        except ValueError as ve:
-            # データ不足などの検証エラー
-            log_manager.write_log(
-                'WARNING',
-                'text_generator',
-                str(ve),
-                metadata={'error_type': 'ValueError'}
-            )
-            return jsonify({'error': str(ve)}), 400
+def register_gauges():
+    """各コンポーネントのstats()の値を/metricsのゲージとして公開する"""
+    gauges = [
+        ('afm_token_cache_bytes', 'Bytes held by the token cache', lambda: processor.token_cache.stats()['bytes']),
+        ('afm_token_cache_entries', 'Entries in the token cache', lambda: processor.token_cache.stats()['entries']),
+        ('afm_render_cache_entries', 'Rendered wordcloud images in the cache',
+         lambda: processor.renderer.stats()['entries']),
+        ('afm_db_pool_connections', 'Database connections by state',
+         lambda: {state: processor.pool.stats()[state] for state in ('in_use', 'idle')}, ['state']),
+        ('afm_log_queue_depth', 'Log records waiting to be written', lambda: log_manager.stats()['queued']),
+        ('afm_sentence_pool_depth', 'Pre-generated sentences in the pool', lambda: sentence_pool.stats()['depth']),
+        ('afm_jobs_inflight', 'Jobs currently queued or running', lambda: job_manager.stats()['inflight']),
+    ]
+    # ワーカーごとに同じ値を持つゲージは合計せず最大値にする
+    shared_gauges = [
+        ('afm_noun_index_buckets', 'Time buckets held by the noun index', lambda: noun_index.stats()['buckets']),
+        ('afm_markov_trained_rows', 'Corpus lines the Markov model was trained on',
+         lambda: markov_store.stats()['trained_rows'])
+    ]
+    for name, help_text, callback, *labelnames in gauges:
+        metrics.gauge(name, help_text, callback, *labelnames)
+    for name, help_text, callback in shared_gauges:
+        metrics.gauge(name, help_text, callback, aggregate='max')
+
+def run_text_job(params):
+    """マルコフ連鎖で文章を1つ生成する"""
+    with metrics.collect_timings() as timings:
+        result = _run_text_job(params)
+    log_manager.write_log(
+        'INFO',
+        'text_generator',
+        'テキストの生成に成功しました',
+        metadata={'text_length': len(result['text']), 'timings': timings}
+    )
+    return result
+
+def _run_text_job(params):
+    if markov_store.get_model() is None:
+        log_manager.write_log(
+            'WARNING',
+            'text_generator',
+            'No texts found in database'
+        )
+        raise JobError('データベースにテキストが見つかりませんでした', 404)
+
+    try:
+        generated_text = sentence_pool.pop()
+    except ValueError as ve:
+        # データ不足などの検証エラー
+        log_manager.write_log(
+            'WARNING',
+            'text_generator',
+            str(ve),
+            metadata={'error_type': 'ValueError'}
+        )
+        raise JobError(str(ve), 400)
+    except RuntimeError as re:
+        # 生成失敗エラー
+        log_manager.write_log(
+            'ERROR',
+            'text_generator',
+            str(re),
+            metadata={'error_type': 'RuntimeError'}
+        )
+        raise JobError(str(re), 500)
+
+    return {'text': generated_text}
+
+def normalize_wordcloud_params(params):
+    """リクエストのパラメータを検証し、型を揃える（{'hours': 4}と{'hours': '4'}を同じ依頼にする）"""
+    try:
+        hours = float(params.get('hours', DEFAULT_WORDCLOUD_HOURS))
+    except (TypeError, ValueError):
+        hours = -1
+    if hours <= 0:
+        raise JobError('hoursには正の数を指定してください', 400)
+    # 名詞索引が保持している時間窓より長い指定は、黙って短くせずにエラーにする
+    max_hours = noun_index.retention_seconds / 3600
+    if hours > max_hours:
+        raise JobError(f'hoursには{max_hours:g}以下の値を指定してください', 400)
 
-        except RuntimeError as re:
-            # 生成失敗エラー
+    image_format = params.get('format', 'png')
+    quantize = str(params.get('quantize', '0')) in ('1', 'true', 'True')
+    if image_format not in IMAGE_FORMATS:
+        raise JobError('formatにはpngまたはwebpを指定してください', 400)
+    return {'hours': hours, 'format': image_format, 'quantize': quantize}
+
+def prepare_wordcloud(params):
+    """正規化済みのパラメータから描画に使う頻度表を取得"""
+    # 前回の取り込み以降に増えたノートだけを反映してから頻度表を取得
+    noun_index.refresh()
+    frequencies = noun_index.frequencies(params['hours'] * 3600)
+    if not frequencies:
+        log_manager.write_log(
+            'WARNING',
+            'generate_wordcloud',
+            'No texts_wordcloud found in database'
+        )
+        raise JobError('テキストが見つかりませんでした', 404)
+    return frequencies
+
+def run_wordcloud_job(params, frequencies=None):
+    """ワードクラウドを描画する（頻度表が渡されなければここで取得する）"""
+    image_format, quantize = params['format'], params['quantize']
+    with metrics.collect_timings() as timings:
+        if frequencies is None:
+            frequencies = prepare_wordcloud(params)
+        try:
+            rendered = processor.render_wordcloud(frequencies, image_format, quantize)
+        except WorkerTimeoutError as te:
             log_manager.write_log(
                 'ERROR',
-                'text_generator',
-                str(re),
-                metadata={'error_type': 'RuntimeError'}
+                'generate_wordcloud',
+                str(te),
+                metadata={'error_type': 'WorkerTimeoutError'}
             )
-            return jsonify({'error': str(re)}), 500
+            raise JobError('ワードクラウドの生成がタイムアウトしました', 503)
+    if rendered is None:
+        raise JobError('ワードクラウドの生成に失敗しました', 500)
+
+    log_manager.write_log(
+        'INFO',
+        'generate_wordcloud',
+        'ワードクラウドの生成に成功しました',
+        metadata={
+            'format': image_format,
+            'bytes': len(rendered['data']),
+            'cached': rendered['cached'],
+            'timings': timings
+        }
+    )
+    return {
+        'data': rendered['data'],
+        'mimetype': rendered['mimetype'],
+        'format': image_format,
+        'bytes': len(rendered['data']),
+        'etag': rendered['etag'],
+        'cached': rendered['cached']
+    }
+
+JOB_RUNNERS = {
+    'text': run_text_job,
+    'wordcloud': run_wordcloud_job
+}
+
+JOB_NORMALIZERS = {
+    'wordcloud': normalize_wordcloud_params
+}
+
+def send_wordcloud(result):
+    # 画像を直接返却
+    return send_file(
+        io.BytesIO(result['data']),
+        mimetype=result['mimetype'],
+        as_attachment=True,
+        download_name=f"wordcloud.{result['format']}",
+        etag=result['etag']
+    )
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+@app.route('/generate/text', methods=['GET'])
+def generate_text():
+    try:
+        return jsonify(run_text_job(request.args.to_dict()))
+
+    except JobError as je:
+        return jsonify({'error': je.message}), je.status
 
     except Exception as e:
         # 予期しないエラー
@@ -98,43 +333,162 @@ def generate_text():
         )
         return jsonify({'error': 'サーバーエラーが発生しました'}), 500
 
+@app.before_request
+def start_request_timer():
+    request.started_at = time.perf_counter()
+    # プロファイルを要求されていない間は残り件数を確認するだけ
+    if profiler is not None and profiler.remaining and not request.path.startswith('/debug/'):
+        profiler.begin()
+
+@app.teardown_request
+def stop_request_profile(exc):
+    if profiler is not None:
+        profiler.end()
+
+@app.after_request
+def observe_request_latency(response):
+    started_at = getattr(request, 'started_at', None)
+    if started_at is not None:
+        # パスではなくルールで集計し、ラベルの種類が増えすぎないようにする
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started_at,
+                                             endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def check_admin_token():
+    """管理者用エンドポイントの認可。問題があればエラーレスポンスを返す"""
+    if profiler is None or not profiler.enabled:
+        return jsonify({'error': 'Not Found'}), 404
+    if not profiler.authorize(request.headers.get('X-Admin-Token')):
+        log_manager.write_log(
+            'WARNING',
+            'profiler',
+            'Rejected profiling request with an invalid admin token',
+            metadata={'remote_addr': request.remote_addr}
+        )
+        return jsonify({'error': '認証に失敗しました'}), 403
+    return None
+
+@app.route('/debug/profile', methods=['GET'])
+def profile_status():
+    """プロファイラの状態を返す"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return jsonify(profiler.status())
+
+@app.route('/debug/profile', methods=['POST'])
+def start_profile():
+    """プロファイルを開始する
+
+    mode=requests: 次のcount件のリクエスト（とそのジョブ）をcProfileで計測
+    mode=sample: seconds秒間、全スレッドのスタックをinterval秒ごとにサンプリング
+    mode=tracemalloc: action=start|snapshot|stopでメモリの増分を確認
+    """
+    denied = check_admin_token()
+    if denied:
+        return denied
+    params = {**request.args.to_dict(), **(request.get_json(silent=True) or {})}
+    mode = params.get('mode', 'requests')
+    try:
+        if mode == 'requests':
+            session = profiler.profile_requests(params.get('count', 10))
+        elif mode == 'sample':
+            session = profiler.sample(params.get('seconds', 10), params.get('interval', 0.01))
+        elif mode == 'tracemalloc':
+            action = params.get('action', 'start')
+            if action == 'start':
+                session = profiler.tracemalloc_start(params.get('frames', 25))
+            elif action == 'snapshot':
+                session = profiler.tracemalloc_snapshot(int(params.get('limit', 30)))
+            elif action == 'stop':
+                session = profiler.tracemalloc_stop()
+            else:
+                return jsonify({'error': 'actionにはstart、snapshot、stopのいずれかを指定してください'}), 400
+        else:
+            return jsonify({'error': 'modeにはrequests、sample、tracemallocのいずれかを指定してください'}), 400
+    except (TypeError, ValueError):
+        return jsonify({'error': 'パラメータが不正です'}), 400
+    except RuntimeError as re:
+        return jsonify({'error': str(re)}), 409
+
+    log_manager.write_log('INFO', 'profiler', f'Profiling started ({mode})', metadata=session)
+    return jsonify(session), 202 if mode != 'tracemalloc' else 200
+
+@app.route('/debug/profile/result', methods=['GET'])
+def profile_result():
+    """直近のプロファイル結果を返す（format=textまたはpstats、サンプリングはcollapsed形式）"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    rendered = profiler.render_result(request.args.get('format', 'text'), request.args.get('sort', 'cumulative'))
+    if rendered is None:
+        return jsonify({'error': 'プロファイル結果がありません'}), 404
+    body, mimetype, filename = rendered
+    return send_file(io.BytesIO(body), mimetype=mimetype, as_attachment=True, download_name=filename)
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """辞書・単語リスト・フォント・ワーカーの準備ができていれば200、まだなら503を返す"""
+    if processor is None:
+        return jsonify({'ready': False}), 503
+    checks = {**processor.readiness(), **readiness}
+    is_ready = all(checks.values())
+    return jsonify({
+        'ready': is_ready,
+        'checks': checks,
+        # 学習データが少ない間も描画はできるため、準備状況の判定には含めない
+        'markov_model': markov_store.ready
+    }), 200 if is_ready else 503
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """接続プールやキャッシュの統計情報を返す"""
+    return jsonify({
+        'db_pool': processor.pool.stats(),
+        'token_cache': processor.token_cache.stats(),
+        'corpus_sampler': processor.corpus_sampler.stats(),
+        'ingest': {
+            'ingested_notes': processor.ingested_notes,
+            'pretokenized_reads': processor.pretokenized_reads
+        },
+        'logs': log_manager.stats(),
+        'word_lists': processor.word_lists.stats(),
+        'markov_model': markov_store.stats(),
+        'sentence_pool': sentence_pool.stats(),
+        'noun_index': noun_index.stats(),
+        'wordcloud_render': processor.renderer.stats(),
+        'worker_pool': worker_pool.stats(),
+        'jobs': job_manager.stats()
+    })
+
 @app.route('/generate/wordcloud', methods=['GET'])
 def generate_wordcloud():
     try:
-        texts_wordcloud = processor.get_texts_from_db_wordcloud()
-        if not texts_wordcloud:
-            log_manager.write_log(
-                'WARNING',
-                'generate_wordcloud',
-                'No texts_wordcloud found in database'
-            )
-            return jsonify({'error': 'テキストが見つかりませんでした'}), 404
+        params = job_manager.normalize('wordcloud', request.args.to_dict())
+        frequencies = prepare_wordcloud(params)
 
-        # 一時ファイルのみ生成
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-        temp_filename = temp_file.name
-        
-        # ワードクラウドを生成
-        wordcloud = processor.generate_wordcloud(texts_wordcloud, temp_filename)
-        if wordcloud is None:
-            return jsonify({'error': 'ワードクラウドの生成に失敗しました'}), 500
+        # 同じ頻度表と描画設定の画像がキャッシュにあり、クライアントが同じ画像を持っていれば描画せずに304を返す
+        etag = processor.cached_wordcloud_etag(frequencies, params['format'], params['quantize'])
+        if etag is not None and etag in request.if_none_match:
+            return not_modified(etag)
 
-        log_manager.write_log(
-            'INFO',
-            'generate_wordcloud',
-            'ワードクラウドの生成に成功しました',
-            metadata={
-                'temp_file': temp_filename
-            }
-        )
+        # 同時に届いた同じ内容のリクエストは1回の描画にまとめる（取得済みの頻度表をそのまま使う）
+        # 描画の制限時間を過ぎても終わらなければ503を返す
+        job = job_manager.run('wordcloud', params, timeout=worker_pool.timeout, prepared=frequencies)
+        if job.status == 'failed':
+            return jsonify({'error': job.error}), job.error_status
+        if job.result['etag'] in request.if_none_match:
+            return not_modified(job.result['etag'])
+        return send_wordcloud(job.result)
 
-        # 画像を直接返却
-        return send_file(
-            temp_filename,
-            mimetype='image/png',
-            as_attachment=True,
-            download_name='wordcloud.png'
-        )
+    except JobError as je:
+        return jsonify({'error': je.message}), je.status
 
     except Exception as e:
         log_manager.write_log(
@@ -144,37 +498,113 @@ def generate_wordcloud():
             metadata={'error_type': type(e).__name__}
         )
         return jsonify({'error': 'サーバーエラーが発生しました'}), 500
-    finally:
-        # 一時ファイルを削除
-        if 'temp_filename' in locals():
-            os.unlink(temp_filename)
 
-if __name__ == "__main__":
+def validate_ingest_note(note):
+    """取り込むノートの形式を確かめ、問題があればその理由を返す"""
+    if not isinstance(note, dict):
+        return 'ノートはオブジェクトで指定してください'
+    if note.get('text') is not None and not isinstance(note['text'], str):
+        return 'textは文字列かnullで指定してください'
+    if note.get('note_id') is not None and not isinstance(note['note_id'], str):
+        return 'note_idは文字列で指定してください'
+    return None
+
+@app.route('/ingest/notes', methods=['POST'])
+def ingest_notes():
+    """GTLのノートをまとめて受け取り、形態素解析の結果と一緒に保存する"""
+    payload = request.get_json(silent=True)
+    notes = payload.get('notes') if isinstance(payload, dict) else payload
+    if not isinstance(notes, list) or not notes:
+        return jsonify({'error': 'notesにノートの配列を指定してください'}), 400
+    if len(notes) > INGEST_MAX_BATCH:
+        return jsonify({'error': f'一度に取り込めるノートは{INGEST_MAX_BATCH}件までです'}), 400
+
+    # 不正なノートがあってもバッチ全体は捨てず、そのノートだけを理由と一緒にrejectedで返す
+    rows, rejected = [], []
+    for index, note in enumerate(notes):
+        error = validate_ingest_note(note)
+        if error is not None:
+            note_id = note.get('note_id') if isinstance(note, dict) else None
+            rejected.append({'index': index, 'note_id': note_id, 'error': error})
+            continue
+        rows.append({
+            'note_id': note.get('note_id'),
+            'user_name': note.get('user_name'),
+            'instance_name': note.get('instance_name'),
+            # リノートなど本文のないノートはtextがnull（解析せずに保存する）
+            'text': note.get('text')
+        })
+    if rejected:
+        log_manager.write_log(
+            'WARNING',
+            'ingest_notes',
+            f'{len(rejected)}件のノートを取り込みませんでした',
+            metadata={'rejected': rejected}
+        )
+    if not rows:
+        return jsonify({'ingested': 0, 'duplicates': 0, 'gtl_ids': [], 'rejected': rejected})
+
     try:
-        db_params = get_db_params()
-        processor = TextProcessor(db_params)
-        log_manager = LogManager(db_params)
-        
-        # 起動時のログ記録
+        gtl_ids = processor.ingest_notes(rows)
+    except Exception as e:
         log_manager.write_log(
-            'INFO',
-            'system',
-            'Flask application started',
-            metadata={'host': '0.0.0.0', 'port': 3000}
+            'ERROR',
+            'ingest_notes',
+            str(e),
+            metadata={'error_type': type(e).__name__}
         )
-        app.run(host='0.0.0.0', port=3000)
+        gtl_ids = None
+    if gtl_ids is None:
+        return jsonify({'error': 'ノートの保存に失敗しました'}), 500
+    # 保存済みのnote_idのノート（再送されたもの）は保存せず、duplicatesに数える
+    return jsonify({'ingested': len(gtl_ids), 'duplicates': len(rows) - len(gtl_ids), 'gtl_ids': gtl_ids,
+                    'rejected': rejected})
 
-        generated_text = processor.generate_markov_text(texts)
-        print(generated_text)
+@app.route('/jobs/<kind>', methods=['POST'])
+def create_job(kind):
+    """生成処理をジョブとして登録し、ジョブIDを返す"""
+    if kind not in JOB_RUNNERS:
+        return jsonify({'error': f'不明なジョブの種類です: {kind}'}), 404
+    params = request.get_json(silent=True) or request.args.to_dict()
+    try:
+        job, created = job_manager.submit(kind, params)
+    except JobError as je:
+        return jsonify({'error': je.message}), je.status
+    response = jsonify({**job.to_dict(), 'created': created})
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response
 
-    except Exception as e:
-        print(f"Initialization error: {str(e)}")
-        if log_manager:
-            log_manager.write_log(
-                'ERROR',
-                'system',
-                'Application initialization failed',
-                metadata={'error': str(e)}
-            )
-        exit(1)  # exit() をif文のブロック内に移動
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """ジョブの状態と結果を返す"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    data = job.to_dict()
+    if job.status == 'succeeded' and 'data' in job.result:
+        data['result']['url'] = f'/jobs/{job.id}/result'
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """完了したジョブの結果（ワードクラウドは画像）を返す"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), job.error_status
+    if not job.finished:
+        return jsonify({'error': 'ジョブはまだ完了していません', 'status': job.status}), 409
+    if 'data' in job.result:
+        return send_wordcloud(job.result)
+    return jsonify(job.result)
 
+# アプリケーション起動前に初期化を実行
+# （ワーカープロセスがこのモジュールを__mp_main__として読み込む際は初期化しない）
+if __name__ != '__mp_main__':
+    init_app()
+
+if __name__ == "__main__":
+    # 開発用の起動方法。本番はgunicorn -c gunicorn.conf.py main:app で起動する
+    app.run(host='0.0.0.0', port=3000, threaded=True)
@@ -0,0 +1,361 @@
+import os
+import json
+import time
+import fcntl
+import resource
+import threading
+from itertools import chain
+from datetime import datetime
+import markovify
+from compact_chain import CompactChain
+from metrics import timed, collect_timings
+
+
+# 差分更新中に常駐メモリを読み取る間隔（学習行数）
+RSS_SAMPLE_LINES = 1000
+
+
+def peak_rss_kb():
+    """このプロセスの起動以来の最大常駐メモリ（KB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss_kb():
+    """このプロセスの現在の常駐メモリ（KB）。/procがない環境ではNone"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * resource.getpagesize() // 1024
+
+
+class _RunSplitter(markovify.NewlineText):
+    """NewlineTextと同じ規則で行をトークン列に分ける（連鎖は持たない）"""
+
+    def __init__(self):
+        self.well_formed = True
+
+    def iter_runs(self, lines):
+        sentences = (sentence for line in lines for sentence in self.sentence_split(line))
+        return map(self.word_split, filter(self.test_sentence_input, sentences))
+
+
+_run_splitter = _RunSplitter()
+
+
+def iter_runs(lines):
+    """分かち書き済みの行のイテレータを、学習用のトークン列のイテレータに変換"""
+    return _run_splitter.iter_runs(lines)
+
+
+def build_model_from_lines(lines, state_size, engine='compact'):
+    """分かち書き済みの行のイテレータからモデルを構築（行がなければNone）
+
+    コーパス全体を1つの文字列やリストにせず、1行ずつ連鎖に取り込む
+    """
+    runs = iter_runs(lines)
+    if engine == 'compact':
+        return CompactChain.build(runs, state_size)
+    first = next(runs, None)
+    if first is None:
+        return None
+    model_chain = markovify.Chain(chain([first], runs), state_size)
+    return markovify.NewlineText(None, state_size=state_size, chain=model_chain, retain_original=False)
+
+
+def combine_models(models, engine='compact'):
+    """同じエンジンのモデルの遷移回数を合算する"""
+    if engine == 'compact':
+        return CompactChain.combine(models)
+    return markovify.combine(models)
+
+
+class MarkovModelStore:
+    """マルコフ連鎖モデルをメモリ上に常駐させ、差分学習とディスクへの保存を行う"""
+
+    FORMAT_VERSION = 1
+    # 文章の生成に必要な最小の学習行数
+    MIN_TRAINED_ROWS = 10
+
+    def __init__(self, processor, log_manager, model_path=None, state_size=2, engine=None):
+        self.processor = processor
+        self.log_manager = log_manager
+        # compact（CompactChainのバイナリで保存し、mmapで開く）またはmarkovify（JSONで保存）
+        self.engine = engine or processor.markov_engine
+        default_path = '/penetration/markov_model.bin' if self.engine == 'compact' else '/penetration/markov_model.json'
+        self.model_path = model_path or os.getenv('MARKOV_MODEL_PATH', default_path)
+        self.state_size = state_size
+        # 差分学習の間隔（秒）とサーバー側カーソルから1回に取得する件数
+        self.refresh_interval = float(os.getenv('MARKOV_REFRESH_INTERVAL', '300'))
+        self.batch_size = int(os.getenv('MARKOV_UPDATE_BATCH', '5000'))
+        # モデルファイルがない状態での初回構築で、全期間を読む代わりにランダムに抽出するノート数
+        # （学習対象がこれ以下なら全件を読む。0で常に全件）
+        self.bootstrap_size = int(os.getenv('MARKOV_BOOTSTRAP_SAMPLE', '20000'))
+        # 学習を担当しないプロセスが保存済みモデルの更新を確認する間隔（秒）
+        self.poll_interval = min(float(os.getenv('MARKOV_SNAPSHOT_POLL_INTERVAL', '10')), self.refresh_interval)
+        # 直近の差分更新の件数・所要時間・最大常駐メモリ
+        self.last_run = None
+        # 学習済みのノートとほぼ同じノートを学習しないための索引
+        self.dedup = processor.new_dedup_index()
+
+        self.model = None
+        # ウォーターマーク：学習済みの最新gtl_idとそのタイムスタンプ
+        self.last_id = 0
+        self.last_timestamp = None
+        self.trained_rows = 0
+        # 保存のたびに増える番号と、読み込んだファイルの(inode, 更新時刻, サイズ)
+        self.generation = 0
+        self._file_signature = None
+        self.reloads = 0
+        # 同じモデルファイルを使うプロセスのうち、ロックを取れた1つだけがDBから学習して保存する
+        self._trainer_lock = None
+
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _stat_model_file(self):
+        try:
+            st = os.stat(self.model_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """保存済みのモデルをディスクから読み込む（compactはmmapで開き、他のプロセスとメモリを共有する）"""
+        signature = self._stat_model_file()
+        if signature is None:
+            return False
+        try:
+            if self.engine == 'compact':
+                model, data = CompactChain.open(self.model_path)
+            else:
+                with open(self.model_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                model = None
+            if data.get('version') != self.FORMAT_VERSION or data.get('state_size') != self.state_size:
+                self.log_manager.write_log("WARNING", "MarkovModelStore", "Ignoring incompatible model file",
+                                           metadata={'path': self.model_path})
+                return False
+            self.model = model or markovify.NewlineText.from_json(data['model'])
+            self.last_id = data['last_id']
+            self.last_timestamp = data.get('last_timestamp')
+            self.trained_rows = data.get('trained_rows', 0)
+            self.generation = data.get('generation', 0)
+            self._file_signature = signature
+            self.log_manager.write_log("INFO", "MarkovModelStore", "Loaded Markov model from disk",
+                                       metadata=self.stats())
+            return True
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "MarkovModelStore", f"Error loading Markov model: {str(e)}")
+            return False
+
+    def save(self):
+        """モデルを一時ファイルに書き出してから置き換える"""
+        if self.model is None:
+            return False
+        try:
+            data = {
+                'version': self.FORMAT_VERSION,
+                'state_size': self.state_size,
+                'last_id': self.last_id,
+                'last_timestamp': self.last_timestamp,
+                'trained_rows': self.trained_rows,
+                'generation': self.generation + 1
+            }
+            if self.engine == 'compact':
+                # ウォーターマークはバイナリのヘッダに埋め込む
+                self.model.save(self.model_path, meta=data)
+                # 書き出したファイルをmmapで開き直し、学習したプロセスも他のプロセスと同じページを使う
+                self.load()
+                return True
+            data['model'] = self.model.to_json()
+            tmp_path = f"{self.model_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.model_path)
+            self.generation += 1
+            self._file_signature = self._stat_model_file()
+            return True
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "MarkovModelStore", f"Error saving Markov model: {str(e)}")
+            return False
+
+    def reload_if_changed(self):
+        """他のプロセスが新しいモデルを保存していれば読み込み直す"""
+        signature = self._stat_model_file()
+        if signature is None or signature == self._file_signature:
+            return False
+        with self._lock:
+            if signature == self._file_signature:
+                return False
+            # 置き換え前のファイルを参照している生成処理は、古いモデルのまま最後まで実行される
+            if self.load():
+                self.reloads += 1
+                return True
+            return False
+
+    def _acquire_trainer_lock(self):
+        """学習を担当するロックを取る（担当のプロセスが終了するとロックは自動的に解放される）"""
+        if self._trainer_lock is not None:
+            return True
+        lock_file = open(f"{self.model_path}.lock", 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._trainer_lock = lock_file
+        self.log_manager.write_log("INFO", "MarkovModelStore", "This process now trains the shared Markov model",
+                                   metadata={'pid': os.getpid(), 'path': self.model_path})
+        return True
+
+    def refresh(self):
+        """ウォーターマーク以降の新しいノートをDBから逐次読み出してモデルを差分更新"""
+        with self._lock, collect_timings() as timings, timed('model_refresh'):
+            started = time.perf_counter()
+            # ru_maxrssは起動以来の最大値で、1回の差分更新の増分にならないため、現在の常駐メモリを読み取る
+            rss_before = current_rss_kb()
+            progress = {'rows': 0, 'lines': 0, 'last_row': None, 'rss_peak': rss_before}
+
+            def track_rows(rows):
+                for row in rows:
+                    progress['rows'] += 1
+                    progress['last_row'] = row
+                    yield row[1], row[3]
+
+            def count_lines(lines):
+                for line in lines:
+                    progress['lines'] += 1
+                    if rss_before is not None and progress['lines'] % RSS_SAMPLE_LINES == 0:
+                        progress['rss_peak'] = max(progress['rss_peak'], current_rss_kb() or 0)
+                    yield line
+
+            # DB読み出し → 形態素解析・フィルタ → 連鎖の構築を1行ずつ流し、コーパス全体をメモリに載せない
+            rows = self.processor.iter_texts_after(self.last_id, self.batch_size)
+            lines = self.processor.iter_markov_corpus(track_rows(rows), dedup=self.dedup)
+            batch_model = build_model_from_lines(count_lines(lines), self.state_size, self.engine)
+
+            if batch_model is not None:
+                # 既存モデルは書き換えず、結合した新しいモデルに差し替える
+                if self.model is None:
+                    self.model = batch_model
+                else:
+                    with timed('model_combine'):
+                        self.model = combine_models([self.model, batch_model], self.engine)
+
+            last_row = progress['last_row']
+            if last_row is not None:
+                self.last_id = last_row[0]
+                last_timestamp = last_row[2]
+                self.last_timestamp = last_timestamp.isoformat() if isinstance(last_timestamp, datetime) else last_timestamp
+                self.trained_rows += progress['lines']
+
+            rss_after = current_rss_kb() or 0
+            self.last_run = {
+                'rows': progress['rows'],
+                'lines': progress['lines'],
+                'seconds': round(time.perf_counter() - started, 3),
+                'peak_rss_kb': peak_rss_kb(),
+                # この差分更新の開始時からの常駐メモリの増分と、更新中に読み取った最大値（KB）
+                'rss_growth_kb': rss_after - rss_before if rss_before is not None else None,
+                'run_peak_rss_kb': max(progress['rss_peak'], rss_after) if rss_before is not None else None,
+                # 差分更新のうち各処理段階にかかった時間（DB読み出し・形態素解析などは交互に行われる）
+                'timings': dict(timings)
+            }
+            if progress['rows']:
+                self.save()
+                self.log_manager.write_log("INFO", "MarkovModelStore", "Markov model updated",
+                                           metadata={'new_rows': progress['rows'], **self.stats()})
+            return progress['rows']
+
+    def bootstrap(self):
+        """全期間からランダムに抽出したノートで最初のモデルを構築し、ウォーターマークを最新のノートまで進める
+        （学習対象がbootstrap_size件以下なら何もせずFalseを返し、refresh()で全件を読む）"""
+        if self.bootstrap_size <= 0:
+            return False
+        sampler = self.processor.corpus_sampler
+        bounds = sampler.bounds()
+        if bounds is None or bounds[1] - bounds[0] + 1 <= self.bootstrap_size:
+            return False
+        with self._lock, timed('model_bootstrap'):
+            rows = sampler.sample(self.bootstrap_size)
+            progress = {'lines': 0}
+
+            def count_lines(lines):
+                for line in lines:
+                    progress['lines'] += 1
+                    yield line
+
+            lines = self.processor.iter_markov_corpus(((row[1], row[2]) for row in rows), dedup=self.dedup)
+            model = build_model_from_lines(count_lines(lines), self.state_size, self.engine)
+            if model is None:
+                return False
+            self.model = model
+            # 抽出に含まれなかった古いノートは学習せず、以降の差分更新は最新のノートから続ける
+            self.last_id = bounds[1]
+            self.trained_rows = progress['lines']
+            self.save()
+            self.log_manager.write_log("INFO", "MarkovModelStore", "Markov model bootstrapped from a corpus sample",
+                                       metadata={'sampled_rows': len(rows), **self.stats()})
+            return True
+
+    def get_model(self):
+        """サンプリング用のモデルを返す（未学習の場合のみ同期的に構築）"""
+        if self.model is None:
+            with self._lock:
+                if self.model is None and not self.load() and not self.bootstrap():
+                    self.refresh()
+        return self.model
+
+    @property
+    def ready(self):
+        """文章を生成できるだけ学習済みか"""
+        return self.get_model() is not None and self.trained_rows >= self.MIN_TRAINED_ROWS
+
+    def generate(self):
+        """常駐モデルから文章をサンプリング"""
+        if not self.ready:
+            raise ValueError("学習データが不足しています")
+        return self.processor.sample_markov_text(self.model)
+
+    def start(self):
+        """バックグラウンドでの定期差分更新を開始"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='markov-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        last_refresh = time.monotonic()
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                if not self._acquire_trainer_lock():
+                    self.reload_if_changed()
+                elif time.monotonic() - last_refresh >= self.refresh_interval:
+                    # 前の担当が保存したモデルがあれば、それを引き継いでから差分を学習する
+                    self.reload_if_changed()
+                    self.refresh()
+                    last_refresh = time.monotonic()
+            except Exception as e:
+                self.log_manager.write_log("ERROR", "MarkovModelStore", f"Error refreshing Markov model: {str(e)}")
+
+    def stats(self):
+        return {
+            'engine': self.engine,
+            'last_id': self.last_id,
+            'last_timestamp': self.last_timestamp,
+            'trained_rows': self.trained_rows,
+            'model_path': self.model_path,
+            'generation': self.generation,
+            'role': 'trainer' if self._trainer_lock is not None else 'reader',
+            'reloads': self.reloads,
+            'mapped': getattr(self.model, 'mapped', False),
+            'last_run': self.last_run,
+            'dedup': self.dedup.stats() if self.dedup is not None else None
+        }
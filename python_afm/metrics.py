@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+# 処理段階の所要時間のヒストグラムに使うバケット（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_local = threading.local()
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def merge(self, values, other):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        items = sorted((self.collect() if values is None else values).items())
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # ラベル -> [各バケットの件数, 合計, 件数]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def merge(self, values, other):
+        for key, (counts, total, count) in other.items():
+            entry = values.get(key)
+            if entry is None:
+                values[key] = [list(counts), total, count]
+            else:
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def render(self, values=None):
+        items = sorted((self.collect() if values is None else values).items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Gauge(_Metric):
+    """出力のたびにコールバックで値を取得するゲージ"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback, labelnames=(), aggregate='sum'):
+        super().__init__(name, help_text, labelnames)
+        # ラベルがない場合は数値、ある場合は(ラベル値のタプル -> 数値)のdictを返す
+        self.callback = callback
+        # 複数のワーカーの値をまとめる方法（sum: 合計 / max: 最大値）
+        self.aggregate = aggregate
+
+    def collect(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return {}
+        if value is None:
+            return {}
+        if not isinstance(value, dict):
+            return {(): value}
+        return {key if isinstance(key, tuple) else (key,): v for key, v in value.items() if v is not None}
+
+    def reset(self):
+        pass
+
+    def merge(self, values, other):
+        for key, value in other.items():
+            if key not in values:
+                values[key] = value
+            elif self.aggregate == 'max':
+                values[key] = max(values[key], value)
+            else:
+                values[key] += value
+
+    def render(self, values=None):
+        items = sorted((self.collect() if values is None else values).items())
+        if not items:
+            return []
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}' for key, v in items
+        ]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """メトリクスの登録先
+
+    multiproc_dirを指定すると、各プロセスが自分の値をそのディレクトリに書き出し、出力時に全プロセスの値を合算する
+    （gunicornの複数のワーカーのどれに/metricsが届いても同じ値を返すため）。
+    カウンタとヒストグラムは終了したプロセスの値も含め、ゲージは生きているプロセスの値だけを使う。
+    """
+
+    def __init__(self, multiproc_dir=None):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.multiproc_dir = multiproc_dir
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def _list(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.multiproc_dir, f'{pid or os.getpid()}.json')
+
+    def write_snapshot(self, include_gauges=True):
+        """このプロセスの値をmultiproc_dirに書き出す（一時ファイルに書いてから置き換える）"""
+        if not self.multiproc_dir:
+            return False
+        snapshot = {
+            'pid': os.getpid(),
+            'metrics': {
+                metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                for metric in self._list() if include_gauges or metric.kind != 'gauge'
+            }
+        }
+        os.makedirs(self.multiproc_dir, exist_ok=True)
+        path = self._snapshot_path()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+        return True
+
+    def reset(self):
+        """fork直後のワーカーで、親プロセスから引き継いだ値を捨てる（親の値は親の書き出したファイルで数える）"""
+        for metric in self._list():
+            metric.reset()
+
+    def clear_snapshots(self):
+        """前回の起動で書き出された値を削除する（マスターの起動時に呼ぶ）"""
+        if not self.multiproc_dir or not os.path.isdir(self.multiproc_dir):
+            return
+        for filename in os.listdir(self.multiproc_dir):
+            if filename.endswith('.json') or filename.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.multiproc_dir, filename))
+                except OSError:
+                    pass
+
+    def _other_snapshots(self):
+        if not self.multiproc_dir or not os.path.isdir(self.multiproc_dir):
+            return []
+        own = os.path.basename(self._snapshot_path())
+        snapshots = []
+        for filename in os.listdir(self.multiproc_dir):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(self.multiproc_dir, filename), 'r', encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # 書き出し中・削除済みのファイルは次回の出力で数える
+                continue
+        return snapshots
+
+    def render(self):
+        """Prometheusのテキスト形式で全メトリクスを出力"""
+        metrics = self._list()
+        values = {metric.name: metric.collect() for metric in metrics}
+        for snapshot in self._other_snapshots():
+            alive = _pid_alive(snapshot.get('pid', 0))
+            for metric in metrics:
+                other = snapshot['metrics'].get(metric.name)
+                if other is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                metric.merge(values[metric.name], {tuple(key): value for key, value in other})
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(values[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+# gunicornの複数のワーカーの値を合算するときに、各プロセスの値を書き出すディレクトリ
+REGISTRY = Registry(os.getenv('METRICS_MULTIPROC_DIR') or None)
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'afm_stage_seconds', 'Time spent in each pipeline stage', ['stage']))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'afm_stage_errors_total', 'Pipeline stages that raised an exception', ['stage']))
+STAGE_ITEMS = REGISTRY.register(Counter(
+    'afm_stage_items_total', 'Items processed by each pipeline stage', ['stage']))
+SAMPLING_ATTEMPTS = REGISTRY.register(Counter(
+    'afm_markov_sampling_attempts_total', 'Markov sampling attempts by outcome', ['result']))
+LOG_WRITE_SECONDS = REGISTRY.register(Histogram(
+    'afm_log_write_seconds', 'Latency of writing a batch of log rows'))
+LOG_SUPPRESSED = REGISTRY.register(Counter(
+    'afm_log_suppressed_total', 'Log records not written individually by sampling or rate limiting',
+    ['source', 'reason']))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'afm_http_request_seconds', 'HTTP request latency', ['endpoint', 'status']))
+
+
+def observe_stage(stage, seconds, items=None):
+    """処理段階の所要時間を記録し、集計中の呼び出し元があればその内訳にも加える"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if items:
+        STAGE_ITEMS.inc(items, stage=stage)
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0) + seconds, 6)
+
+
+@contextmanager
+def timed(stage, items=None):
+    """with内の処理時間を処理段階のヒストグラムに記録"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, items)
+
+
+def timed_stage(stage):
+    """関数の実行時間を処理段階のヒストグラムに記録するデコレータ"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect_timings():
+    """このスレッドでwith内に記録された処理段階ごとの所要時間をdictに集める（ログのmetadata用）"""
+    previous = getattr(_local, 'timings', None)
+    timings = {}
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+        if previous is not None:
+            for stage, seconds in timings.items():
+                previous[stage] = round(previous.get(stage, 0) + seconds, 6)
+
+
+def gauge(name, help_text, callback, labelnames=(), aggregate='sum'):
+    return REGISTRY.register(Gauge(name, help_text, callback, labelnames, aggregate))
+
+
+def render():
+    return REGISTRY.render()
+
+
+class SnapshotWriter:
+    """REGISTRYの値を一定間隔でMETRICS_MULTIPROC_DIRに書き出すバックグラウンドスレッド"""
+
+    def __init__(self, registry=REGISTRY, interval=None):
+        self.registry = registry
+        self.interval = float(interval or os.getenv('METRICS_SNAPSHOT_INTERVAL', '5'))
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.registry.multiproc_dir or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.registry.write_snapshot()
+            except OSError:
+                pass
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            self.registry.write_snapshot()
+        except OSError:
+            pass
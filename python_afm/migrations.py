@@ -0,0 +1,42 @@
+import os
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# 複数プロセスが同時に起動しても1つずつ適用されるようにするためのロックキー
+MIGRATION_LOCK_KEY = 0x61666d01
+
+
+def apply_migrations(pool, log_manager, directory=MIGRATIONS_DIR):
+    """migrationsディレクトリ内の未適用のSQLをファイル名順に適用"""
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                        name text PRIMARY KEY,
+                        applied_at timestamp NOT NULL DEFAULT NOW()
+                    )
+                """)
+    except Exception as e:
+        log_manager.write_log("ERROR", "migrations", f"Error preparing schema_migrations: {str(e)}")
+        return False
+
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.sql'):
+            continue
+        try:
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                sql = f.read()
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                    cur.execute("SELECT 1 FROM public.schema_migrations WHERE name = %s", (filename,))
+                    if cur.fetchone():
+                        continue
+                    cur.execute(sql)
+                    cur.execute("INSERT INTO public.schema_migrations (name) VALUES (%s)", (filename,))
+            log_manager.write_log("INFO", "migrations", f"Applied migration {filename}")
+        except Exception as e:
+            # 後続のマイグレーションは前のものに依存しうるため、ここで止める
+            log_manager.write_log("ERROR", "migrations", f"Error applying migration {filename}: {str(e)}")
+            return False
+    return True
@@ -0,0 +1,31 @@
+-- 単語リスト（禁止ワード・ストップワード・ワードクラウド除外ワード）の変更を
+-- afm_word_lists チャンネルへ通知し、python_afm のキャッシュを即時に無効化する
+
+CREATE OR REPLACE FUNCTION notify_word_list_change() RETURNS trigger AS $$
+DECLARE
+    changed_key text;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_key := OLD.key;
+    ELSE
+        changed_key := NEW.key;
+    END IF;
+
+    IF TG_TABLE_NAME = 'note_text' AND changed_key IN ('forbidden', 'stop_words') THEN
+        PERFORM pg_notify('afm_word_lists', changed_key);
+    ELSIF TG_TABLE_NAME = 'memorandum' AND changed_key = 'wordcloud_forbidden' THEN
+        PERFORM pg_notify('afm_word_lists', changed_key);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS note_text_word_list_notify ON public.note_text;
+CREATE TRIGGER note_text_word_list_notify
+    AFTER INSERT OR UPDATE OR DELETE ON public.note_text
+    FOR EACH ROW EXECUTE FUNCTION notify_word_list_change();
+
+DROP TRIGGER IF EXISTS memorandum_word_list_notify ON public.memorandum;
+CREATE TRIGGER memorandum_word_list_notify
+    AFTER INSERT OR UPDATE OR DELETE ON public.memorandum
+    FOR EACH ROW EXECUTE FUNCTION notify_word_list_change();
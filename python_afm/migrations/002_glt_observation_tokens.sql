@@ -0,0 +1,7 @@
+-- 取り込み時に形態素解析した結果をノートと一緒に保存する列
+-- tokens: 表層形の並び、pos: 各表層形の品詞（'大分類,中分類'）
+-- どちらもNULLの行は読み出し時にMeCabで解析する
+
+ALTER TABLE public.glt_observation
+    ADD COLUMN IF NOT EXISTS tokens text[],
+    ADD COLUMN IF NOT EXISTS pos text[];
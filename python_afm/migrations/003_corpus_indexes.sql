@@ -0,0 +1,20 @@
+-- 学習・集計の対象になるノートかどうかを保存時に計算しておき、
+-- 対象のノートだけを含む部分インデックスで読み出す
+
+ALTER TABLE public.glt_observation
+    ADD COLUMN IF NOT EXISTS eligible boolean GENERATED ALWAYS AS (
+        post_text IS NOT NULL
+        AND length(post_text) >= 10
+        AND post_text NOT LIKE '%http%'
+        AND post_text NOT LIKE '%@%'
+    ) STORED;
+
+-- 差分取り込み（gtl_id順）とランダムサンプリングの起点検索用
+CREATE INDEX IF NOT EXISTS glt_observation_eligible_gtl_id_idx
+    ON public.glt_observation (gtl_id)
+    WHERE eligible;
+
+-- ワードクラウドの時間窓とサンプリングの投稿ペース推定用
+CREATE INDEX IF NOT EXISTS glt_observation_eligible_timestamp_idx
+    ON public.glt_observation (timestamp)
+    WHERE eligible;
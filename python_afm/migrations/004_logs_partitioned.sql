@@ -0,0 +1,101 @@
+-- logsを作成日時で日ごとにパーティション分割し、保持期間を過ぎたログは
+-- DELETEではなくパーティションごとDROPして削除する（不要タプルとVACUUMの負荷を残さない）
+
+-- 指定した日のパーティションを作成する（作成済みならfalse）
+-- 先にデフォルトパーティションに入った同じ日の行は、新しいパーティションに移してから付け替える
+CREATE OR REPLACE FUNCTION public.logs_create_partition(day date) RETURNS boolean AS $$
+DECLARE
+    partition_name text := 'logs_p' || to_char(day, 'YYYYMMDD');
+BEGIN
+    IF to_regclass('public.' || partition_name) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format('CREATE TABLE public.%I (LIKE public.logs INCLUDING DEFAULTS)', partition_name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM public.logs_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+        'INSERT INTO public.%I SELECT * FROM moved',
+        day, day + 1, partition_name);
+    EXECUTE format('ALTER TABLE public.logs ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, day, day + 1);
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 保持期間より前の日のパーティションを削除し、削除した数を返す
+CREATE OR REPLACE FUNCTION public.logs_drop_partitions(retention interval) RETURNS integer AS $$
+DECLARE
+    partition_name text;
+    dropped integer := 0;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.logs'::regclass
+          AND c.relname ~ '^logs_p[0-9]{8}$'
+    LOOP
+        -- パーティションの終わり（翌日0時）が保持期間より前なら丸ごと削除できる
+        IF to_date(substr(partition_name, 7), 'YYYYMMDD') + 1 <= (LOCALTIMESTAMP - retention)::date THEN
+            EXECUTE format('DROP TABLE public.%I', partition_name);
+            dropped := dropped + 1;
+        END IF;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    day date;
+BEGIN
+    -- 既にパーティション化されていれば何もしない
+    IF EXISTS (SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname = 'public' AND c.relname = 'logs' AND c.relkind = 'p') THEN
+        RETURN;
+    END IF;
+
+    IF to_regclass('public.logs') IS NULL THEN
+        CREATE TABLE public.logs (
+            log_id bigint NOT NULL,
+            level varchar(20) NOT NULL,
+            source varchar(255),
+            message text,
+            user_id varchar(255),
+            metadata jsonb,
+            created_at timestamp NOT NULL DEFAULT NOW()
+        ) PARTITION BY RANGE (created_at);
+    ELSE
+        ALTER TABLE public.logs RENAME TO logs_legacy;
+        -- 列の型と順序は既存のテーブルに合わせる
+        -- log_idの採番は旧テーブルのシーケンスに依存しないよう、新しいシーケンスに付け替える
+        CREATE TABLE public.logs (LIKE public.logs_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at);
+        ALTER TABLE public.logs ALTER COLUMN log_id DROP DEFAULT;
+        ALTER TABLE public.logs ALTER COLUMN created_at SET DEFAULT NOW();
+        ALTER TABLE public.logs ALTER COLUMN created_at SET NOT NULL;
+    END IF;
+
+    -- 事前に作成されていない日の行を受け止めるパーティション
+    CREATE TABLE public.logs_default PARTITION OF public.logs DEFAULT;
+
+    -- delete_logs.jsの保持期間（7日）分と、数日先までのパーティション
+    FOR day IN SELECT generate_series(CURRENT_DATE - 7, CURRENT_DATE + 3, INTERVAL '1 day')::date LOOP
+        PERFORM public.logs_create_partition(day);
+    END LOOP;
+
+    IF to_regclass('public.logs_legacy') IS NOT NULL THEN
+        -- すべての行を移す（パーティションのない古い日の行はデフォルトパーティションに入り、
+        -- 保持期間を過ぎた分はdelete_logs.jsが通常どおり削除する）
+        INSERT INTO public.logs
+        SELECT * FROM public.logs_legacy;
+        DROP TABLE public.logs_legacy;
+    END IF;
+
+    CREATE SEQUENCE IF NOT EXISTS public.logs_log_id_seq;
+    ALTER SEQUENCE public.logs_log_id_seq OWNED BY public.logs.log_id;
+    PERFORM setval('public.logs_log_id_seq', COALESCE((SELECT max(log_id) FROM public.logs), 0) + 1, false);
+    ALTER TABLE public.logs ALTER COLUMN log_id SET DEFAULT nextval('public.logs_log_id_seq');
+
+    -- パーティションキーを含む主キー（各パーティションにも同じインデックスが作られる）
+    ALTER TABLE public.logs ADD CONSTRAINT logs_pkey PRIMARY KEY (log_id, created_at);
+END;
+$$;
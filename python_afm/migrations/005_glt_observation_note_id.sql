@@ -0,0 +1,9 @@
+-- 取り込みを再送しても同じノートが重複しないよう、MisskeyのノートIDを保存する
+-- （取り込みAPIが保存後に応答できなかった場合もnode側で安全に直接保存し直せる）
+-- 既存の行はNULLのまま（一意インデックスはNULL同士を重複とみなさない）
+
+ALTER TABLE public.glt_observation
+    ADD COLUMN IF NOT EXISTS note_id text;
+
+CREATE UNIQUE INDEX IF NOT EXISTS glt_observation_note_id_key
+    ON public.glt_observation (note_id);
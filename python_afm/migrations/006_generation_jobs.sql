@@ -0,0 +1,21 @@
+-- /jobsで登録したジョブの状態と結果
+-- gunicornの複数のワーカーのどれに/jobs/<id>が届いても同じジョブを返せるよう、DBに保存する
+-- created_at・finished_atはepoch秒（JOB_RESULT_TTLを過ぎた行はpython_afmが削除する）
+
+CREATE TABLE IF NOT EXISTS public.generation_jobs (
+    job_id text PRIMARY KEY,
+    kind text NOT NULL,
+    params jsonb NOT NULL,
+    status text NOT NULL,
+    -- 結果（ワードクラウドの画像はresult_dataに分けて保存する）
+    result jsonb,
+    result_data bytea,
+    error text,
+    error_status integer,
+    joined integer NOT NULL DEFAULT 0,
+    created_at double precision NOT NULL,
+    finished_at double precision
+);
+
+CREATE INDEX IF NOT EXISTS generation_jobs_expire_idx
+    ON public.generation_jobs ((COALESCE(finished_at, created_at)));
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from collections import Counter
+from metrics import timed
+
+
+class RollingNounIndex:
+    """GTLの名詞の出現回数を時間バケットごとに集計し、任意の時間窓の頻度表を返す"""
+
+    def __init__(self, processor, log_manager, bucket_seconds=None, retention_hours=None):
+        self.processor = processor
+        self.log_manager = log_manager
+        self.bucket_seconds = int(bucket_seconds or os.getenv('NOUN_INDEX_BUCKET_SECONDS', '300'))
+        # 保持する最大の時間窓（これより古いバケットは破棄する）
+        self.retention_seconds = float(retention_hours or os.getenv('NOUN_INDEX_RETENTION_HOURS', '24')) * 3600
+        self.refresh_interval = float(os.getenv('NOUN_INDEX_REFRESH_INTERVAL', '60'))
+        self.batch_size = int(os.getenv('NOUN_INDEX_BATCH', '5000'))
+
+        # バケット開始時刻（DB時計の秒） -> 名詞の出現回数
+        self._buckets = {}
+        self.last_id = 0
+        self.indexed_notes = 0
+        # DB時計とこのプロセスの時計の差
+        self._clock_offset = None
+        # 集計済みのノートとほぼ同じノートを数えないための索引
+        self.dedup = processor.new_dedup_index()
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def now(self):
+        """DB時計での現在時刻"""
+        return time.time() + (self._clock_offset or 0)
+
+    def refresh(self):
+        """ウォーターマーク以降のノートを取り込み、保持期間を過ぎたバケットを捨てる"""
+        with self._refresh_lock, timed('noun_index_refresh'):
+            db_clock = self.processor.get_db_clock()
+            if db_clock is not None:
+                self._clock_offset = db_clock - time.time()
+
+            new_rows = 0
+            while True:
+                rows = self.processor.get_observations_after(self.last_id, self.retention_seconds, self.batch_size)
+                if not rows:
+                    break
+                # 形態素解析はロックの外で行い、集計結果だけをまとめて反映する
+                batch = {}
+                # 取り込み時に保存された解析結果があるノートはMeCabを通さない
+                nouns_per_row = self.processor.extract_noun_candidates_many([row[1] for row in rows],
+                                                                            [row[3] for row in rows],
+                                                                            dedup=self.dedup)
+                for (gtl_id, text, posted_at, _), nouns in zip(rows, nouns_per_row):
+                    if nouns:
+                        bucket = int(posted_at) // self.bucket_seconds * self.bucket_seconds
+                        batch.setdefault(bucket, Counter()).update(nouns)
+                with self._lock:
+                    for bucket, counts in batch.items():
+                        self._buckets.setdefault(bucket, Counter()).update(counts)
+                self.last_id = rows[-1][0]
+                self.indexed_notes += len(rows)
+                new_rows += len(rows)
+                if len(rows) < self.batch_size:
+                    break
+
+            with self._lock:
+                self._expire()
+            return new_rows
+
+    def _expire(self):
+        cutoff = self.now() - self.retention_seconds - self.bucket_seconds
+        for bucket in [b for b in self._buckets if b < cutoff]:
+            del self._buckets[bucket]
+
+    def frequencies(self, window_seconds):
+        """直近window_seconds秒に含まれるバケットの合計（単語リストによる除外前）"""
+        window_seconds = min(window_seconds, self.retention_seconds)
+        cutoff = self.now() - window_seconds
+        total = Counter()
+        with self._lock:
+            for bucket, counts in self._buckets.items():
+                if bucket + self.bucket_seconds > cutoff:
+                    total.update(counts)
+        return total
+
+    def start(self):
+        """バックグラウンドでの定期取り込みを開始"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='noun-index-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log_manager.write_log("ERROR", "RollingNounIndex", f"Error refreshing noun index: {str(e)}")
+
+    def stats(self):
+        return {
+            'buckets': len(self._buckets),
+            'bucket_seconds': self.bucket_seconds,
+            'retention_seconds': self.retention_seconds,
+            'last_id': self.last_id,
+            'indexed_notes': self.indexed_notes,
+            'dedup': self.dedup.stats() if self.dedup is not None else None
+        }
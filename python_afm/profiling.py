@@ -0,0 +1,244 @@
+import io
+import os
+import sys
+import hmac
+import time
+import marshal
+import functools
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+# 一度に要求できる上限（誤って本番で長時間動かし続けないため）
+MAX_REQUESTS = int(os.getenv('PROFILE_MAX_REQUESTS', '100'))
+MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '120'))
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """sys._current_frames()を一定間隔で読み、全スレッドのスタックをcollapsed形式で集計する"""
+
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self, on_finish):
+        self._thread = threading.Thread(target=self._run, args=(on_finish,), name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self, on_finish):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self._stop_event.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            self._stop_event.wait(self.interval)
+        on_finish(self)
+
+    def collapsed(self):
+        """flamegraph.plやspeedscopeで読めるcollapsed stack形式"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+
+class Profiler:
+    """管理者トークン付きのリクエストでだけ有効になるプロファイラ
+
+    無効な間は各リクエストで属性を1つ確認するだけで、計測は行わない。
+    """
+
+    def __init__(self, admin_token=None):
+        self.admin_token = admin_token if admin_token is not None else os.getenv('PROFILE_ADMIN_TOKEN', '')
+        self._lock = threading.Lock()
+        # 計測対象として残っているリクエスト数（0なら無効）
+        self.remaining = 0
+        self._stats = None
+        self._session = None
+        self._sampler = None
+        self._sample_session = None
+        self._snapshot = None
+        self.result = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.admin_token)
+
+    def authorize(self, token):
+        return self.enabled and token is not None and hmac.compare_digest(token, self.admin_token)
+
+    # --- 次のN件のリクエストをcProfileで計測 ---
+
+    def profile_requests(self, count):
+        count = max(1, min(int(count), MAX_REQUESTS))
+        with self._lock:
+            self._stats = None
+            self._session = {'mode': 'requests', 'requested': count, 'profiled': 0, 'skipped': 0,
+                             'started_at': time.time()}
+            self.remaining = count
+        return dict(self._session)
+
+    def begin(self):
+        """リクエストまたはジョブの処理開始時に呼ぶ"""
+        if not self.remaining:
+            return
+        self._local.active = True
+        self._local.profile = None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12以降は同時に1つしか有効にできない（有効なものが全スレッドを計測している）
+            with self._lock:
+                if self._session is not None:
+                    self._session['skipped'] += 1
+            return
+        self._local.profile = profile
+
+    def end(self, count_request=True):
+        """begin()と同じスレッドで処理の終了時に呼ぶ"""
+        if not getattr(self._local, 'active', False):
+            return
+        self._local.active = False
+        profile = self._local.profile
+        self._local.profile = None
+        if profile is not None:
+            profile.disable()
+            with self._lock:
+                if self._session is not None:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+                    self._session['profiled'] += 1
+        if count_request:
+            self._count_request()
+
+    def _count_request(self):
+        with self._lock:
+            if not self.remaining:
+                return
+            self.remaining -= 1
+            if self.remaining == 0 and self._session is not None:
+                self._finish_requests()
+
+    def _finish_requests(self):
+        session = self._session
+        session['finished_at'] = time.time()
+        self.result = {'session': dict(session), 'stats': self._stats}
+        self._session = None
+        self._stats = None
+
+    def wrap(self, func):
+        """ジョブの実行関数など、リクエストとは別のスレッドで動く処理も計測対象にする"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.remaining:
+                return func(*args, **kwargs)
+            self.begin()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.end(count_request=False)
+        return wrapper
+
+    # --- 一定時間スタックをサンプリング ---
+
+    def sample(self, seconds, interval=0.01):
+        seconds = max(0.1, min(float(seconds), MAX_SECONDS))
+        interval = max(0.001, float(interval))
+        with self._lock:
+            if self._sampler is not None:
+                raise RuntimeError("Stack sampling is already running")
+            self._sampler = StackSampler(seconds, interval)
+            session = {'mode': 'sample', 'seconds': seconds, 'interval': interval, 'started_at': time.time()}
+            self._sample_session = session
+        self._sampler.start(self._finish_sample)
+        return dict(session)
+
+    def _finish_sample(self, sampler):
+        with self._lock:
+            session = dict(self._sample_session, finished_at=time.time(), samples=sampler.samples)
+            self.result = {'session': session, 'collapsed': sampler.collapsed()}
+            self._sampler = None
+
+    # --- tracemallocによるメモリの増分 ---
+
+    def tracemalloc_start(self, frames=25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(int(frames))
+        self._snapshot = tracemalloc.take_snapshot()
+        return {'mode': 'tracemalloc', 'tracing': True, 'frames': tracemalloc.get_traceback_limit()}
+
+    def tracemalloc_snapshot(self, limit=30):
+        """前回のスナップショットからの増分を行番号ごとに集計する"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not running")
+        snapshot = tracemalloc.take_snapshot()
+        previous = self._snapshot
+        self._snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        if previous is None:
+            lines = [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        else:
+            lines = [str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:limit]]
+        return {'mode': 'tracemalloc', 'traced_bytes': current, 'peak_bytes': peak, 'top': lines}
+
+    def tracemalloc_stop(self):
+        tracemalloc.stop()
+        self._snapshot = None
+        return {'mode': 'tracemalloc', 'tracing': False}
+
+    # --- 結果の取得 ---
+
+    def status(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'requests': dict(self._session, remaining=self.remaining) if self._session else None,
+                'sampling': self._sampler is not None,
+                'tracemalloc': tracemalloc.is_tracing(),
+                'result': self.result['session'] if self.result else None
+            }
+
+    def render_result(self, result_format='text', sort='cumulative', limit=50):
+        """(本体, MIMEタイプ, ファイル名) を返す。結果がなければNone"""
+        result = self.result
+        if result is None:
+            return None
+        if 'collapsed' in result:
+            return result['collapsed'].encode('utf-8'), 'text/plain; charset=utf-8', 'profile.collapsed'
+        stats = result['stats']
+        if stats is None:
+            return b'', 'text/plain; charset=utf-8', 'profile.txt'
+        if result_format == 'pstats':
+            # pstats.Stats(ファイル名)やsnakevizでそのまま読める形式
+            return marshal.dumps(stats.stats), 'application/octet-stream', 'profile.pstats'
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            sort = 'cumulative'
+        stream = io.StringIO()
+        view = pstats.Stats(stream=stream)
+        view.add(stats)
+        view.sort_stats(sort).print_stats(limit)
+        return stream.getvalue().encode('utf-8'), 'text/plain; charset=utf-8', 'profile.txt'
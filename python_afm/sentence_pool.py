@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+from collections import deque
+
+
+class SentencePool:
+    """検証済みのマルコフ文をあらかじめ生成して蓄え、リクエスト時は取り出すだけにする"""
+
+    def __init__(self, markov_store, processor, log_manager, size=None, low_watermark=None, max_age=None,
+                 recent_size=None):
+        self.markov_store = markov_store
+        self.processor = processor
+        self.log_manager = log_manager
+        self.size = int(size or os.getenv('SENTENCE_POOL_SIZE', '50'))
+        # 在庫がこの数を下回ったら補充を始める
+        self.low_watermark = int(low_watermark or os.getenv('SENTENCE_POOL_LOW_WATERMARK', str(self.size // 2)))
+        # 生成からこの秒数を過ぎた文は捨てる（モデルの更新を反映させるため）
+        self.max_age = float(max_age or os.getenv('SENTENCE_POOL_MAX_AGE', '1800'))
+        # 直近に返した文をこの件数だけ覚えておき、同じ文を繰り返さない
+        self.recent_size = int(recent_size or os.getenv('SENTENCE_POOL_RECENT', '200'))
+        self.refill_interval = float(os.getenv('SENTENCE_POOL_REFILL_INTERVAL', '30'))
+        # 1回の補充で試す最大回数（在庫の空き1件あたり）
+        self.max_attempts_per_slot = int(os.getenv('SENTENCE_POOL_MAX_ATTEMPTS', '20'))
+
+        # (文, 生成時刻, 確認に使った禁止ワードの版)
+        self._pool = deque()
+        self._pooled = set()
+        self._recent = deque()
+        self._recent_set = set()
+
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        self._refill_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._stats = {
+            'served': 0,
+            'fallbacks': 0,
+            'generated': 0,
+            'rejected': 0,
+            'duplicates': 0,
+            'expired': 0,
+            'refills': 0
+        }
+        self.last_refill_at = None
+        self.last_refill_rate = None
+
+    def _remember(self, sentence):
+        self._recent.append(sentence)
+        self._recent_set.add(sentence)
+        while len(self._recent) > self.recent_size:
+            self._recent_set.discard(self._recent.popleft())
+
+    def _is_duplicate(self, sentence):
+        return sentence in self._pooled or sentence in self._recent_set
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+        while self._pool and self._pool[0][1] < cutoff:
+            sentence = self._pool.popleft()[0]
+            self._pooled.discard(sentence)
+            self._stats['expired'] += 1
+
+    def _recheck_forbidden(self, text_filter, version):
+        """禁止ワードの更新前に確認した在庫の文をまとめて確認し直し、禁止ワードを含む文を捨てる（ロック内で呼ぶ）"""
+        entries = list(self._pool)
+        stale = [i for i, entry in enumerate(entries) if entry[2] != version]
+        if not stale:
+            return
+        clean = {stale[j] for j in text_filter.filter_forbidden([entries[i][0] for i in stale])}
+        self._pool = deque()
+        for i, (sentence, created_at, checked) in enumerate(entries):
+            if checked == version or i in clean:
+                self._pool.append((sentence, created_at, version))
+            else:
+                self._pooled.discard(sentence)
+                self._stats['rejected'] += 1
+
+    def pop(self):
+        """在庫から文を1つ取り出す。空の場合はその場で生成する"""
+        # 版を先に読むため、フィルタは記録する版と同じかより新しい
+        version = self.processor.word_lists.version('forbidden')
+        text_filter = self.processor.text_filter
+        sentence = None
+        with self._lock:
+            self._expire()
+            # 在庫に入れた後で禁止ワードが追加された場合に備えて再確認する
+            self._recheck_forbidden(text_filter, version)
+            if self._pool:
+                sentence = self._pool.popleft()[0]
+                self._pooled.discard(sentence)
+            depth = len(self._pool)
+
+        if depth < self.low_watermark:
+            self._refill_event.set()
+
+        if sentence is None:
+            # 在庫切れの場合は従来どおりその場で生成する
+            self._stats['fallbacks'] += 1
+            sentence = self.markov_store.generate()
+
+        with self._lock:
+            self._remember(sentence)
+            self._stats['served'] += 1
+        return sentence
+
+    def refill(self):
+        """在庫が上限に達するまで検証済みの文を生成して追加する"""
+        with self._refill_lock:
+            if not self.markov_store.ready:
+                return 0
+            model = self.markov_store.model
+            with self._lock:
+                self._expire()
+                missing = self.size - len(self._pool)
+            if missing <= 0:
+                return 0
+
+            added = 0
+            started = time.monotonic()
+            for _ in range(missing * self.max_attempts_per_slot):
+                if added >= missing or self._stop_event.is_set():
+                    break
+                version = self.processor.word_lists.version('forbidden')
+                try:
+                    sentence = self.processor.try_sample_markov_text(model)
+                except Exception:
+                    sentence = None
+                if sentence is None:
+                    self._stats['rejected'] += 1
+                    continue
+                with self._lock:
+                    if self._is_duplicate(sentence):
+                        self._stats['duplicates'] += 1
+                        continue
+                    self._pool.append((sentence, time.time(), version))
+                    self._pooled.add(sentence)
+                added += 1
+
+            elapsed = time.monotonic() - started
+            self._stats['generated'] += added
+            self._stats['refills'] += 1
+            self.last_refill_at = time.time()
+            self.last_refill_rate = added / elapsed if elapsed > 0 else None
+            if added < missing:
+                self.log_manager.write_log("WARNING", "SentencePool", "Could not fill the sentence pool",
+                                           metadata={'added': added, 'missing': missing})
+            return added
+
+    def start(self):
+        """バックグラウンドでの補充を開始"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._refill_event.set()
+        self._thread = threading.Thread(target=self._run, name='sentence-pool-refill', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._refill_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._refill_event.wait(self.refill_interval)
+            self._refill_event.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.refill()
+            except Exception as e:
+                self.log_manager.write_log("ERROR", "SentencePool", f"Error refilling sentence pool: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            depth = len(self._pool)
+            oldest = time.time() - self._pool[0][1] if self._pool else None
+        return {
+            'depth': depth,
+            'size': self.size,
+            'low_watermark': self.low_watermark,
+            'max_age': self.max_age,
+            'oldest_age': oldest,
+            'recent': len(self._recent),
+            'last_refill_at': self.last_refill_at,
+            'refill_rate': self.last_refill_rate,
+            **self._stats
+        }
@@ -0,0 +1,15 @@
+import os
+import sys
+import pytest
+
+# python_afmのモジュールはパッケージではなく同じディレクトリから読み込む
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_db():
+    """db_poolの接続をメモリ上のDB（benchmarks.fakedb）に差し替える"""
+    from benchmarks.fakedb import FakeDatabase
+    db = FakeDatabase().install()
+    yield db
+    db.uninstall()
@@ -0,0 +1,44 @@
+import pytest
+from db_pool import get_pool
+
+DB_PARAMS = {'dbname': 'test_db_pool'}
+
+
+def _stream(pool, rows):
+    """iter_texts_afterと同じく、接続を借りたままyieldするジェネレータ"""
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        yield from rows
+
+
+def test_connection_returned_when_generator_closed_early(fake_db):
+    pool = get_pool(DB_PARAMS)
+    for _ in range(3):
+        stream = _stream(pool, range(10))
+        assert next(stream) == 0
+        # 読み出し側の失敗（WorkerTimeoutErrorなど）で途中で捨てられた場合
+        stream.close()
+    assert pool.stats()['in_use'] == 0
+
+
+def test_connection_returned_on_exception(fake_db):
+    pool = get_pool(DB_PARAMS)
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            raise RuntimeError('failed')
+    assert pool.stats()['in_use'] == 0
+
+
+def test_iter_texts_after_closed_early_releases_connection(fake_db):
+    from text_processor import TextProcessor
+    for i in range(1, 21):
+        fake_db.add_observation(f'テスト用のノートその{i}です')
+    processor = TextProcessor(DB_PARAMS)
+    try:
+        rows = processor.iter_texts_after(0, itersize=5)
+        next(rows)
+        rows.close()
+        assert processor.pool.stats()['in_use'] == 0
+    finally:
+        processor.log_manager.close()
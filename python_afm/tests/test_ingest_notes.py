@@ -0,0 +1,65 @@
+import types
+import pytest
+import main
+from text_processor import TextProcessor
+
+
+class _Logs:
+    def __init__(self):
+        self.records = []
+
+    def write_log(self, level, source, message, metadata=None):
+        self.records.append((level, source, message, metadata))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    stored = []
+
+    def ingest_notes(rows):
+        stored.extend(rows)
+        return list(range(1, len(rows) + 1))
+
+    monkeypatch.setattr(main, 'processor', types.SimpleNamespace(ingest_notes=ingest_notes))
+    monkeypatch.setattr(main, 'log_manager', _Logs())
+    client = main.app.test_client()
+    client.stored = stored
+    return client
+
+
+def test_renote_without_text_is_accepted(client):
+    response = client.post('/ingest/notes', json={'notes': [
+        {'note_id': 'a1', 'user_name': 'u', 'instance_name': None, 'text': None},
+        {'note_id': 'a2', 'user_name': 'u', 'instance_name': 'example.com', 'text': 'こんにちは'}
+    ]})
+    assert response.status_code == 200
+    assert response.get_json()['ingested'] == 2
+    assert [row['text'] for row in client.stored] == [None, 'こんにちは']
+
+
+def test_invalid_notes_are_rejected_individually(client):
+    response = client.post('/ingest/notes', json={'notes': [
+        {'note_id': 'b1', 'text': 123},
+        'not a note',
+        {'note_id': 'b3', 'text': '保存される'},
+        {'note_id': 4, 'text': 'note_idが数値'}
+    ]})
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body['ingested'] == 1
+    assert [r['index'] for r in body['rejected']] == [0, 1, 3]
+    assert body['rejected'][0]['note_id'] == 'b1'
+    assert [row['note_id'] for row in client.stored] == ['b3']
+
+
+def test_processor_stores_null_text_without_parsing(fake_db):
+    processor = TextProcessor({'dbname': 'test_ingest'}, log_manager=_Logs())
+    gtl_ids = processor.ingest_notes([
+        {'note_id': 'c1', 'user_name': 'u', 'instance_name': None, 'text': None},
+        {'note_id': 'c2', 'user_name': 'u', 'instance_name': None, 'text': '今日はとても良い天気でした'}
+    ])
+    assert len(gtl_ids) == 2
+    renote, note = fake_db.observations
+    # (gtl_id, text, timestamp, tokens, pos, user_name, instance_name)
+    assert renote[1] is None and renote[3] is None and renote[4] is None
+    assert note[3] and note[4]
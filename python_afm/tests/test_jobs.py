@@ -0,0 +1,43 @@
+from jobs import JobManager, JobStore
+from db_pool import get_pool
+
+DB_PARAMS = {'dbname': 'test_jobs'}
+
+
+class _Logs:
+    def write_log(self, level, source, message, metadata=None):
+        if level == 'ERROR':
+            raise AssertionError(message)
+
+
+def _manager():
+    runners = {'wordcloud': lambda params: {'data': b'\x89PNG', 'mimetype': 'image/png', 'format': 'png'}}
+    logs = _Logs()
+    return JobManager(runners, logs, max_workers=1, store=JobStore(get_pool(DB_PARAMS), logs))
+
+
+def test_job_is_visible_from_another_worker(fake_db):
+    # 2つのgunicornワーカーは同じDBを見る別々のJobManagerを持つ
+    first, second = _manager(), _manager()
+    try:
+        job = first.run('wordcloud', {'hours': 4}, timeout=5)
+        assert job.status == 'succeeded'
+
+        found = second.get(job.id)
+        assert found.status == 'succeeded'
+        assert 'data' in found.result and found.to_dict()['result'] == {'mimetype': 'image/png', 'format': 'png'}
+        assert second.get(job.id, with_data=True).result['data'] == b'\x89PNG'
+        assert second.get('missing') is None
+    finally:
+        first.shutdown()
+        second.shutdown()
+
+
+def test_expired_jobs_are_deleted(fake_db):
+    manager = _manager()
+    try:
+        job = manager.run('wordcloud', {'hours': 4}, timeout=5)
+        manager.store.delete_expired(job.finished_at + 1)
+        assert manager.store.load(job.id) is None
+    finally:
+        manager.shutdown()
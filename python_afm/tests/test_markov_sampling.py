@@ -0,0 +1,44 @@
+import markovify
+import pytest
+from benchmarks.fakedb import FakeDatabase
+from text_processor import TextProcessor
+
+FORBIDDEN = '禁止'
+
+LINES = [
+    '今日 は とても 良い 天気 です ね 。',
+    '今日 は 禁止 の 話題 です ね 。',
+    '明日 は とても 暑い 天気 に なり そう です 。',
+    '明日 は 禁止 され た 場所 に 行き ます 。',
+    '昨日 は とても 寒い 一日 でし た ね 。',
+]
+
+
+class _Logs:
+    def write_log(self, level, source, message, metadata=None):
+        pass
+
+
+@pytest.fixture
+def processor():
+    db = FakeDatabase(forbidden_words=[FORBIDDEN]).install()
+    try:
+        yield TextProcessor({'dbname': 'test_markov_sampling'}, log_manager=_Logs())
+    finally:
+        db.uninstall()
+
+
+def test_markovify_model_is_sampled_with_constraints(processor):
+    model = markovify.NewlineText('\n'.join(LINES * 20), state_size=2, retain_original=False)
+    results = [processor.sample_markov_text(model) for _ in range(30)]
+    assert all(FORBIDDEN not in result for result in results)
+    # 変換はモデルごとに1回だけ行う
+    assert processor._converted[0] is model
+
+
+def test_no_fallback_to_forbidden_text(processor):
+    # 禁止ワードを避けられないモデルでも、禁止ワードを含む文章は返さずに失敗する
+    model = markovify.NewlineText('\n'.join(['禁止 禁止 禁止 禁止 禁止 禁止 。'] * 20), state_size=2,
+                                  retain_original=False)
+    with pytest.raises(RuntimeError):
+        processor.sample_markov_text(model)
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def _registry(directory, gauge_value):
+    registry = Registry(str(directory))
+    counter = registry.register(Counter('test_total', 'test', ['kind']))
+    histogram = registry.register(Histogram('test_seconds', 'test', buckets=(1.0,)))
+    registry.register(Gauge('test_depth', 'test', lambda: gauge_value))
+    registry.register(Gauge('test_rows', 'test', lambda: gauge_value, aggregate='max'))
+    return registry, counter, histogram
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def _write(directory, pid, registry):
+    # 別のワーカーが書き出したファイルとして保存する
+    snapshot = {'pid': pid, 'metrics': {metric.name: [[list(k), v] for k, v in metric.collect().items()]
+                                        for metric in registry._list()}}
+    with open(os.path.join(directory, f'{pid}.json'), 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+
+
+def test_render_merges_other_workers(tmp_path):
+    other, other_counter, other_histogram = _registry(tmp_path, 3)
+    other_counter.inc(2, kind='a')
+    other_histogram.observe(0.5)
+    _write(tmp_path, os.getppid(), other)
+
+    registry, counter, histogram = _registry(tmp_path, 5)
+    counter.inc(kind='a')
+    counter.inc(kind='b')
+    histogram.observe(2.0)
+    output = registry.render()
+
+    assert 'test_total{kind="a"} 3' in output
+    assert 'test_total{kind="b"} 1' in output
+    assert 'test_seconds_bucket{le="1.0"} 1' in output
+    assert 'test_seconds_count 2' in output
+    assert 'test_depth 8' in output
+    assert 'test_rows 5' in output
+
+
+def test_counters_of_exited_workers_are_kept(tmp_path):
+    other, other_counter, _ = _registry(tmp_path, 3)
+    other_counter.inc(4, kind='a')
+    _write(tmp_path, _dead_pid(), other)
+
+    registry, _, _ = _registry(tmp_path, 5)
+    output = registry.render()
+    assert 'test_total{kind="a"} 4' in output
+    # 終了したワーカーのゲージは数えない
+    assert 'test_depth 5' in output
+
+
+def test_snapshot_roundtrip_and_reset(tmp_path):
+    registry, counter, _ = _registry(tmp_path, 1)
+    counter.inc(kind='a')
+    assert registry.write_snapshot()
+    registry.reset()
+    # 自分のファイルは読まずに現在の値を使う
+    assert 'test_total{kind="a"}' not in registry.render()
+    registry.clear_snapshots()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,104 @@
+"""コーパス用クエリの実行計画の確認
+
+実際のPostgreSQLでの確認は、捨ててよいデータベースをTEST_POSTGRES_DSNに指定したときだけ行う
+（マイグレーションを適用し、glt_observationに行を追加する）。
+"""
+import os
+import pytest
+import corpus_sampler
+from corpus_sampler import ELIGIBLE_INDEXES, PLAN_CHECKS, _scan_indexes, check_query_plans, query_plan_indexes
+
+# マイグレーションが前提にしている、このリポジトリの外で作成されるテーブル
+BASE_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS public.glt_observation (
+        gtl_id bigserial PRIMARY KEY,
+        user_name text,
+        instance_name text,
+        post_text text,
+        timestamp timestamp NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS public.note_text (key text PRIMARY KEY, value text);
+    CREATE TABLE IF NOT EXISTS public.memorandum (key text PRIMARY KEY, value text);
+"""
+
+
+def _index_scan(index):
+    return {'Node Type': 'Index Scan', 'Relation Name': 'glt_observation', 'Index Name': index}
+
+
+class _Logs:
+    def write_log(self, level, source, message, metadata=None):
+        if level == 'ERROR':
+            raise AssertionError(message)
+
+
+def test_scan_indexes_reads_nested_and_bitmap_plans():
+    plan = {'Node Type': 'Nested Loop', 'Plans': [
+        {'Node Type': 'Function Scan'},
+        {'Node Type': 'Limit', 'Plans': [_index_scan('glt_observation_eligible_gtl_id_idx')]},
+        {'Node Type': 'Bitmap Heap Scan', 'Relation Name': 'glt_observation', 'Plans': [
+            {'Node Type': 'Bitmap Index Scan', 'Index Name': 'glt_observation_eligible_timestamp_idx'}
+        ]},
+        {'Node Type': 'Seq Scan', 'Relation Name': 'glt_observation'}
+    ]}
+    assert _scan_indexes(plan) == ['glt_observation_eligible_gtl_id_idx',
+                                   'glt_observation_eligible_timestamp_idx', None]
+
+
+def test_primary_key_scan_is_reported(monkeypatch):
+    # enable_seqscan=offで主キーのインデックスに逃げた計画は問題として報告する
+    monkeypatch.setattr(corpus_sampler, 'query_plan_indexes', lambda conn: {
+        'texts_after': ['glt_observation_eligible_gtl_id_idx'],
+        'observations_after': ['glt_observation_pkey'],
+        'corpus_bounds': [None],
+        'pivot_sample': 'relation does not exist'
+    })
+    assert set(check_query_plans(None)) == {'observations_after', 'corpus_bounds', 'pivot_sample'}
+
+
+@pytest.fixture(scope='module')
+def postgres():
+    dsn = os.getenv('TEST_POSTGRES_DSN')
+    if not dsn:
+        pytest.skip('TEST_POSTGRES_DSNが未設定')
+    import psycopg2
+    try:
+        conn = psycopg2.connect(dsn)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'PostgreSQLに接続できない: {e}')
+    try:
+        with conn.cursor() as cur:
+            cur.execute(BASE_SCHEMA_SQL)
+        conn.commit()
+
+        from db_pool import ConnectionPool
+        from migrations import apply_migrations
+        pool = ConnectionPool({'dsn': dsn}, max_size=2)
+        try:
+            assert apply_migrations(pool, _Logs())
+        finally:
+            pool.closeall()
+
+        with conn.cursor() as cur:
+            # 対象外の行（URLを含む・短い）も混ぜ、部分インデックスの方が安く見積もられる量にする
+            cur.execute("""
+                INSERT INTO public.glt_observation (post_text, timestamp)
+                SELECT CASE WHEN i % 3 = 0 THEN 'https://example.com/' || i
+                            WHEN i % 3 = 1 THEN '短い'
+                            ELSE '実行計画の確認に使うノートです' || i END,
+                       NOW() - (i || ' seconds')::interval
+                FROM generate_series(1, 5000) AS i
+            """)
+            cur.execute("ANALYZE public.glt_observation")
+        conn.commit()
+        yield conn
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('name', list(PLAN_CHECKS))
+def test_queries_use_eligible_indexes(postgres, name):
+    indexes = query_plan_indexes(postgres)[name]
+    assert isinstance(indexes, list) and indexes, indexes
+    for index in indexes:
+        assert index in ELIGIBLE_INDEXES, f'{name}: {indexes}'
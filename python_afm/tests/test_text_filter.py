@@ -0,0 +1,41 @@
+import random
+import re
+from text_filter import (TextFilter, CHINESE_CHARS, RULE_FORBIDDEN, RULE_CHINESE, RULE_LINK,
+                         RULE_ALNUM_TOKEN)
+
+ALNUM_TOKEN = re.compile(r'(?:^|\s)[a-zA-Z0-9]+(?=\s|$)')
+
+
+def _random_texts(rng, count, alphabet):
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) for _ in range(count)]
+
+
+def test_scan_matches_per_rule_checks():
+    rng = random.Random(0)
+    alphabet = list('あいうえおかきくけこ') + CHINESE_CHARS[:3] + list('ab1 @htp')
+    words = sorted({''.join(rng.choice('あいうえおかきくけこ') for _ in range(rng.randint(2, 4))) for _ in range(200)})
+    text_filter = TextFilter(words)
+    for text in _random_texts(rng, 2000, alphabet):
+        assert bool(text_filter.scan(text, RULE_FORBIDDEN)) == any(word in text for word in words)
+        assert bool(text_filter.scan(text, RULE_CHINESE)) == any(char in text for char in CHINESE_CHARS)
+        assert bool(text_filter.scan(text, RULE_LINK)) == ('http' in text or '@' in text)
+        # 分かち書きされたテキストでは、禁止ワードは空白を除いた文字列と照合する
+        tokenized = text_filter.scan(text, RULE_FORBIDDEN | RULE_ALNUM_TOKEN, tokenized=True)
+        expected = any(word in text.replace(' ', '') for word in words) or ALNUM_TOKEN.search(text) is not None
+        assert bool(tokenized) == expected
+
+
+def test_is_valid_output():
+    text_filter = TextFilter(['だめ'])
+    assert text_filter.is_valid_output('今日 は とても 良い 天気 でし た')
+    assert not text_filter.is_valid_output('今日 は だ め な 天気 でし た')
+    assert not text_filter.is_valid_output('今日 は abc な 天気 でし た')
+    assert not text_filter.is_valid_output('今日 は 你 の 天気 でし た')
+    assert not text_filter.is_valid_output('短い 文')
+
+
+def test_filter_corpus_returns_positions():
+    text_filter = TextFilter(['だめ'])
+    texts = ['今日は良い天気でしたね', None, 'https://example.com を見てね', '短い', '今日はだめな天気でしたね']
+    assert text_filter.filter_corpus(texts) == [0, 4]
+    assert text_filter.filter_forbidden(texts) == [0, 2, 3]
@@ -0,0 +1,21 @@
+import types
+import pytest
+import main
+from jobs import JobError
+
+
+@pytest.fixture
+def retention_24h(monkeypatch):
+    monkeypatch.setattr(main, 'noun_index', types.SimpleNamespace(retention_seconds=24 * 3600))
+
+
+def test_hours_within_retention(retention_24h):
+    assert main.normalize_wordcloud_params({'hours': '24'})['hours'] == 24
+
+
+@pytest.mark.parametrize('hours', ['0', '-1', 'abc', '24.5', '48'])
+def test_hours_out_of_range_is_rejected(retention_24h, hours):
+    # 保持期間を超える指定は黙って24時間に縮めず400を返す
+    with pytest.raises(JobError) as exc:
+        main.normalize_wordcloud_params({'hours': hours})
+    assert exc.value.status == 400
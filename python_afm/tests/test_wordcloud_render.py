@@ -0,0 +1,27 @@
+import hashlib
+import pytest
+from wordcloud_render import WordCloudRenderer
+
+pytest.importorskip('wordcloud')
+
+
+@pytest.fixture
+def renderer():
+    renderer = WordCloudRenderer()
+    try:
+        renderer.font_path
+    except FileNotFoundError:
+        pytest.skip('フォントがない環境では描画できない')
+    return renderer
+
+
+def test_etag_is_hash_of_rendered_bytes(renderer):
+    rendered = renderer.render({'りんご': 5, 'みかん': 3, 'ぶどう': 1})
+    assert rendered['etag'] == hashlib.sha256(rendered['data']).hexdigest()[:32]
+
+
+def test_etag_differs_when_image_differs(renderer):
+    # 入力の頻度表が同じでも除外ワードで描画される単語が変われば、ETagも変わる
+    first = renderer.render({'りんご': 5, 'みかん': 3, 'ぶどう': 1})
+    second = renderer.render({'りんご': 5, 'みかん': 3})
+    assert first['etag'] != second['etag']
@@ -0,0 +1,286 @@
+import re
+import time
+from collections import deque
+
+# 中国語特有の文字（日本語の文章にはまず現れないもの）
+CHINESE_CHARS = ['读', '难', '书', '说', '谢', '对', '话', '吗', '吧', '们', '这', '你', '她', '很', '给']
+# ワードクラウドの単語に含まれていたら除外する記号
+WORDCLOUD_PUNCTUATION = '！？。、．，…‥：；｜＆＊（）［］｛｝「」『』【】＜＞〈〉《》〔〕・＋－＝／＼～①②③④⑤⑥⑦⑧⑨⑩'
+# URL・メンションを含むとみなす部分文字列（DB側のeligible列と同じ条件）
+LINK_MARKERS = ('http', '@')
+
+# TextFilter.scanで判定する規則（ビットの組み合わせで指定する）
+RULE_FORBIDDEN = 1
+RULE_CHINESE = 2
+RULE_LINK = 4
+# 分かち書きされたテキスト中の英数字のみの単語
+RULE_ALNUM_TOKEN = 8
+# 学習・集計に使わないテキストの規則
+CORPUS_RULES = RULE_LINK | RULE_CHINESE
+
+_ALNUM_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+
+class AhoCorasick:
+    """複数の単語の部分一致を、テキストを1回走査するだけで検出するオートマトン"""
+
+    # 単語数が少ないうちは組み込みの部分文字列検索を並べた方が速い
+    LINEAR_SCAN_THRESHOLD = 64
+
+    def __init__(self, patterns):
+        # 単語 -> 規則のビット（単語のリストなら全て1）
+        tags = patterns if isinstance(patterns, dict) else dict.fromkeys(patterns, 1)
+        tags = {p: tag for p, tag in tags.items() if p}
+        self.patterns = sorted(tags)
+        self._goto = [{}]
+        self._fail = [0]
+        # その状態に到達した時点で一致している単語（失敗遷移先の一致も含む）
+        self._output = [None]
+        # その状態に到達した時点で一致している単語の規則のビットの和（失敗遷移先の分も含む）
+        self._tags = [0]
+
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._tags.append(0)
+                state = next_state
+            self._output[state] = pattern
+            self._tags[state] |= tags[pattern]
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+                self._tags[next_state] |= self._tags[self._fail[next_state]]
+
+    def step(self, state, char):
+        """1文字進めた後の状態を返す"""
+        goto = self._goto
+        fail = self._fail
+        while True:
+            next_state = goto[state].get(char)
+            if next_state is not None:
+                return next_state
+            if state == 0:
+                return 0
+            state = fail[state]
+
+    def match_at(self, state):
+        """その状態で一致している単語（なければNone）"""
+        return self._output[state]
+
+    def search(self, text):
+        """最初に一致した単語を返す（なければNone）"""
+        if len(self.patterns) <= self.LINEAR_SCAN_THRESHOLD:
+            for pattern in self.patterns:
+                if pattern in text:
+                    return pattern
+            return None
+        state = 0
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        for char in text:
+            while True:
+                next_state = goto[state].get(char)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            if output[state] is not None:
+                return output[state]
+        return None
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class TextFilter:
+    """コーパスの掃除と生成結果の検証に使うフィルタ規則をまとめて事前コンパイルしたもの
+
+    禁止ワード・中国語の文字・URLとメンションは1つのオートマトンにまとめてあり、
+    scan()はテキストを1回走査するだけで指定した規則をすべて判定する。
+    """
+
+    def __init__(self, forbidden_words=(), chinese_chars=CHINESE_CHARS, punctuation=WORDCLOUD_PUNCTUATION):
+        # 禁止ワードだけのオートマトン（compactエンジンの生成中の照合にも使う）
+        self.forbidden = AhoCorasick(forbidden_words)
+        rules = {}
+        for char in chinese_chars:
+            rules[char] = rules.get(char, 0) | RULE_CHINESE
+        for marker in LINK_MARKERS:
+            rules[marker] = rules.get(marker, 0) | RULE_LINK
+        for word in forbidden_words:
+            if word:
+                rules[word] = rules.get(word, 0) | RULE_FORBIDDEN
+        self._rules = AhoCorasick(rules)
+        self.chinese_chars = frozenset(chinese_chars)
+        self._chinese_re = re.compile('[' + re.escape(''.join(chinese_chars)) + ']') if chinese_chars else None
+        self._punctuation_re = re.compile('[' + re.escape(punctuation) + ']')
+        self._alphanumeric_re = re.compile(r'[a-zA-Z0-9]+')
+
+    def scan(self, text, rules, tokenized=False):
+        """textを1回走査し、rulesのうち当てはまった規則のビットを返す（最初に当てはまった時点で打ち切る）
+
+        tokenized=Trueでは空白を単語の区切りとして扱い、禁止ワードは空白を除いた文字列と照合する。
+        """
+        goto = self._rules._goto
+        fail = self._rules._fail
+        tags = self._rules._tags
+        state = 0
+        if not tokenized:
+            for char in text:
+                while True:
+                    next_state = goto[state].get(char)
+                    if next_state is not None:
+                        state = next_state
+                        break
+                    if state == 0:
+                        break
+                    state = fail[state]
+                if tags[state] & rules:
+                    return tags[state] & rules
+            return 0
+
+        check_alnum = rules & RULE_ALNUM_TOKEN
+        # 今の単語が英数字だけで構成されているか（空の単語はFalse）
+        token_alnum = False
+        token_start = True
+        for char in text:
+            if char == ' ':
+                if check_alnum and token_alnum:
+                    return RULE_ALNUM_TOKEN
+                token_start = True
+                continue
+            if token_start:
+                token_alnum = char in _ALNUM_CHARS
+                token_start = False
+            elif token_alnum:
+                token_alnum = char in _ALNUM_CHARS
+            while True:
+                next_state = goto[state].get(char)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            if tags[state] & rules:
+                return tags[state] & rules
+        if check_alnum and token_alnum:
+            return RULE_ALNUM_TOKEN
+        return 0
+
+    def filter_corpus(self, texts, min_length=10, rules=CORPUS_RULES):
+        """min_length文字以上で、rulesのどれにも当てはまらないテキストの位置を返す
+        （解析結果など対応するリストと揃えて取り出せるよう、テキストではなく位置を返す）"""
+        return [
+            i for i, text in enumerate(texts)
+            if isinstance(text, str) and len(text) >= min_length and not self.scan(text, rules)
+        ]
+
+    def filter_forbidden(self, texts):
+        """禁止ワードを含まないテキストの位置を返す"""
+        return self.filter_corpus(texts, 0, RULE_FORBIDDEN)
+
+    def contains_forbidden(self, text):
+        return self.forbidden.search(text) is not None
+
+    def contains_chinese(self, text):
+        return self._chinese_re is not None and self._chinese_re.search(text) is not None
+
+    def is_alphanumeric(self, word):
+        return self._alphanumeric_re.fullmatch(word) is not None
+
+    def validate_generated(self, tokenized_text):
+        """分かち書きされた生成文の品質チェック（中国語・英数字のみの単語を含まない）"""
+        if not tokenized_text:
+            return False
+        return not self.scan(tokenized_text, RULE_CHINESE | RULE_ALNUM_TOKEN, tokenized=True)
+
+    def is_valid_output(self, tokenized_text, min_length=10):
+        """投稿可能な生成文かどうか（長さを確認し、中国語・英数字のみの単語・禁止ワードを1回の走査で判定）"""
+        if not tokenized_text or len(tokenized_text) - tokenized_text.count(' ') < min_length:
+            return False
+        return not self.scan(tokenized_text, RULE_CHINESE | RULE_ALNUM_TOKEN | RULE_FORBIDDEN, tokenized=True)
+
+    def is_noun_candidate(self, surface):
+        """ワードクラウドの単語として使える表層形か（長さ・英数字・記号）"""
+        return (len(surface) > 1 and
+                not surface.isascii() and
+                self._punctuation_re.search(surface) is None)
+
+    def is_corpus_candidate(self, text):
+        """マルコフ連鎖・ワードクラウドの読み出し対象になるノートか（DB側の抽出条件と同じ）"""
+        return isinstance(text, str) and len(text) >= 10 and not self.scan(text, RULE_LINK)
+
+
+def _benchmark(sizes=(10, 100, 1000, 5000), text_count=2000):
+    """従来の線形走査とフィルタエンジンの処理時間を比較する"""
+    import random
+    random.seed(42)
+    kana = [chr(c) for c in range(0x3042, 0x3094)]
+    texts = [''.join(random.choice(kana) for _ in range(random.randint(20, 140))) for _ in range(text_count)]
+
+    for size in sizes:
+        words = {''.join(random.choice(kana) for _ in range(random.randint(3, 6))) for _ in range(size)}
+        words = list(words)
+
+        start = time.perf_counter()
+        naive_hits = sum(1 for text in texts if any(word in text for word in words))
+        naive = time.perf_counter() - start
+
+        text_filter = TextFilter(words)
+        start = time.perf_counter()
+        engine_hits = sum(1 for text in texts if text_filter.contains_forbidden(text))
+        engine = time.perf_counter() - start
+
+        assert naive_hits == engine_hits
+        print(f"forbidden={size:5d} texts={text_count} naive={naive * 1000:8.1f}ms engine={engine * 1000:8.1f}ms")
+
+    chinese = CHINESE_CHARS
+    text_filter = TextFilter()
+    start = time.perf_counter()
+    naive_hits = sum(1 for text in texts if any(char in text for char in chinese))
+    naive = time.perf_counter() - start
+    start = time.perf_counter()
+    engine_hits = sum(1 for text in texts if text_filter.contains_chinese(text))
+    engine = time.perf_counter() - start
+    assert naive_hits == engine_hits
+    print(f"chinese_chars texts={text_count} naive={naive * 1000:8.1f}ms engine={engine * 1000:8.1f}ms")
+
+    # 生成文の検証：規則ごとに走査する場合と、scan()の1回の走査で判定する場合
+    alphanumeric_token_re = re.compile(r'(?:^|\s)[a-zA-Z0-9]+(?=\s|$)')
+    tokenized = [' '.join(text[i:i + 3] for i in range(0, len(text), 3)) for text in texts]
+    text_filter = TextFilter(words)
+    start = time.perf_counter()
+    naive_hits = sum(1 for text in tokenized
+                     if not text_filter.contains_chinese(text) and alphanumeric_token_re.search(text) is None
+                     and len(text.replace(' ', '')) >= 10 and not text_filter.contains_forbidden(text.replace(' ', '')))
+    naive = time.perf_counter() - start
+    start = time.perf_counter()
+    engine_hits = sum(1 for text in tokenized if text_filter.is_valid_output(text))
+    engine = time.perf_counter() - start
+    assert naive_hits == engine_hits
+    print(f"valid_output forbidden={len(words)} texts={text_count} per_rule={naive * 1000:8.1f}ms "
+          f"single_pass={engine * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -1,73 +1,140 @@
-import re
 import MeCab
 import markovify
-import numpy as np
-from wordcloud import WordCloud
-import matplotlib.pyplot as plt
-import psycopg2
-from PIL import Image
 import os
+import time
+import threading
+from collections import Counter
+from itertools import islice
 from datetime import datetime
+from psycopg2.extras import execute_values
 from create_logs import LogManager
+from token_cache import TokenCache
+from db_pool import get_pool
+from word_lists import WordListCache
+from text_filter import TextFilter, CHINESE_CHARS, RULE_LINK
+from wordcloud_render import WordCloudRenderer
+from markov_model import build_model_from_lines
+from compact_chain import CompactChain
+from dedup import NearDuplicateIndex
+from metrics import timed, timed_stage, observe_stage, SAMPLING_ATTEMPTS
+from worker_pool import WorkerPool, WorkerTimeoutError, mecab_parse
+import worker_pool as worker_tasks
+from corpus_sampler import (CorpusSampler, TEXTS_AFTER_SQL, OBSERVATIONS_AFTER_SQL,
+                            CORPUS_BOUNDS_SQL, PIVOT_SAMPLE_SQL)
 
 class TextProcessor:
-    def __init__(self, db_params):
-        self.tagger = MeCab.Tagger()
+    def __init__(self, db_params, token_cache=None, log_manager=None, worker_pool=None):
+        # MeCab.Taggerはスレッド間で共有できないため、スレッドごとに作る
+        self._local = threading.local()
         self.db_params = db_params
-        self.log_manager = LogManager(db_params)
-        self.forbidden_words = self._get_forbidden_words()
-        # ストップワードのリストを追加
-        self.stop_words = self._get_stop_words()
+        self.pool = get_pool(db_params)
+        # マルコフ連鎖とワードクラウドで共有する形態素解析キャッシュ
+        self.token_cache = token_cache or TokenCache()
+        self.log_manager = log_manager or LogManager(db_params)
+        # マルコフ連鎖の実装（整数ID・配列で持ち、保存したファイルをmmapでプロセス間共有するcompact または markovify）
+        self.markov_engine = os.getenv('MARKOV_ENGINE', 'compact')
+        # 禁止トークン・禁止ワードを遷移の時点で除いて生成する（markovifyのモデルはCompactChainに変換して使う）
+        self.constrained_generation = os.getenv('MARKOV_CONSTRAINED', '1') == '1'
+        self._constraints = None
+        # 最後に変換したmarkovifyのモデルと変換後のCompactChain
+        self._converted = None
+        # 転載・コピペ・botの投稿などほぼ同じノートを学習・集計から除くか
+        self.dedup_enabled = os.getenv('DEDUP_ENABLED', '1') == '1'
+        # MeCabの解析・モデル構築・描画を実行するプロセスプール（未指定ならこのプロセスで実行）
+        self.worker_pool = worker_pool or WorkerPool(max_workers=0)
+        # 禁止ワード・ストップワード等はTTLと変更通知で更新されるキャッシュから参照する
+        self.word_lists = WordListCache({
+            'forbidden': self._get_forbidden_words,
+            'stop_words': self._get_stop_words,
+            'wordcloud_forbidden': self.get_wordcloud_forbidden_words
+        }, db_params, self.log_manager)
         # 中国語特有の文字リストを追加
-        self.chinese_chars = ['读', '难', '书', '说', '谢', '对', '话', '吗', '吧', '们', '这', '你', '她', '很', '给']
-        
-    def get_texts_from_db(self):
+        self.chinese_chars = CHINESE_CHARS
+        self._text_filter = None
+        self._text_filter_version = None
+        # フォントと描画結果を保持するワードクラウドの描画器
+        self.renderer = WordCloudRenderer()
+        # 全期間からのランダムな学習用テキストの抽出
+        self.corpus_sampler = CorpusSampler(self)
+        # 取り込みAPIで保存したノート数と、保存済みの解析結果を使ってMeCabを省略した件数
+        self.ingested_notes = 0
+        self.pretokenized_reads = 0
+        self._tagger_warm = False
+
+    @property
+    def tagger(self):
+        tagger = getattr(self._local, 'tagger', None)
+        if tagger is None:
+            tagger = self._local.tagger = MeCab.Tagger()
+        return tagger
+
+    @property
+    def forbidden_words(self):
+        return self.word_lists.get('forbidden')
+
+    @property
+    def stop_words(self):
+        # ストップワードのリスト
+        return self.word_lists.get('stop_words')
+
+    @property
+    def text_filter(self):
+        """禁止ワードが更新されたときだけ作り直すコンパイル済みフィルタ"""
+        version = self.word_lists.version('forbidden')
+        if self._text_filter is None or self._text_filter_version != version:
+            self._text_filter = TextFilter(self.forbidden_words, self.chinese_chars)
+            self._text_filter_version = version
+        return self._text_filter
+
+    def warm_up(self):
+        """MeCabの辞書・単語リスト・フォントを読み込み、各部品の準備状況を返す"""
+        # 辞書の各ページを実際に参照させるため、解析を1回通しておく
+        self.tagger.parse('起動時に辞書を読み込むための文章です。')
+        self._tagger_warm = True
+        self.word_lists.warm_up()
+        self.text_filter
+        try:
+            self.renderer.warm_up()
+        except Exception as e:
+            self.log_manager.write_log("WARNING", "TextProcessor", f"Failed to warm up wordcloud fonts: {str(e)}")
+        return self.readiness()
+
+    def readiness(self):
+        return {
+            'mecab': self._tagger_warm,
+            'word_lists': self.word_lists.loaded,
+            'fonts': self.renderer.ready
+        }
+
+    @timed_stage('db_fetch')
+    def get_observations_after(self, last_id, since_seconds, limit=5000):
+        """ワードクラウド用に、指定したgtl_idより新しいノートを投稿時刻（DB時計の秒）と保存済みの解析結果付きで取得"""
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
-                    # テキストの品質フィルタリングを追加
-                    cur.execute("""
-                        SELECT post_text 
-                        FROM public.glt_observation 
-                        WHERE post_text IS NOT NULL 
-                        AND length(post_text) >= 10
-                        AND post_text NOT LIKE '%http%'
-                        AND post_text NOT LIKE '%@%'
-                        LIMIT 1000
-                    """)
-                    texts = [row[0] for row in cur.fetchall()]
-                    self.log_manager.write_log("INFO", "TextProcessor", "Successfully fetched texts from database")
-                    return texts
+                    cur.execute(OBSERVATIONS_AFTER_SQL, (last_id, since_seconds, limit))
+                    return [(row[0], row[1], float(row[2]), self._unpack_parsed(row[3], row[4]))
+                            for row in cur.fetchall()]
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Database error: {str(e)}")
-            return []
+            return None
 
-    def get_texts_from_db_wordcloud(self):
+    @timed_stage('db_fetch')
+    def get_db_clock(self):
+        """投稿時刻と比較するためのDB側の現在時刻（秒）"""
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
-                    # 直近4時間分のデータを取得するようにクエリを修正
-                    cur.execute("""
-                        SELECT post_text 
-                        FROM public.glt_observation 
-                        WHERE post_text IS NOT NULL 
-                        AND length(post_text) >= 10
-                        AND post_text NOT LIKE '%http%'
-                        AND post_text NOT LIKE '%@%'
-                        AND timestamp >= NOW() - INTERVAL '4 hours'
-                        ORDER BY timestamp DESC
-                        LIMIT 1000
-                    """)
-                    texts = [row[0] for row in cur.fetchall()]
-                    self.log_manager.write_log("INFO", "TextProcessor", "Successfully fetched texts from database for wordcloud")
-                    return texts
+                    cur.execute("SELECT EXTRACT(EPOCH FROM LOCALTIMESTAMP)")
+                    return float(cur.fetchone()[0])
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Database error: {str(e)}")
-            return []
+            return None
 
+    @timed_stage('db_fetch')
     def _get_forbidden_words(self):
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT value 
@@ -80,11 +147,12 @@ class TextProcessor:
                     return []
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Error fetching forbidden words: {str(e)}")
-            return []
+            return None
 
+    @timed_stage('db_fetch')
     def _get_stop_words(self):
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT value 
@@ -97,124 +165,317 @@ class TextProcessor:
                     return []
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Error fetching stop words: {str(e)}")
-            return []
+            return None
 
     def _contains_forbidden_words(self, text):
         """禁止ワードが含まれているかチェック"""
-        return any(word in text for word in self.forbidden_words)
+        return self.text_filter.contains_forbidden(text)
+
+    def _normalize_text(self, text):
+        # 基本的な文字列クリーニング
+        text = text.strip()
+        return text.replace('\n', ' ')
+
+    def _intern_parsed(self, parsed):
+        surfaces, pos = parsed
+        return surfaces, tuple(self.token_cache.intern_pos(p) for p in pos)
+
+    def _parse_with_mecab(self, text):
+        """MeCabで解析し、表層形と品詞（大分類・中分類）のタプルを返す"""
+        return self._intern_parsed(mecab_parse(self.tagger, text))
+
+    def parse(self, text):
+        """キャッシュを経由して形態素解析の結果を取得"""
+        return self.token_cache.get_or_parse(self._normalize_text(text), self._parse_with_mecab)
+
+    def _pack_parsed(self, parsed):
+        """解析結果をDBのtext[]列に保存する形に変換"""
+        surfaces, pos = parsed
+        return list(surfaces), [f"{pos1},{pos2}" for pos1, pos2 in pos]
+
+    def _unpack_parsed(self, tokens, pos):
+        """DBに保存された解析結果を解析結果のタプルに戻す（未保存ならNone）"""
+        if tokens is None or pos is None or len(tokens) != len(pos):
+            return None
+        return tuple(tokens), tuple(self.token_cache.intern_pos(tuple(p.split(',', 1))) for p in pos)
+
+    def parse_many(self, texts, parsed=None):
+        """複数のテキストを解析する。キャッシュにないものはワーカーに分割して渡す
+        （parsedに保存済みの解析結果があるテキストはMeCabを通さない）"""
+        normalized = [self._normalize_text(text) for text in texts]
+        results = [None] * len(normalized)
+        missing = {}
+        for i, text in enumerate(normalized):
+            if parsed is not None and parsed[i] is not None:
+                results[i] = parsed[i]
+                self.pretokenized_reads += 1
+                continue
+            key = self.token_cache.make_key(text)
+            cached = self.token_cache.get(key)
+            if cached is not None:
+                results[i] = cached
+            else:
+                missing.setdefault(text, (key, []))[1].append(i)
+
+        if missing:
+            missing_texts = list(missing)
+            with timed('tokenize', items=len(missing_texts)):
+                if self.worker_pool.enabled:
+                    parsed = [self._intern_parsed(p) for p in self.worker_pool.map_chunks(worker_tasks.parse_texts, missing_texts)]
+                else:
+                    parsed = [self._parse_with_mecab(text) for text in missing_texts]
+            for text, value in zip(missing_texts, parsed):
+                key, indexes = missing[text]
+                self.token_cache.put(key, value)
+                for i in indexes:
+                    results[i] = value
+        return results
 
     def tokenize(self, text):
         if not text or not isinstance(text, str):
             return ""
-            
-        # 基本的な文字列クリーニング
-        text = text.strip()
-        text = text.replace('\n', ' ')
-        
-        node = self.tagger.parseToNode(text)
-        words = []
-        while node:
-            if node.surface not in ['BOS/EOS', '', ' ']:
-                # 表層形をそのまま使用
-                words.append(node.surface)
-            node = node.next
-        return ' '.join(words)
+
+        surfaces, _ = self.parse(text)
+        return ' '.join(surfaces)
 
     def _contains_only_alphanumeric(self, text):
         """テキストがアルファベットと数字のみで構成されているかチェック"""
-        return bool(re.match('^[a-zA-Z0-9]+$', text))
+        return self.text_filter.is_alphanumeric(text)
 
     def _validate_generated_text(self, text):
-        """生成されたテキストの品質チェック"""
-        if not text:
-            return False
-        
-        # 中国語特有の文字が含まれていないかチェック
-        for char in self.chinese_chars:
-            if char in text:
-                return False
-        
-        # スペースで分割して各単語をチェック
-        words = text.split()
-        for word in words:
-            if self._contains_only_alphanumeric(word):
-                return False
-        return True
+        """生成されたテキストの品質チェック（中国語の文字・英数字のみの単語を含まない）"""
+        return self.text_filter.validate_generated(text)
+
+    def iter_texts_after(self, last_id, itersize=5000):
+        """指定したgtl_idより新しい学習用テキストをサーバー側カーソルでitersize件ずつ読み出すジェネレータ"""
+        try:
+            with self.pool.connection() as conn:
+                # 名前付きカーソルにすると結果セットをDB側に残したまま少しずつ取得できる
+                with conn.cursor(name='corpus_stream') as cur:
+                    cur.itersize = itersize
+                    # 読み出し側の処理時間を含めないよう、DBからの取得にかかった時間だけを積算する
+                    started = time.perf_counter()
+                    cur.execute(TEXTS_AFTER_SQL, (last_id, None))
+                    fetch_seconds = time.perf_counter() - started
+                    rows = iter(cur)
+                    fetched = 0
+                    while True:
+                        started = time.perf_counter()
+                        row = next(rows, None)
+                        fetch_seconds += time.perf_counter() - started
+                        if row is None:
+                            break
+                        fetched += 1
+                        yield row[0], row[1], row[2], self._unpack_parsed(row[3], row[4])
+                    observe_stage('db_fetch', fetch_seconds, fetched)
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "TextProcessor", f"Database error: {str(e)}")
+
+    @timed_stage('db_fetch')
+    def get_corpus_bounds(self, recent_hours):
+        """学習対象のノートのgtl_idの範囲と、直近recent_hours時間の最初のgtl_idを取得"""
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(CORPUS_BOUNDS_SQL, (recent_hours,))
+                    row = cur.fetchone()
+                    if row is None or row[0] is None:
+                        return None
+                    return row
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "TextProcessor", f"Database error: {str(e)}")
+            return None
+
+    @timed_stage('db_fetch')
+    def get_texts_from_pivots(self, pivots, run_length):
+        """各起点のgtl_id以降の学習用テキストをrun_length件ずつ保存済みの解析結果付きで取得"""
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(PIVOT_SAMPLE_SQL, (list(pivots), run_length))
+                    return [(row[0], row[1], self._unpack_parsed(row[2], row[3])) for row in cur.fetchall()]
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "TextProcessor", f"Database error: {str(e)}")
+            return None
+
+    @timed_stage('ingest')
+    def ingest_notes(self, notes):
+        """ノートを形態素解析してから解析結果と一緒にまとめて保存し、採番されたgtl_idを返す
+        （note_idが保存済みのノートは保存せず、返すgtl_idにも含めない）"""
+        # 学習・集計の対象にならないノート（DB側のeligible列と同じ条件）は解析せずに保存する
+        eligible = self.text_filter.filter_corpus([note['text'] for note in notes], rules=RULE_LINK)
+        packed = [(None, None)] * len(notes)
+        for i, parsed in zip(eligible, self.parse_many([notes[i]['text'] for i in eligible])):
+            packed[i] = self._pack_parsed(parsed)
+
+        rows = [
+            (note.get('note_id'), note['user_name'], note['instance_name'], note['text'], tokens, pos)
+            for note, (tokens, pos) in zip(notes, packed)
+        ]
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    inserted = execute_values(cur, """
+                        INSERT INTO public.glt_observation (note_id, user_name, instance_name, post_text, tokens, pos)
+                        VALUES %s
+                        ON CONFLICT (note_id) DO NOTHING
+                        RETURNING gtl_id
+                    """, rows, template="(%s, %s, %s, %s, %s::text[], %s::text[])", page_size=len(rows) or 1, fetch=True)
+            self.ingested_notes += len(inserted)
+            return [row[0] for row in inserted]
+        except Exception as e:
+            self.log_manager.write_log("ERROR", "TextProcessor", f"Error ingesting notes: {str(e)}",
+                                       metadata={'notes': len(notes)})
+            return None
+
+    def new_dedup_index(self, max_entries=None):
+        """ほぼ同じノートを除くための索引（DEDUP_ENABLED=0ならNone）"""
+        if not self.dedup_enabled:
+            return None
+        return NearDuplicateIndex(max_entries=max_entries)
+
+    def prepare_markov_corpus(self, texts, parsed=None, dedup=None):
+        """マルコフ連鎖の学習用に、テキストを分かち書きした行のリストへ変換
+        （dedupを渡すと、その索引で既に見たノートとほぼ同じノートを除く）"""
+        with timed('filter', items=len(texts)):
+            # 短いテキストと、URL・メンション・中国語特有の文字を含むテキストを1回の走査で除外
+            kept = self.text_filter.filter_corpus(texts, min_length=11)
+            candidates = [texts[i] for i in kept]
+            candidates_parsed = [parsed[i] for i in kept] if parsed is not None else [None] * len(kept)
+
+        parsed_candidates = self.parse_many(candidates, candidates_parsed)
+        if dedup is not None:
+            with timed('dedup', items=len(candidates)):
+                kept = [(text, p) for text, p in zip(candidates, parsed_candidates) if not dedup.check_and_add(p[0])]
+        else:
+            kept = zip(candidates, parsed_candidates)
+
+        processed_texts = []
+        for text, (surfaces, _) in kept:
+            # ワードクラウドと解析結果を共有するため、句点は解析後に補う
+            processed = ' '.join(surfaces)
+            if not text.strip().endswith('。'):
+                processed += ' 。'
+            if processed and len(processed) >= 10:
+                processed_texts.append(processed)
+        return processed_texts
+
+    def iter_markov_corpus(self, items, chunk_size=None, dedup=None):
+        """(テキスト, 保存済みの解析結果)を順に受け取り、分かち書きした学習用の行を逐次返すジェネレータ"""
+        chunk_size = chunk_size or self.worker_pool.chunk_size * max(self.worker_pool.max_workers, 1)
+        items = iter(items)
+        while True:
+            # 形態素解析はワーカーにまとめて渡せるよう、一定件数ごとに行う
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                return
+            yield from self.prepare_markov_corpus([text for text, _ in chunk], [parsed for _, parsed in chunk], dedup)
+
+    @timed_stage('model_build')
+    def build_markov_model(self, processed_texts, state_size=2, engine=None):
+        """分かち書き済みの行からマルコフ連鎖モデルを構築"""
+        if not any(text.strip() for text in processed_texts):
+            raise ValueError("テキストの処理後のデータが空です")
+
+        if (engine or self.markov_engine) == 'compact':
+            return build_model_from_lines(processed_texts, state_size, 'compact')
+
+        if self.worker_pool.enabled:
+            return self.worker_pool.submit(worker_tasks.build_markov_model, processed_texts, state_size)
+
+        combined_text = '\n'.join(processed_texts)
+        return markovify.NewlineText(
+            combined_text,
+            state_size=state_size,
+            retain_original=False
+        )
+
+    def _generation_constraints(self, chain):
+        """制約付き生成で使う禁止トークンのマスクと禁止ワードのオートマトン（モデルか禁止ワードが変わったときだけ作り直す）"""
+        text_filter = self.text_filter
+        cached = self._constraints
+        if cached is None or cached[0] is not chain or cached[1] is not text_filter:
+            banned = chain.token_mask(lambda token: (text_filter.contains_chinese(token) or
+                                                     text_filter.is_alphanumeric(token) or
+                                                     text_filter.contains_forbidden(token)))
+            cached = (chain, text_filter, banned)
+            self._constraints = cached
+        return cached[2], text_filter.forbidden
+
+    def _constrained_chain(self, text_model):
+        """制約付き生成に使うCompactChainを返す（markovifyのモデルはモデルが変わったときだけ変換する）"""
+        if not self.constrained_generation:
+            return None
+        if isinstance(text_model, CompactChain):
+            return text_model
+        converted = self._converted
+        if converted is None or converted[0] is not text_model:
+            with timed('convert_model'):
+                converted = (text_model, CompactChain.from_markovify(text_model))
+            self._converted = converted
+        return converted[1]
+
+    def sample_constrained_text(self, chain):
+        """禁止トークン・禁止ワードを避けながら遷移し、検証済みの条件を満たす文章を返す（見つからなければNone）"""
+        banned, automaton = self._generation_constraints(chain)
+        words = chain.constrained_walk(banned, automaton, min_words=5, max_words=50, min_chars=10)
+        return ''.join(words) if words is not None else None
+
+    def _sample_once(self, text_model, tries=100):
+        chain = self._constrained_chain(text_model)
+        if chain is not None:
+            # 遷移の時点で不適切な候補を除くため、生成された文章は常に検証を満たす
+            result = self.sample_constrained_text(chain)
+            SAMPLING_ATTEMPTS.inc(result='constrained' if result is not None else 'empty')
+            return result
+        generated = text_model.make_sentence(tries=tries, max_words=50, min_words=5)
+        if generated and self.text_filter.is_valid_output(generated):
+            SAMPLING_ATTEMPTS.inc(result='valid')
+            return generated.replace(' ', '')
+        SAMPLING_ATTEMPTS.inc(result='invalid' if generated else 'empty')
+        return None
+
+    @timed_stage('sample')
+    def sample_markov_text(self, text_model, attempts=10):
+        """構築済みのモデルから検証済みの文章を1つ生成（禁止ワードを含む文章は返さない）"""
+        for attempt in range(attempts):
+            result = self._sample_once(text_model)
+            if result is not None:
+                self.log_manager.write_log("INFO", "TextProcessor", "Successfully generated Markov text")
+                return result
+        self.log_manager.write_log("WARNING", "TextProcessor", f"No valid sentence after {attempts} attempts")
+        raise RuntimeError("適切な文章の生成に失敗しました")
+
+    @timed_stage('sample')
+    def try_sample_markov_text(self, text_model, tries=100):
+        """1回だけサンプリングし、検証を通った文章を返す（通らなければNone、ログは書かない）"""
+        return self._sample_once(text_model, tries)
 
     def generate_markov_text(self, texts, length=100):
         try:
             if not texts or len(texts) < 10:
                 self.log_manager.write_log("WARNING", "TextProcessor", "Insufficient training data")
                 raise ValueError("学習データが不足しています")
-                
+
             # テキストの前処理を改善
-            processed_texts = []
-            for text in texts:
-                try:
-                    # 中国語特有の文字を含むテキストを除外
-                    if any(char in text for char in self.chinese_chars):
-                        continue
-                        
-                    if text and isinstance(text, str) and len(text.strip()) > 10:
-                        if not text.strip().endswith('。'):
-                            text = text.strip() + '。'
-                        processed = self.tokenize(text)
-                        if processed and len(processed) >= 10:
-                            processed_texts.append(processed)
-                except Exception as e:
-                    continue
+            processed_texts = self.prepare_markov_corpus(texts, dedup=self.new_dedup_index(len(texts)))
 
             if len(processed_texts) < 10:
                 self.log_manager.write_log("WARNING", "TextProcessor", "Insufficient valid texts after processing")
                 raise ValueError("有効なテキストが不足しています")
 
-            combined_text = '\n'.join(processed_texts)
-            if not combined_text.strip():
-                raise ValueError("テキストの処理後のデータが空です")
-
-            text_model = markovify.NewlineText(
-                combined_text,
-                state_size=2,
-                retain_original=False
-            )
-
-            for attempt in range(10):
-                try:
-                    generated = text_model.make_sentence(
-                        tries=100,
-                        max_words=50,
-                        min_words=5
-                    )
-                    if generated:
-                        result = generated.replace(' ', '')
-                        if len(result) >= 10 and self._validate_generated_text(generated):
-                            # 禁止ワードチェックを追加
-                            if not self._contains_forbidden_words(result):
-                                self.log_manager.write_log("INFO", "TextProcessor", "Successfully generated Markov text")
-                                return result
-                            else:
-                                self.log_manager.write_log("WARNING", "TextProcessor", f"Generated text contains forbidden words (attempt {attempt + 1}/10)")
-                                continue
-                        else:
-                            self.log_manager.write_log("WARNING", "TextProcessor", f"Generated text failed validation (attempt {attempt + 1}/10)")
-                except Exception as e:
-                    self.log_manager.write_log("WARNING", "TextProcessor", f"Generation attempt {attempt + 1} failed: {str(e)}")
-                    continue
-
-            # 10回試行しても適切な文章が生成できない場合は最後に生成された文章を返す
-            if generated:
-                self.log_manager.write_log("WARNING", "TextProcessor", "Returning text with forbidden words after 10 attempts")
-                return result.replace(' ', '')
-            raise RuntimeError("適切な文章の生成に失敗しました")
+            text_model = self.build_markov_model(processed_texts)
+            return self.sample_markov_text(text_model)
 
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Error in generate_markov_text: {str(e)}")
             raise
 
+    @timed_stage('db_fetch')
     def get_wordcloud_forbidden_words(self):
         """ワードクラウドの禁止ワードをデータベースから取得"""
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT value 
@@ -228,32 +489,36 @@ class TextProcessor:
                     return []
         except Exception as e:
             self.log_manager.write_log("ERROR", "TextProcessor", f"Error fetching wordcloud forbidden words: {str(e)}")
-            return []
+            return None
 
+    @timed_stage('db_write')
     def update_wordcloud_forbidden_words(self, words):
         """ワードクラウドの禁止ワードをデータベースに更新"""
         try:
-            with psycopg2.connect(**self.db_params) as conn:
+            existing_words = self.get_wordcloud_forbidden_words()
+            if existing_words is None:
+                return False
+            # 既存のリストの末尾に新しい単語を追加し、重複を除去
+            all_words = existing_words + words
+            unique_words = list(dict.fromkeys(all_words))  # 順序を保持しながら重複を削除
+
+            # 400単語を超える場合、古い単語（リストの先頭）から削除
+            if len(unique_words) > 400:
+                unique_words = unique_words[-400:]
+
+            # 配列をカンマ区切りのテキストに変換
+            words_text = ','.join(unique_words)
+
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
-                    existing_words = self.get_wordcloud_forbidden_words()
-                    # 既存のリストの末尾に新しい単語を追加し、重複を除去
-                    all_words = existing_words + words
-                    unique_words = list(dict.fromkeys(all_words))  # 順序を保持しながら重複を削除
-                    
-                    # 400単語を超える場合、古い単語（リストの先頭）から削除
-                    if len(unique_words) > 400:
-                        unique_words = unique_words[-400:]
-                    
-                    # 配列をカンマ区切りのテキストに変換
-                    words_text = ','.join(unique_words)
-                    
                     cur.execute("""
                         INSERT INTO public.memorandum (key, value)
                         VALUES ('wordcloud_forbidden', %s)
                         ON CONFLICT (key) DO UPDATE SET value = %s
                     """, (words_text, words_text))
                     conn.commit()
-                    
+                    self.word_lists.invalidate('wordcloud_forbidden')
+
                     self.log_manager.write_log("INFO", "TextProcessor", 
                         f"Updated wordcloud forbidden words: {len(unique_words)} words (max 400)")
                     return True
@@ -262,92 +527,82 @@ class TextProcessor:
                 f"Error updating wordcloud forbidden words: {str(e)}")
             return False
 
-    def generate_wordcloud(self, texts, output_path):
+    def _noun_candidates(self, surfaces, pos):
+        text_filter = self.text_filter
+        return [
+            surface for surface, (pos1, pos2) in zip(surfaces, pos)
+            if (pos1 == '名詞' and
+                pos2 not in ['数', '記号'] and
+                surface not in ['', ' ', '　'] and
+                text_filter.is_noun_candidate(surface))  # 長さ・アルファベットのみ・記号を除外
+        ]
+
+    def extract_noun_candidates_many(self, texts, parsed=None, dedup=None):
+        """複数のテキストの名詞を抽出（dedupで重複と判定されたノートは空のリストになる）"""
+        parsed = self.parse_many(texts, parsed)
+        if dedup is None:
+            return [self._noun_candidates(surfaces, pos) for surfaces, pos in parsed]
+        with timed('dedup', items=len(parsed)):
+            duplicates = [dedup.check_and_add(surfaces) for surfaces, _ in parsed]
+        return [[] if duplicate else self._noun_candidates(surfaces, pos)
+                for duplicate, (surfaces, pos) in zip(duplicates, parsed)]
+
+    def count_nouns(self, texts):
+        counts = Counter()
+        for nouns in self.extract_noun_candidates_many(texts, dedup=self.new_dedup_index(len(texts))):
+            counts.update(nouns)
+        return counts
+
+    @timed_stage('filter')
+    def filter_word_frequencies(self, frequencies, exclude_wordcloud_forbidden=True):
+        """ストップワード・禁止ワード（・ワードクラウド除外ワード）を取り除いた頻度表を返す"""
+        wordcloud_forbidden = self.word_lists.get('wordcloud_forbidden') if exclude_wordcloud_forbidden else frozenset()
+        forbidden_words = self.forbidden_words
+        stop_words = self.stop_words
+        return {
+            word: count for word, count in frequencies.items()
+            if (count > 0 and
+                word not in stop_words and
+                word not in wordcloud_forbidden and
+                word not in forbidden_words)
+        }
+
+    def wordcloud_fingerprint(self, frequencies, image_format='png', quantize=False):
+        """描画結果を識別する値。ワードクラウド除外ワードは描画のたびに更新されるため含めない"""
+        base = self.filter_word_frequencies(frequencies, exclude_wordcloud_forbidden=False)
+        options = {'format': image_format, 'quantize': bool(quantize)}
+        return base, self.renderer.fingerprint(base, options)
+
+    def cached_wordcloud_etag(self, frequencies, image_format='png', quantize=False):
+        """同じ頻度表と設定の描画結果がキャッシュにあれば、そのETagを返す"""
+        _, fingerprint = self.wordcloud_fingerprint(frequencies, image_format, quantize)
+        cached = self.renderer.get(fingerprint)
+        return cached['etag'] if cached is not None else None
+
+    def render_wordcloud(self, frequencies, image_format='png', quantize=False):
+        """ワードクラウドをメモリ上に描画する。同じ頻度表と設定ならキャッシュを返す"""
         try:
-            # テキストの前処理を改善
-            words = []
-            used_words = []  # 実際にワードクラウドで使用された単語を保存
-            wordcloud_forbidden = self.get_wordcloud_forbidden_words()
-            forbidden_words = self._get_forbidden_words()
-            for text in texts:
-                node = self.tagger.parseToNode(text)
-                while node:
-                    features = node.feature.split(',')
-                    if (features[0] == '名詞' and
-                        features[1] not in ['数', '記号'] and
-                        node.surface not in ['', ' ', '　'] and 
-                        node.surface not in self.stop_words and
-                        node.surface not in wordcloud_forbidden and
-                        node.surface not in forbidden_words and
-                        len(node.surface) > 1 and
-                        not node.surface.isascii() and  # アルファベットのみの単語を除外
-                        not any(char in '！？。、．，…‥：；｜＆＊（）［］｛｝「」『』【】＜＞〈〉《》〔〕・＋－＝／＼～①②③④⑤⑥⑦⑧⑨⑩' for char in node.surface)):
-                        words.append(node.surface)
-                    node = node.next
-            
+            base, fingerprint = self.wordcloud_fingerprint(frequencies, image_format, quantize)
+            cached = self.renderer.get(fingerprint)
+            if cached is not None:
+                return {**cached, 'fingerprint': fingerprint, 'cached': True}
+
+            wordcloud_forbidden = self.word_lists.get('wordcloud_forbidden')
+            words = {word: count for word, count in base.items() if word not in wordcloud_forbidden}
+
             if not words:
                 self.log_manager.write_log("WARNING", "TextProcessor", "No valid words found for wordcloud")
-                return False
+                return None
+
+            with timed('wordcloud_render'):
+                if self.worker_pool.enabled:
+                    rendered = self.worker_pool.submit(worker_tasks.render_wordcloud, words, image_format, quantize)
+                else:
+                    rendered = self.renderer.render(words, image_format, quantize)
+            for stage, seconds in rendered.pop('timings', {}).items():
+                observe_stage(stage, seconds)
+            used_words = rendered['used_words']
 
-            processed_text = ' '.join(words)
-            
-            # フォントの検索順序を変更
-            font_paths = [
-
-                '/penetration/fonts/MPLUSRounded1c-Medium.ttf',
-                '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',
-                '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
-                '/usr/share/fonts/truetype/ipafont-gothic/ipag.ttf',
-                '/usr/share/fonts/truetype/vlgothic/VL-Gothic-Regular.ttf',
-                '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'  # フォールバック用
-
-            ]
-            
-            # 利用可能なフォントを探す
-            font_path = None
-            for path in font_paths:
-                if os.path.exists(path):
-                    font_path = path
-                    break
-            
-            # フォントが見つからない場合はシステムのデフォルトフォントを使用
-            if font_path is None:
-                try:
-                    import matplotlib.font_manager as fm
-                    system_fonts = fm.findSystemFonts()
-                    for font in system_fonts:
-                        if any(jp_font in font.lower() for jp_font in ['gothic', 'mincho', 'noto', 'ipa']):
-                            font_path = font
-                            break
-                except:
-                    font_path = None  # デフォルトのフォントにフォールバック
-            
-            if not font_path:
-                raise FileNotFoundError("Required font files not found")
-
-            # WordCloudの生成
-            wordcloud = WordCloud(
-                font_path=font_path,
-                width=960,
-                height=520,
-                background_color='white',
-                prefer_horizontal=0.7,
-                colormap='tab10',
-                min_font_size=12,
-                max_font_size=80,
-                random_state=42,
-                regexp=r"[\w']+|[^\s\w]+",
-                collocations=False,
-                normalize_plurals=False
-            ).generate(processed_text)
-            
-            # 使用された単語と頻度を取得
-            word_frequencies = wordcloud.words_
-            used_words = list(word_frequencies.keys())
-            
-            # WordCloudの保存
-            wordcloud.to_file(output_path)
-            
             # 使用された単語をデータベースに登録
             if used_words:
                 update_result = self.update_wordcloud_forbidden_words(used_words)
@@ -357,20 +612,26 @@ class TextProcessor:
                     f"Updated wordcloud forbidden words with {len(used_words)} words",
                     metadata={"updated_words": used_words}
                 )
-            
+
+            self.renderer.put(fingerprint, rendered)
             self.log_manager.write_log(
                 "INFO",
                 "TextProcessor",
-                f"Generated wordcloud at: {output_path}",
+                "Generated wordcloud",
                 metadata={
-                    "font_path": font_path,
+                    "font_path": self.renderer.font_path,
+                    "format": image_format,
+                    "bytes": len(rendered['data']),
                     "word_count": len(used_words),
+                    "token_cache": self.token_cache.stats(),
                     "sample_words": used_words[:5] if used_words else []
                 }
             )
-            
-            return True
+            return {**rendered, 'fingerprint': fingerprint, 'cached': False}
 
+        except WorkerTimeoutError:
+            self.log_manager.write_log("ERROR", "TextProcessor", "Wordcloud rendering timed out")
+            raise
         except Exception as e:
             self.log_manager.write_log(
                 "ERROR",
@@ -378,4 +639,16 @@ class TextProcessor:
                 f"Wordcloud generation error: {str(e)}",
                 metadata={"words_found": len(words) if 'words' in locals() else 0}
             )
+            return None
+
+    def generate_wordcloud(self, texts, output_path):
+        return self.generate_wordcloud_from_frequencies(self.count_nouns(texts), output_path)
+
+    def generate_wordcloud_from_frequencies(self, frequencies, output_path):
+        """ワードクラウドを描画してファイルに保存"""
+        rendered = self.render_wordcloud(frequencies)
+        if rendered is None:
             return False
+        with open(output_path, 'wb') as f:
+            f.write(rendered['data'])
+        return True
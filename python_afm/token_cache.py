@@ -0,0 +1,88 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class TokenCache:
+    """MeCabの解析結果（表層形と品詞）をLRUで保持するキャッシュ"""
+
+    def __init__(self, max_bytes=None):
+        # メモリ上限（バイト）。概算サイズの合計がこれを超えると古いものから削除する
+        self.max_bytes = max_bytes or int(os.getenv('TOKEN_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # 品詞タプルは種類が少ないため共有して保持する
+        self._pos_pool = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text):
+        """本文のハッシュをキーとする（GTLのノートは書き換えられないため）"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def intern_pos(self, pos):
+        return self._pos_pool.setdefault(pos, pos)
+
+    @staticmethod
+    def _estimate_size(key, value):
+        surfaces, pos = value
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        size += sys.getsizeof(surfaces) + sum(sys.getsizeof(s) for s in surfaces)
+        size += sys.getsizeof(pos)
+        return size
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value[0]
+
+    def put(self, key, value):
+        size = self._estimate_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_parse(self, text, parse):
+        """キャッシュにあればそれを返し、なければparseの結果を登録して返す"""
+        key = self.make_key(text)
+        value = self.get(key)
+        if value is None:
+            value = parse(text)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
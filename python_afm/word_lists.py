@@ -0,0 +1,129 @@
+import os
+import time
+import select
+import threading
+import psycopg2
+import psycopg2.extensions
+from db_pool import connect
+
+NOTIFY_CHANNEL = 'afm_word_lists'
+
+
+class WordListCache:
+    """禁止ワード等の単語リストをTTL付きで保持し、DBからの変更通知で無効化する"""
+
+    def __init__(self, loaders, db_params, log_manager, ttl=None):
+        # loaders: リスト名 -> DBから単語のリストを取得する関数（失敗時はNoneを返す）
+        self.loaders = loaders
+        self.db_params = db_params
+        self.log_manager = log_manager
+        self.ttl = ttl if ttl is not None else float(os.getenv('WORD_LIST_TTL', '60'))
+
+        self._values = {}
+        self._loaded_at = {}
+        self._versions = {name: 0 for name in loaders}
+        self._lock = threading.Lock()
+        self._listener = None
+        self._stop_event = threading.Event()
+        self.reloads = 0
+        self.notifications = 0
+
+    def get(self, name):
+        """単語の集合を返す。期限切れや無効化されている場合のみDBから読み直す"""
+        loaded_at = self._loaded_at.get(name)
+        if loaded_at is None or time.monotonic() - loaded_at >= self.ttl:
+            self._reload(name)
+        return self._values.get(name, frozenset())
+
+    def warm_up(self):
+        """すべてのリストを読み込んでおく"""
+        for name in self.loaders:
+            self.get(name)
+        return self.loaded
+
+    @property
+    def loaded(self):
+        return all(name in self._values for name in self.loaders)
+
+    def version(self, name):
+        """リストが読み直されるたびに増える番号（派生データの再構築判定用）"""
+        self.get(name)
+        return self._versions[name]
+
+    def _reload(self, name):
+        with self._lock:
+            loaded_at = self._loaded_at.get(name)
+            if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+                return
+            words = self.loaders[name]()
+            if words is None:
+                # 取得に失敗した場合は前回の値を使い続ける（未取得なら次回また試す）
+                if name in self._values:
+                    self._loaded_at[name] = time.monotonic()
+                return
+            self._loaded_at[name] = time.monotonic()
+            words = frozenset(words)
+            if words != self._values.get(name):
+                self._values[name] = words
+                self._versions[name] += 1
+            self.reloads += 1
+
+    def invalidate(self, name=None):
+        """指定したリスト（省略時はすべて）を次回アクセス時に読み直させる"""
+        with self._lock:
+            if name is None:
+                self._loaded_at.clear()
+            else:
+                self._loaded_at.pop(name, None)
+
+    def start_listener(self):
+        """LISTEN/NOTIFYで変更を受け取るスレッドを開始"""
+        if self._listener and self._listener.is_alive():
+            return
+        self._stop_event.clear()
+        self._listener = threading.Thread(target=self._listen, name='word-list-listener', daemon=True)
+        self._listener.start()
+
+    def stop_listener(self):
+        self._stop_event.set()
+
+    def _listen(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = connect(self.db_params)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # 接続し直すまでの間に変更されている可能性があるため全て読み直す
+                self.invalidate()
+                backoff = 1
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.notifications += 1
+                        self.invalidate(notify.payload if notify.payload in self.loaders else None)
+            except Exception as e:
+                self.log_manager.write_log("WARNING", "WordListCache", f"Word list listener error: {str(e)}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def stats(self):
+        return {
+            'lists': {name: len(words) for name, words in self._values.items()},
+            'versions': dict(self._versions),
+            'ttl': self.ttl,
+            'reloads': self.reloads,
+            'notifications': self.notifications,
+            'listening': bool(self._listener and self._listener.is_alive())
+        }
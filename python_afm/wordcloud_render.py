@@ -0,0 +1,197 @@
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import ImageFont
+
+# フォントの検索順序
+FONT_PATHS = [
+    '/penetration/fonts/MPLUSRounded1c-Medium.ttf',
+    '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/ipafont-gothic/ipag.ttf',
+    '/usr/share/fonts/truetype/vlgothic/VL-Gothic-Regular.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'  # フォールバック用
+]
+
+# WordCloudに渡す描画設定
+WORDCLOUD_OPTIONS = {
+    'width': 960,
+    'height': 520,
+    'background_color': 'white',
+    'prefer_horizontal': 0.7,
+    'colormap': 'tab10',
+    'min_font_size': 12,
+    'max_font_size': 80,
+    'random_state': 42,
+    'collocations': False,
+    'normalize_plurals': False
+}
+
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+
+
+class _CachedImageFont:
+    """WordCloudが単語ごとに呼ぶImageFont.truetypeを、読み込み済みのフォントで返す"""
+
+    def __init__(self):
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def truetype(self, font=None, size=10, *args, **kwargs):
+        if args or kwargs or not isinstance(font, str):
+            return ImageFont.truetype(font, size, *args, **kwargs)
+        key = (font, size)
+        loaded = self._fonts.get(key)
+        if loaded is None:
+            with self._lock:
+                loaded = self._fonts.get(key)
+                if loaded is None:
+                    loaded = ImageFont.truetype(font, size)
+                    self._fonts[key] = loaded
+        return loaded
+
+    def __getattr__(self, name):
+        return getattr(ImageFont, name)
+
+    def __len__(self):
+        return len(self._fonts)
+
+
+_font_cache = _CachedImageFont()
+_WordCloud = None
+
+
+def _load_wordcloud():
+    """wordcloudはmatplotlibを読み込み起動が遅くなるため、初めて使うときに読み込む"""
+    global _WordCloud
+    if _WordCloud is None:
+        import wordcloud.wordcloud
+        # wordcloudモジュール内のImageFontを差し替え、FreeTypeのフェイスをサイズごとに使い回す
+        wordcloud.wordcloud.ImageFont = _font_cache
+        _WordCloud = wordcloud.wordcloud.WordCloud
+    return _WordCloud
+
+
+class WordCloudRenderer:
+    """ワードクラウドをメモリ上で描画し、頻度表と描画設定ごとに結果をキャッシュする"""
+
+    def __init__(self, cache_size=None):
+        self.cache_size = int(cache_size or os.getenv('WORDCLOUD_RENDER_CACHE_SIZE', '16'))
+        self._font_path = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # FreeTypeのフェイスはスレッド間で同時に使えないため、描画は1つずつ行う
+        self._render_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def font_path(self):
+        """利用するフォントを初回だけ探して以後は使い回す"""
+        if self._font_path is None:
+            self._font_path = self._resolve_font_path()
+        return self._font_path
+
+    def _resolve_font_path(self):
+        # 利用可能なフォントを探す
+        for path in FONT_PATHS:
+            if os.path.exists(path):
+                return path
+
+        # フォントが見つからない場合はシステムのデフォルトフォントを使用
+        try:
+            import matplotlib.font_manager as fm
+            for font in fm.findSystemFonts():
+                if any(jp_font in font.lower() for jp_font in ['gothic', 'mincho', 'noto', 'ipa']):
+                    return font
+        except Exception:
+            pass
+        raise FileNotFoundError("Required font files not found")
+
+    def warm_up(self):
+        """wordcloudとフォントを描画に使うサイズ分だけ先に読み込む"""
+        _load_wordcloud()
+        for size in range(WORDCLOUD_OPTIONS['min_font_size'], WORDCLOUD_OPTIONS['max_font_size'] + 1):
+            _font_cache.truetype(self.font_path, size)
+
+    @property
+    def ready(self):
+        return _WordCloud is not None and len(_font_cache) > 0
+
+    @staticmethod
+    def fingerprint(frequencies, options):
+        """頻度表と描画設定から決まる識別子（描画結果のキャッシュのキー）"""
+        payload = json.dumps([sorted(frequencies.items()), options], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def get(self, fingerprint):
+        with self._lock:
+            cached = self._cache.get(fingerprint)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(fingerprint)
+            self.hits += 1
+            return cached
+
+    def put(self, fingerprint, rendered):
+        with self._lock:
+            self._cache[fingerprint] = rendered
+            self._cache.move_to_end(fingerprint)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def render(self, frequencies, image_format='png', quantize=False):
+        """頻度表から画像のバイト列と実際に配置された単語を返す"""
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+
+        started = time.perf_counter()
+        with self._render_lock:
+            wordcloud = _load_wordcloud()(font_path=self.font_path, **WORDCLOUD_OPTIONS).generate_from_frequencies(frequencies)
+            image = wordcloud.to_image()
+        laid_out = time.perf_counter()
+
+        buffer = io.BytesIO()
+        if image_format == 'webp':
+            image.save(buffer, format='WEBP', quality=90, method=4)
+        elif quantize:
+            # 減色したパレットPNGにしてファイルサイズを抑える
+            image.quantize(colors=64).save(buffer, format='PNG', optimize=True)
+        else:
+            image.save(buffer, format='PNG')
+
+        data = buffer.getvalue()
+        return {
+            'data': data,
+            'mimetype': IMAGE_FORMATS[image_format],
+            # ETagは入力ではなく実際に返すバイト列から求める
+            'etag': hashlib.sha256(data).hexdigest()[:32],
+            'used_words': list(wordcloud.words_.keys()),
+            # ワーカープロセスで描画した場合も呼び出し元で記録できるよう、所要時間を結果に含める
+            'timings': {
+                'wordcloud_layout': laid_out - started,
+                'image_encode': time.perf_counter() - laid_out
+            }
+        }
+
+    def stats(self):
+        return {
+            'entries': len(self._cache),
+            'cache_size': self.cache_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'font_path': self._font_path,
+            'loaded_fonts': len(_font_cache)
+        }
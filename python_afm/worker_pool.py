@@ -0,0 +1,199 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# ワーカープロセスごとに保持するMeCabとワードクラウドの描画器
+_tagger = None
+_renderer = None
+
+
+class WorkerTimeoutError(TimeoutError):
+    """ワーカーでの処理が制限時間内に終わらなかった"""
+
+
+def _init_worker():
+    global _tagger
+    import MeCab
+    _tagger = MeCab.Tagger()
+
+
+def mecab_parse(tagger, text):
+    """MeCabで解析し、表層形と品詞（大分類・中分類）のタプルを返す"""
+    node = tagger.parseToNode(text)
+    surfaces = []
+    pos = []
+    while node:
+        if node.surface not in ['BOS/EOS', '', ' ']:
+            # 表層形をそのまま使用
+            features = node.feature.split(',')
+            surfaces.append(node.surface)
+            pos.append((features[0], features[1] if len(features) > 1 else '*'))
+        node = node.next
+    return tuple(surfaces), tuple(pos)
+
+
+def parse_texts(texts):
+    """ワーカー側で複数のテキストをまとめて解析"""
+    if _tagger is None:
+        _init_worker()
+    return [mecab_parse(_tagger, text) for text in texts]
+
+
+def warm_up_worker():
+    """ワーカーでMeCabの辞書とワードクラウドのフォントを読み込んでおく"""
+    global _renderer
+    if _tagger is None:
+        _init_worker()
+    _tagger.parse('起動時に辞書を読み込むための文章です。')
+    if _renderer is None:
+        from wordcloud_render import WordCloudRenderer
+        _renderer = WordCloudRenderer()
+    try:
+        _renderer.warm_up()
+    except FileNotFoundError:
+        pass
+    return os.getpid()
+
+
+def build_markov_model(processed_texts, state_size):
+    """ワーカー側で分かち書き済みの行からマルコフ連鎖モデルを構築"""
+    import markovify
+    return markovify.NewlineText('\n'.join(processed_texts), state_size=state_size, retain_original=False)
+
+
+def render_wordcloud(frequencies, image_format, quantize):
+    """ワーカー側でワードクラウドを描画（フォントはワーカーごとに使い回す）"""
+    global _renderer
+    if _renderer is None:
+        from wordcloud_render import WordCloudRenderer
+        _renderer = WordCloudRenderer()
+    return _renderer.render(frequencies, image_format, quantize)
+
+
+def default_pool_size():
+    """gunicornのワーカーごとにプールを持つため、CPU数をワーカー数で割った数（最低1）にする"""
+    gunicorn_workers = max(1, int(os.getenv('GUNICORN_WORKERS', '1')))
+    return max(1, (os.cpu_count() or 1) // gunicorn_workers)
+
+
+class WorkerPool:
+    """CPU負荷の高い処理をWebのスレッドから切り離して実行するプロセスプール"""
+
+    def __init__(self, max_workers=None, timeout=None, chunk_size=None):
+        # 0を指定するとプロセスを使わずに呼び出し元のスレッドで実行する
+        if max_workers is None:
+            max_workers = int(os.getenv('WORKER_POOL_SIZE', str(default_pool_size())))
+        self.max_workers = max_workers
+        self.timeout = float(timeout or os.getenv('WORKER_TASK_TIMEOUT', '60'))
+        self.chunk_size = int(chunk_size or os.getenv('WORKER_CHUNK_SIZE', '200'))
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._suspended = False
+        self.warmed = self.max_workers <= 0
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'timeouts': 0,
+            'recycles': 0
+        }
+
+    @property
+    def enabled(self):
+        return self.max_workers > 0 and not self._suspended
+
+    def suspend(self):
+        """ワーカーを使わず呼び出し元で実行させる（プロセスプールはforkを越えて使えないため、fork前の親プロセスで使う）"""
+        self._suspended = True
+
+    def resume(self):
+        self._suspended = False
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # スレッドを持つ親プロセスをforkしないよう、forkserverからワーカーを起動する
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['worker_pool'])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=context,
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def _recycle(self, executor):
+        """止まったワーカーを終了させ、次の呼び出しで新しいプールを作る"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._stats['recycles'] += 1
+        # ProcessPoolExecutorには実行中のワーカーを止める公開APIがないため直接終了させる
+        for process in list(getattr(executor, '_processes', {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _wait(self, executor, futures, timeout):
+        deadline = time.monotonic() + timeout
+        try:
+            return [future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures]
+        except FutureTimeoutError:
+            self._stats['timeouts'] += 1
+            self._recycle(executor)
+            raise WorkerTimeoutError(f"Worker task timed out after {timeout}s")
+        except BrokenProcessPool:
+            self._recycle(executor)
+            raise
+        finally:
+            self._stats['completed'] += sum(1 for future in futures if future.done())
+
+    def submit(self, fn, *args, timeout=None):
+        """fn(*args)をワーカーで実行し、結果を待って返す"""
+        if not self.enabled:
+            return fn(*args)
+        executor = self._get_executor()
+        self._stats['submitted'] += 1
+        future = executor.submit(fn, *args)
+        return self._wait(executor, [future], timeout or self.timeout)[0]
+
+    def map_chunks(self, fn, items, timeout=None):
+        """itemsをchunk_sizeごとに分けて並列に処理し、結果を元の順に連結して返す"""
+        items = list(items)
+        if not self.enabled:
+            return fn(items)
+        executor = self._get_executor()
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        self._stats['submitted'] += len(chunks)
+        futures = [executor.submit(fn, chunk) for chunk in chunks]
+        results = []
+        for chunk_result in self._wait(executor, futures, timeout or self.timeout):
+            results.extend(chunk_result)
+        return results
+
+    def warm_up(self):
+        """ワーカープロセスを起動し、最初のリクエストの前に辞書とフォントを読み込ませる"""
+        if not self.enabled:
+            return True
+        executor = self._get_executor()
+        # 空いているワーカーがない間は投入ごとにプロセスが増えるため、同時に投入して全プロセスを起動させる
+        futures = [executor.submit(warm_up_worker) for _ in range(self.max_workers)]
+        pids = set(self._wait(executor, futures, self.timeout))
+        self.warmed = True
+        return len(pids)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'running': self._executor is not None,
+            **self._stats
+        }